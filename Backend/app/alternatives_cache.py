@@ -0,0 +1,242 @@
+"""
+/smart-alternatives の結果キャッシュ
+メモリ上のLRU（TTL付き）と、再起動後も残るSQLiteの2段構成
+同じキーの計算が同時に走る場合は1つにまとめる（single-flight）
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# メモリ上に保持する件数と有効期限（秒）
+ALTERNATIVES_CACHE_SIZE = int(os.environ.get("ALTERNATIVES_CACHE_SIZE", "1024"))
+ALTERNATIVES_CACHE_TTL = float(os.environ.get("ALTERNATIVES_CACHE_TTL", "86400"))
+
+# SQLiteのキャッシュファイル（空の場合はメモリのみ）
+ALTERNATIVES_CACHE_DB = os.environ.get("ALTERNATIVES_CACHE_DB", "")
+
+_whitespace_pattern = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """全角・半角の揺れと空白の違いを吸収する"""
+    return _whitespace_pattern.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def make_key(text, target_word, start=None, window=None, **preferences):
+    """
+    対象単語の前後の文脈・対象単語の位置・発音の設定からキャッシュキーを作る
+    start: 対象単語の文字位置（省略時はテキスト内で最初に現れる位置）
+    window: BERTに入力する文脈の範囲 (開始位置, 終了位置)（省略時はテキスト全体）
+    preferences の値がリストの場合は順序を無視する
+    """
+    if start is None:
+        start = text.find(target_word)
+    if start < 0:
+        start = 0
+    end = start + len(target_word)
+    window_start, window_end = window if window is not None else (0, len(text))
+    before = normalize_text(text[window_start:start])
+    after = normalize_text(text[end:window_end])
+
+    normalized_preferences = {
+        name: sorted(value) if isinstance(value, (list, tuple)) else value
+        for name, value in sorted(preferences.items())
+    }
+    payload = json.dumps(
+        [before, normalize_text(target_word), after, normalized_preferences],
+        ensure_ascii=False,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+
+class _SQLiteStore:
+    """SQLAlchemyでSQLiteに結果を保存する永続化層"""
+
+    def __init__(self, path):
+        from sqlalchemy import Column, Float, MetaData, String, Table, Text, create_engine
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._engine = create_engine(f"sqlite:///{path}")
+        metadata = MetaData()
+        self._table = Table(
+            "alternatives_cache",
+            metadata,
+            Column("key", String(64), primary_key=True),
+            Column("value", Text, nullable=False),
+            Column("created_at", Float, nullable=False),
+        )
+        metadata.create_all(self._engine)
+
+    def get(self, key, ttl):
+        from sqlalchemy import delete, select
+
+        with self._engine.begin() as conn:
+            row = conn.execute(
+                select(self._table.c.value, self._table.c.created_at).where(
+                    self._table.c.key == key
+                )
+            ).first()
+            if row is None:
+                return None
+            if time.time() - row.created_at > ttl:
+                conn.execute(delete(self._table).where(self._table.c.key == key))
+                return None
+            return json.loads(row.value)
+
+    def put(self, key, value):
+        from sqlalchemy.dialects.sqlite import insert
+
+        statement = insert(self._table).values(
+            key=key, value=json.dumps(value, ensure_ascii=False), created_at=time.time()
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["key"],
+            set_={"value": statement.excluded.value, "created_at": statement.excluded.created_at},
+        )
+        with self._engine.begin() as conn:
+            conn.execute(statement)
+
+
+class AlternativesCache:
+    """代替案の結果キャッシュ（メモリ → SQLite → 計算 の順に参照する）"""
+
+    def __init__(self, max_size=1024, ttl=86400.0, db_path=""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.stats = {
+            "hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "promoted": 0,
+            "errors": 0,
+        }
+
+        self._store = None
+        if db_path:
+            try:
+                self._store = _SQLiteStore(db_path)
+                logger.info(f"代替案のキャッシュを {db_path} に保存します")
+            except Exception as e:
+                logger.warning(f"代替案のキャッシュDBを開けませんでした（メモリのみ使用します）: {e}")
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _put_memory(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute, promote=None):
+        """
+        キャッシュにあれば返し、なければ compute() を待って結果を保存する
+        同じキーの計算中に届いた呼び出しは、その計算結果を共有する
+        promote: 優先度の低い計算（先読みなど）の優先度を上げる関数
+        promote を指定しない呼び出しが優先度の低い計算に相乗りする場合は、promote() で
+        計算を自分の優先度に上げてから結果を待つ（計算済みの部分は捨てない）
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            if entry[1] is not None and promote is None:
+                entry[1]()
+                entry[1] = None
+                self.stats["promoted"] += 1
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(entry[0])
+
+        # 呼び出し元がキャンセルされても計算は続け、相乗りしている呼び出しに結果を返す
+        task = asyncio.ensure_future(self._load_or_compute(key, compute))
+        entry = [task, promote]
+        self._in_flight[key] = entry
+        task.add_done_callback(lambda _: self._finish(key, entry))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, entry):
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+        task = entry[0]
+        # 待っている呼び出しがない場合に「未取得の例外」の警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    async def _load_or_compute(self, key, compute):
+        if self._store is not None:
+            try:
+                value = await asyncio.to_thread(self._store.get, key, self.ttl)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"代替案のキャッシュDBの読み込みに失敗しました: {e}")
+                value = None
+            if value is not None:
+                self.stats["db_hits"] += 1
+                self._put_memory(key, value)
+                return value
+
+        self.stats["misses"] += 1
+        value = await compute()
+        self._put_memory(key, value)
+
+        if self._store is not None:
+            try:
+                await asyncio.to_thread(self._store.put, key, value)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"代替案のキャッシュDBへの書き込みに失敗しました: {e}")
+        return value
+
+    def contains(self, key):
+        """メモリ上に有効な結果があるか（統計には数えない）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() <= entry[1]
+
+    def clear(self):
+        """メモリ上のキャッシュを空にする（SQLiteの内容は残す）"""
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        """ヒット数・ミス数などの統計"""
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "persistent": self._store is not None,
+        }
+
+
+alternatives_cache = AlternativesCache(
+    ALTERNATIVES_CACHE_SIZE, ALTERNATIVES_CACHE_TTL, ALTERNATIVES_CACHE_DB
+)
@@ -0,0 +1,143 @@
+"""
+複数ユーザーから同時に届いたMLM推論をまとめて1回のフォワードで処理するバッチスケジューラ
+集めたバッチはモデル推論用エグゼキュータで実行し、他の推論と同時に走らせず優先度にも従う
+"""
+
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import inference
+import metrics
+import nlp_utils
+
+logger = logging.getLogger(__name__)
+
+# 1バッチに含める最大リクエスト数と、バッチを集める最大待ち時間（ミリ秒）
+MLM_MAX_BATCH_SIZE = int(os.environ.get("MLM_MAX_BATCH_SIZE", "16"))
+MLM_MAX_WAIT_MS = float(os.environ.get("MLM_MAX_WAIT_MS", "5"))
+
+# バッチ待ちの最大リクエスト数
+MLM_BATCH_QUEUE_SIZE = int(os.environ.get("MLM_BATCH_QUEUE_SIZE", "64"))
+
+
+class MLMBatcher:
+    """
+    短い時間窓の間に届いたマスク入力を集め、パディングして一度に推論する
+    各呼び出し元には自分の入力に対するTop-kだけが Future で返される
+    待機中の入力が max_batch_size を超える場合は優先度の高いものからバッチに含める
+    """
+
+    def __init__(self, max_batch_size, max_wait_ms, max_queue_size):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.PriorityQueue(maxsize=max_queue_size)
+        self._sequence = itertools.count()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """バッチ待ちのリクエスト数"""
+        return self._queue.qsize()
+
+    def submit(
+        self,
+        text,
+        target_word,
+        top_k=5,
+        difficult_sounds=None,
+        priority=inference.PRIORITY_INTERACTIVE,
+        token=None,
+    ):
+        """推論をキューに積み、代替案のリストを結果とする Future を返す"""
+        self._ensure_started()
+
+        future = Future()
+        item = (text, target_word, top_k, difficult_sounds)
+        try:
+            self._queue.put_nowait(
+                (
+                    inference.effective_priority(priority, token),
+                    next(self._sequence),
+                    item,
+                    token,
+                    future,
+                )
+            )
+        except queue.Full:
+            raise inference.QueueFullError("MLMのバッチキューが満杯です")
+        return future
+
+    def promote(self, token, priority):
+        """バッチ待ちの token の入力の優先度を priority まで上げる"""
+        inference.promote_queued(self._queue, token, priority, 3)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="mlm-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _collect_batch(self):
+        """最初の1件が届いてから最大待ち時間の間、バッチを集める"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # 呼び出し元がキャンセル済みのもの・新しいバージョンのリクエストが届いたものは推論しない
+        runnable = []
+        priority = None
+        for item_priority, _, item, token, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if token is not None and token.superseded:
+                future.set_exception(inference.SupersededError("新しいリクエストが届きました"))
+                continue
+            runnable.append((item, future))
+            priority = item_priority if priority is None else min(priority, item_priority)
+        return runnable, priority
+
+    def _run(self):
+        while True:
+            batch, priority = self._collect_batch()
+            if not batch:
+                continue
+
+            metrics.observe_batch_size("mlm_batcher", len(batch))
+            # バッチ内で最も優先度の高いリクエストの優先度でモデル推論用エグゼキュータに積み、完了を待つ
+            # （待っている間に届いたリクエストは次のバッチにまとまる）
+            try:
+                results = inference.model_executor.submit(
+                    nlp_utils.generate_alternatives_with_mlm_batch,
+                    [item for item, _ in batch],
+                    priority=priority,
+                ).result()
+            except Exception as e:
+                if not isinstance(e, inference.QueueFullError):
+                    logger.error(f"MLMのバッチ推論中にエラーが発生しました: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), alternatives in zip(batch, results):
+                future.set_result(alternatives)
+
+
+mlm_batcher = MLMBatcher(MLM_MAX_BATCH_SIZE, MLM_MAX_WAIT_MS, MLM_BATCH_QUEUE_SIZE)
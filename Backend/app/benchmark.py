@@ -0,0 +1,270 @@
+"""
+形態素解析・難しい単語の検出・MLMによる代替案生成・HTTPエンドポイントのベンチマーク
+ネットワークに接続せず、ランダムに初期化した小さなBERT（同じインターフェース）で計測する
+
+使い方:
+    python benchmark.py                               # 計測して結果を表示する
+    python benchmark.py --save-baseline baseline.json # 結果をベースラインとして保存する
+    python benchmark.py --baseline baseline.json      # ベースラインと比較する（劣化があれば終了コード1）
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# 合成文書の材料となる文
+SYNTHETIC_SENTENCES = [
+    "吃音症は言語障害の一種です。",
+    "人前で話すのは緊張します。",
+    "今日は学校に行きます。",
+    "明日の会議で新しい企画を発表します。",
+    "先生に挨拶をしてから帰りました。",
+    "北の空がきれいに晴れています。",
+    "駅までの道を近くの人に尋ねました。",
+    "毎朝コーヒーを飲みながら新聞を読みます。",
+    "切手を買いに郵便局へ行きました。",
+    "この本はとても興味深い内容でした。",
+    "会社の同僚と昼ご飯を食べました。",
+    "週末は家族と公園を散歩しました。",
+    "新しい仕事に少しずつ慣れてきました。",
+    "電話で予約の時間を確認しました。",
+    "資料を印刷して会議室に持っていきます。",
+    "しっかり準備をすれば大丈夫です。",
+]
+
+# 代替案の対象とする単語と、それを含む文
+TARGET_WORD = "企画"
+TARGET_SENTENCE = "明日の会議で新しい企画を発表します。"
+
+# 文書の大きさ（文の数）
+DEFAULT_SIZES = [10, 100, 1000]
+
+# 計測で使う苦手な音
+DIFFICULT_SOUNDS = ["き", "し", "か"]
+
+
+def synthetic_document(sentences, seed=0):
+    """材料の文をランダムに並べた合成文書を作る（同じ seed なら同じ文書になる）"""
+    rng = random.Random(seed)
+    return "".join(rng.choice(SYNTHETIC_SENTENCES) for _ in range(sentences))
+
+
+def build_tiny_model(path):
+    """
+    合成文書の語彙だけを持つ小さなBERTをランダムな重みで作成して保存する
+    トークナイザは本番のモデルと同じMeCab + WordPieceの BertJapaneseTokenizer
+    """
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+
+    import MeCab
+    import torch
+    from transformers import BertConfig, BertForMaskedLM, BertJapaneseTokenizer
+
+    tagger = MeCab.Tagger()
+    words = set()
+    node = tagger.parseToNode("\n".join(SYNTHETIC_SENTENCES))
+    while node:
+        if node.surface:
+            words.add(node.surface)
+        node = node.next
+    words = sorted(words)
+
+    special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab = special_tokens + words + ["##" + word for word in words]
+
+    os.makedirs(path, exist_ok=True)
+    vocab_path = os.path.join(path, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab) + "\n")
+
+    tokenizer = BertJapaneseTokenizer(
+        vocab_path,
+        word_tokenizer_type="mecab",
+        subword_tokenizer_type="wordpiece",
+        mecab_kwargs={"mecab_dic": "unidic_lite"},
+    )
+    tokenizer.save_pretrained(path)
+
+    # 重みは固定のシードで初期化し、実行ごとに同じ結果になるようにする
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        max_position_embeddings=512,
+    )
+    BertForMaskedLM(config).save_pretrained(path)
+    return path
+
+
+def summarize(timings, chars):
+    """計測時間のリストからパーセンタイルとスループットを求める"""
+    timings = sorted(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))]
+
+    mean = statistics.mean(timings)
+    return {
+        "p50_ms": percentile(50) * 1000,
+        "p90_ms": percentile(90) * 1000,
+        "p99_ms": percentile(99) * 1000,
+        "mean_ms": mean * 1000,
+        "ops_per_sec": 1.0 / mean if mean > 0 else 0.0,
+        "chars_per_sec": chars / mean if mean > 0 else 0.0,
+    }
+
+
+def measure(fn, repeat, warmup=2, setup=None):
+    """fn の実行時間（秒）を repeat 回計測する（setup は毎回の計測前に実行する）"""
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def run_benchmarks(sizes, repeat):
+    """各ベンチマークを文書の大きさごとに実行し、{名前@大きさ: 集計結果} を返す"""
+    import alternatives_cache
+    import main
+    import nlp_utils
+    from fastapi.testclient import TestClient
+
+    if not nlp_utils.wait_for_model():
+        raise SystemExit("モデルをロードできませんでした")
+    client = TestClient(main.app)
+
+    def clear_caches():
+        # 毎回キャッシュなしの状態から計測する
+        nlp_utils._segment_cache.clear()
+        nlp_utils._reading_cache.clear()
+        alternatives_cache.alternatives_cache.clear()
+
+    results = {}
+    for size in sizes:
+        # 文書の中央に代替案の対象の単語を含む文を置く
+        half = (size - 1) // 2
+        text = (
+            synthetic_document(half, seed=0)
+            + TARGET_SENTENCE
+            + synthetic_document(size - 1 - half, seed=1)
+        )
+        target = TARGET_WORD
+        alternatives = nlp_utils.generate_alternatives_with_mlm(text, target, top_k=30)
+
+        benchmarks = {
+            "analyze_morphology": lambda: nlp_utils.analyze_morphology(text),
+            "get_difficult_words": lambda: nlp_utils.get_difficult_words(
+                text, 0.5, DIFFICULT_SOUNDS
+            ),
+            "generate_alternatives_with_mlm": lambda: nlp_utils.generate_alternatives_with_mlm(
+                text, target, top_k=30
+            ),
+            "filter_by_pronunciation_ease": lambda: nlp_utils.filter_by_pronunciation_ease(
+                [{k: v for k, v in alt.items() if k != "reading"} for alt in alternatives]
+            ),
+            "POST /analyze-realtime": lambda: client.post(
+                "/analyze-realtime",
+                json={"text": text, "difficult_sounds": DIFFICULT_SOUNDS},
+            ).raise_for_status(),
+            "POST /smart-alternatives": lambda: client.post(
+                "/smart-alternatives",
+                json={"text": text, "target_word": target, "method": "both"},
+            ).raise_for_status(),
+        }
+
+        for name, fn in benchmarks.items():
+            timings = measure(fn, repeat, setup=clear_caches)
+            results[f"{name}@{size}"] = summarize(timings, len(text))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """p50をベースラインと比較し、tolerance を超えて遅くなった項目の名前のリストを返す"""
+    regressions = []
+    print(f"\n{'ベンチマーク':<44} {'ベースライン':>12} {'今回':>10} {'比':>7}")
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["p50_ms"]
+        after = summary["p50_ms"]
+        ratio = after / before if before > 0 else 1.0
+        mark = ""
+        if ratio > 1.0 + tolerance:
+            mark = "  劣化"
+            regressions.append(name)
+        print(f"{name:<44} {before:>10.2f}ms {after:>8.2f}ms {ratio:>6.2f}x{mark}")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'ベンチマーク':<44} {'p50':>9} {'p90':>9} {'p99':>9} {'ops/s':>9} {'文字/s':>12}")
+    for name, summary in results.items():
+        print(
+            f"{name:<44} {summary['p50_ms']:>7.2f}ms {summary['p90_ms']:>7.2f}ms "
+            f"{summary['p99_ms']:>7.2f}ms {summary['ops_per_sec']:>9.1f} "
+            f"{summary['chars_per_sec']:>12.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="合成文書の文の数"
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="計測回数")
+    parser.add_argument(
+        "--model-dir",
+        default=os.path.join(tempfile.gettempdir(), "fluent_assist_benchmark_model"),
+        help="小さなBERTを保存するディレクトリ",
+    )
+    parser.add_argument("--baseline", help="比較するベースラインのJSONファイル")
+    parser.add_argument("--save-baseline", help="結果をベースラインとして保存するJSONファイル")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="劣化とみなすp50の増加率（0.2 = 20%%）"
+    )
+    args = parser.parse_args()
+
+    # nlp_utils の読み込み前に、小さなモデルとネットワークを使わない設定にする
+    os.environ["BERT_MODEL_NAME"] = build_tiny_model(args.model_dir)
+    os.environ["FLUENT_ASSIST_CACHE_DIR"] = os.path.join(args.model_dir, "cache")
+    os.environ["ALTERNATIVES_CACHE_DB"] = ""
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    results = run_benchmarks(args.sizes, args.repeat)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)}件のベンチマークがベースラインより遅くなりました")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+原稿ファイルをまとめて解析し、難しい単語とその代替案をJSONLで出力するツール
+段落ごとにプロセスプールへ分散し、各ワーカーは独自のMeCabとBERTモデルを持つ
+
+使い方:
+    python bulk_analyze.py speeches/ slides.txt -o results.jsonl --difficult-sounds し は き
+    python bulk_analyze.py speeches/ -o results.jsonl --no-alternatives --workers 8
+
+同じ出力ファイルを指定して再実行すると、出力済みの段落を飛ばして続きから処理する
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# 解析対象とするファイルの拡張子
+DEFAULT_EXTENSIONS = [".txt", ".md"]
+
+# ワーカーごとに先行して投入しておく段落数（入力全体をメモリに載せないための上限）
+TASKS_PER_WORKER = 4
+
+# ワーカープロセスでの解析設定（initializerで設定する）
+_worker_options = None
+
+
+def iter_input_files(paths, extensions=DEFAULT_EXTENSIONS):
+    """入力パス（ファイルまたはディレクトリ）から解析対象のファイルを順に返す"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in extensions:
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def split_paragraphs(text):
+    """空行で区切られた段落を (段落番号, 段落) のリストとして返す"""
+    paragraphs = []
+    current = []
+    for line in text.splitlines():
+        if line.strip():
+            current.append(line)
+        elif current:
+            paragraphs.append("\n".join(current))
+            current = []
+    if current:
+        paragraphs.append("\n".join(current))
+    return list(enumerate(paragraphs))
+
+
+def paragraph_key(path, paragraph, text):
+    """段落を識別するキー（内容が変わった段落は再解析する）"""
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return (path, paragraph, digest)
+
+
+def load_completed(output_path):
+    """
+    出力済みの段落のキーを読み込む
+    中断により末尾の行が途中で切れている場合は、その行を切り詰めてから再開する
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logger.warning("出力ファイル末尾の不完全な行を削除しました")
+            f.truncate(end)
+
+    for line in data[:end].decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+            completed.add((record["path"], record["paragraph"], record["sha1"]))
+        except (ValueError, KeyError):
+            continue
+    return completed
+
+
+def _init_worker(options):
+    """ワーカープロセスの初期化（代替案を生成する場合はモデルをロードする）"""
+    global _worker_options
+
+    _worker_options = options
+    logging.basicConfig(level=logging.WARNING)
+
+    if options["alternatives"]:
+        import nlp_utils
+
+        if not nlp_utils.wait_for_model():
+            raise RuntimeError("BERTモデルをロードできませんでした")
+
+
+def _generate_alternatives(nlp_utils, text, difficult_words, options):
+    """段落内の難しい単語の代替案を生成する（MLMは段落ごとに一度の推論で処理する）"""
+    mlm_results = nlp_utils.generate_alternatives_with_mlm_spans(
+        [
+            (text, info["start"], info["end"], options["top_k"], options["difficult_sounds"])
+            for info in difficult_words
+        ]
+    )
+
+    results = []
+    for info, alternatives in zip(difficult_words, mlm_results):
+        if alternatives and options["method"] == "both":
+            embedding_alternatives = nlp_utils.generate_alternatives_with_similar_embeddings(
+                text,
+                info["word"],
+                [alt["word"] for alt in alternatives],
+                top_k=len(alternatives),
+                start=info["start"],
+            )
+            alternatives = nlp_utils.combine_alternatives(
+                alternatives, embedding_alternatives
+            )
+        results.append(
+            nlp_utils.filter_by_pronunciation_ease(alternatives) if alternatives else []
+        )
+    return results
+
+
+def analyze_paragraph(task):
+    """1つの段落を解析し、出力するレコードを返す（ワーカープロセスで実行する）"""
+    import nlp_utils
+
+    (path, paragraph, digest), text = task
+    options = _worker_options
+
+    table = nlp_utils.analyze_text(text)
+    difficult_words = nlp_utils.get_difficult_words(
+        text, options["threshold"], options["difficult_sounds"], table=table
+    )
+
+    if options["alternatives"] and difficult_words:
+        alternatives = _generate_alternatives(nlp_utils, text, difficult_words, options)
+        for info, word_alternatives in zip(difficult_words, alternatives):
+            info["alternatives"] = word_alternatives
+
+    return {
+        "path": path,
+        "paragraph": paragraph,
+        "sha1": digest,
+        "text": text,
+        "words": difficult_words,
+    }
+
+
+def iter_tasks(files, completed, stats):
+    """入力ファイルを順に読み込み、未処理の段落を ((パス, 段落番号, ハッシュ), 段落) として返す"""
+    for path in files:
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f"{path} を読み込めませんでした: {e}")
+            stats["failed_files"] += 1
+            continue
+
+        for paragraph, paragraph_text in split_paragraphs(text):
+            key = paragraph_key(path, paragraph, paragraph_text)
+            if key in completed:
+                stats["skipped"] += 1
+                continue
+            yield key, paragraph_text
+        stats["files"] += 1
+
+
+def run(files, output_path, options, workers, progress_interval=10.0):
+    """段落をプロセスプールで解析し、完了した順にJSONLへ追記する"""
+    completed = load_completed(output_path)
+    if completed:
+        logger.info(f"出力済みの{len(completed)}段落をスキップして再開します")
+
+    stats = {"files": 0, "failed_files": 0, "skipped": 0, "done": 0, "errors": 0}
+    tasks = iter_tasks(files, completed, stats)
+    max_pending = workers * TASKS_PER_WORKER
+
+    # spawnで起動し、各ワーカーが独自のMeCabとモデルを初期化する
+    context = multiprocessing.get_context("spawn")
+    started = last_report = time.monotonic()
+
+    with open(output_path, "a", encoding="utf-8") as out, concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(options,),
+    ) as pool:
+        pending = {}
+
+        def submit_next():
+            for task in tasks:
+                pending[pool.submit(analyze_paragraph, task)] = task[0]
+                if len(pending) >= max_pending:
+                    break
+
+        submit_next()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                path, paragraph, _ = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error(f"{path} の段落{paragraph}の解析に失敗しました: {e}")
+                    stats["errors"] += 1
+                    continue
+                # 1段落ごとに書き出すことで、中断しても完了分は失われない
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                stats["done"] += 1
+            submit_next()
+
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                _report_progress(stats, len(files), now - started)
+
+    _report_progress(stats, len(files), time.monotonic() - started)
+    return stats
+
+
+def _report_progress(stats, total_files, elapsed):
+    """進捗をログに出力する"""
+    rate = stats["done"] / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"ファイル {stats['files']}/{total_files}、解析済み {stats['done']}段落"
+        f"（スキップ {stats['skipped']}、失敗 {stats['errors']}）、{rate:.1f}段落/秒"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="解析するファイルまたはディレクトリ")
+    parser.add_argument("-o", "--output", required=True, help="出力するJSONLファイル")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数"
+    )
+    parser.add_argument("--difficult-sounds", nargs="*", default=None, help="苦手な音")
+    parser.add_argument("--threshold", type=float, default=0.5, help="難しさの閾値")
+    parser.add_argument(
+        "--no-alternatives",
+        dest="alternatives",
+        action="store_false",
+        help="代替案を生成しない（BERTモデルをロードしない）",
+    )
+    parser.add_argument(
+        "--method", choices=["mlm", "both"], default="both", help="代替案の生成方法"
+    )
+    parser.add_argument("--top-k", type=int, default=30, help="MLMの候補数")
+    parser.add_argument(
+        "--extensions", nargs="+", default=DEFAULT_EXTENSIONS, help="解析するファイルの拡張子"
+    )
+    parser.add_argument(
+        "--progress-interval", type=float, default=10.0, help="進捗を表示する間隔（秒）"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    workers = max(1, args.workers)
+    # コアを取り合わないよう、ワーカーごとのスレッド数を割り当てる（子プロセスに引き継がれる）
+    os.environ.setdefault(
+        "TORCH_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+    )
+    os.environ.setdefault("TORCH_INTEROP_THREADS", "1")
+
+    files = list(iter_input_files(args.inputs, [ext.lower() for ext in args.extensions]))
+    options = {
+        "threshold": args.threshold,
+        "difficult_sounds": args.difficult_sounds,
+        "alternatives": args.alternatives,
+        "method": args.method,
+        "top_k": args.top_k,
+    }
+    stats = run(files, args.output, options, workers, args.progress_interval)
+    if stats["errors"] or stats["failed_files"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
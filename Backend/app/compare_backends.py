@@ -0,0 +1,94 @@
+"""
+推論バックエンドごとのMLMのTop-kをfp32のPyTorchと比較し、一致率と推論時間を表示するツール
+
+使い方:
+    python compare_backends.py --backends torch-int8 onnx onnx-int8 --top-k 10
+"""
+
+import argparse
+import time
+
+import torch
+
+import model_backends
+import nlp_utils
+
+# 比較に使う例文（[MASK]の位置を予測させる）
+SAMPLE_SENTENCES = [
+    "吃音症は言語障害の[MASK]です。",
+    "人前で[MASK]のは緊張します。",
+    "明日の会議で新しい[MASK]を発表します。",
+    "先生に[MASK]をしてから帰りました。",
+    "今日は天気が[MASK]ので散歩に行きます。",
+    "駅までの道を[MASK]に尋ねました。",
+    "この本はとても[MASK]内容でした。",
+    "毎朝コーヒーを[MASK]ながら新聞を読みます。",
+]
+
+
+def predict_topk(backend, tokenizer, sentences, top_k):
+    """各文のマスク位置でのTop-kのトークンIDと推論時間（秒）を返す"""
+    inputs = tokenizer(sentences, padding=True, return_tensors="pt")
+    rows, cols = torch.where(inputs["input_ids"] == tokenizer.mask_token_id)
+
+    started = time.perf_counter()
+    logits = backend.masked_logits(**inputs, rows=rows, cols=cols)
+    elapsed = time.perf_counter() - started
+
+    topk = torch.topk(logits, k=top_k, dim=-1).indices.tolist()
+    return topk, elapsed
+
+
+def compare(baseline, candidate, top_k):
+    """Top-1の一致率とTop-kの重なりの割合を返す"""
+    top1 = sum(b[0] == c[0] for b, c in zip(baseline, candidate)) / len(baseline)
+    overlap = sum(len(set(b) & set(c)) / top_k for b, c in zip(baseline, candidate))
+    return top1, overlap / len(baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=[b for b in model_backends.BACKENDS if b != model_backends.BACKEND_TORCH],
+        choices=model_backends.BACKENDS,
+        help="比較するバックエンド",
+    )
+    parser.add_argument("--top-k", type=int, default=10, help="比較するTop-kのk")
+    parser.add_argument("--repeat", type=int, default=5, help="推論時間の計測回数")
+    args = parser.parse_args()
+
+    nlp_utils.configure_torch_threads()
+    model, tokenizer = nlp_utils.load_model()
+    if tokenizer is None:
+        raise SystemExit("モデルをロードできませんでした")
+
+    def measure(name):
+        # 量子化・エクスポートは元のモデルを書き換えない（量子化は新しいモジュールを返す）ため、
+        # 全てのバックエンドで同じモデルを使う
+        backend = model_backends.create_backend(
+            name, model, nlp_utils.bert_model_name, nlp_utils.CACHE_DIR
+        )
+        topk, _ = predict_topk(backend, tokenizer, SAMPLE_SENTENCES, args.top_k)
+        timings = [
+            predict_topk(backend, tokenizer, SAMPLE_SENTENCES, args.top_k)[1]
+            for _ in range(args.repeat)
+        ]
+        return backend.name, topk, sorted(timings)[len(timings) // 2]
+
+    _, baseline, baseline_time = measure(model_backends.BACKEND_TORCH)
+
+    print(f"{'backend':<12} {'top1一致':>8} {f'top{args.top_k}重なり':>10} {'時間(ms)':>9} {'速度比':>6}")
+    print(f"{model_backends.BACKEND_TORCH:<12} {1.0:>8.3f} {1.0:>10.3f} {baseline_time * 1000:>9.1f} {1.0:>6.2f}")
+    for name in args.backends:
+        actual_name, topk, elapsed = measure(name)
+        top1, overlap = compare(baseline, topk, args.top_k)
+        label = name if actual_name == name else f"{name}(失敗)"
+        print(
+            f"{label:<12} {top1:>8.3f} {overlap:>10.3f} {elapsed * 1000:>9.1f} {baseline_time / elapsed:>6.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
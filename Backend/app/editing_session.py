@@ -0,0 +1,172 @@
+"""
+WebSocketの編集セッション
+クライアントから届く編集操作で文書を更新し、ハイライトの差分だけを返す
+
+クライアントとサーバーはハイライトをIDで共有する。差分の適用手順:
+1. shifts を順に適用する（start が at 以上のハイライトを delta だけずらす）
+2. removed のIDのハイライトを削除する
+3. added のハイライトを追加する
+"""
+
+import nlp_utils
+
+
+class EditError(ValueError):
+    """文書に適用できない編集操作を受け取ったときに送出される例外"""
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_str_list(name, value):
+    if value is not None and (
+        not isinstance(value, list) or not all(isinstance(v, str) for v in value)
+    ):
+        raise EditError(f"{name} は文字列のリストで指定してください: {value!r}")
+
+
+def check_message(message):
+    """メッセージの共通のフィールド（version, profile_id, prefetch_alternatives）の型を確認する"""
+    if message.get("version") is not None and not _is_int(message["version"]):
+        raise EditError(f"version は整数で指定してください: {message['version']!r}")
+    for name in ("profile_id", "prefetch_alternatives"):
+        if message.get(name) is not None and not isinstance(message[name], str):
+            raise EditError(f"{name} は文字列で指定してください: {message[name]!r}")
+
+
+class EditingSession:
+    """1つのWebSocket接続に対応する文書とハイライトの状態"""
+
+    def __init__(self):
+        self.text = ""
+        self.difficult_sounds = None
+        # 代替案の先読みのキーを /smart-alternatives と揃えるために保持する
+        self.easy_pronunciations = None
+        self.difficulty_threshold = 0.5
+        self.profile = None
+        # クライアントが保持しているハイライト（ID -> ハイライト）
+        self.highlights = {}
+        # 直近の差分以降、クライアントと共有済みのずらし操作
+        self._pending_shifts = []
+        self._next_id = 0
+
+    def reset(
+        self,
+        text,
+        difficult_sounds=None,
+        difficulty_threshold=0.5,
+        profile=None,
+        easy_pronunciations=None,
+    ):
+        """文書と設定を置き換え、全てのハイライトを返す（profile の指定時は音の設定より優先）"""
+        if not isinstance(text, str):
+            raise EditError(f"text は文字列で指定してください: {text!r}")
+        self.set_options(difficult_sounds, difficulty_threshold, profile, easy_pronunciations)
+        self.text = text
+        self.highlights = {}
+        self._pending_shifts = []
+        self.refresh()
+        return sorted(self.highlights.values(), key=lambda h: h["start"])
+
+    def set_options(
+        self, difficult_sounds=None, difficulty_threshold=0.5, profile=None, easy_pronunciations=None
+    ):
+        """苦手な音などの設定を変更する（反映は次の refresh で行う）"""
+        _check_str_list("difficult_sounds", difficult_sounds)
+        _check_str_list("easy_pronunciations", easy_pronunciations)
+        if not isinstance(difficulty_threshold, (int, float)) or isinstance(
+            difficulty_threshold, bool
+        ):
+            raise EditError(
+                f"difficulty_threshold は数値で指定してください: {difficulty_threshold!r}"
+            )
+        self.difficult_sounds = profile.difficult_sounds if profile else difficult_sounds
+        self.easy_pronunciations = profile.easy_pronunciations if profile else easy_pronunciations
+        self.difficulty_threshold = difficulty_threshold
+        self.profile = profile
+
+    def apply_edits(self, edits):
+        """
+        編集操作 {"start", "end", "text"} を順に文書へ適用する
+        位置は直前の操作を適用した後の文書での文字位置
+        """
+        if not isinstance(edits, list):
+            raise EditError(f"edits は編集操作のリストで指定してください: {edits!r}")
+        for edit in edits:
+            if (
+                not isinstance(edit, dict)
+                or not _is_int(edit.get("start"))
+                or not _is_int(edit.get("end"))
+                or not isinstance(edit.get("text"), str)
+            ):
+                raise EditError(f"不正な編集操作です: {edit!r}")
+            start, end, replacement = edit["start"], edit["end"], edit["text"]
+            if not 0 <= start <= end <= len(self.text):
+                raise EditError(f"編集範囲が文書の範囲外です: {edit}")
+
+            self.text = self.text[:start] + replacement + self.text[end:]
+            delta = len(replacement) - (end - start)
+
+            # 編集範囲に重なるハイライトは無効になるため削除する
+            for highlight_id, highlight in list(self.highlights.items()):
+                if highlight["start"] < end and highlight["end"] > start or (
+                    start == end and highlight["start"] < start < highlight["end"]
+                ):
+                    highlight["stale"] = True
+                elif delta and highlight["start"] >= end:
+                    highlight["start"] += delta
+                    highlight["end"] += delta
+            if delta:
+                self._pending_shifts.append({"at": end, "delta": delta})
+
+    def refresh(self):
+        """
+        文書を解析し直し、前回からのハイライトの差分を返す
+        変更のない文は文単位のキャッシュにより再解析されない
+        """
+        table = nlp_utils.analyze_text(self.text)
+        words = nlp_utils.get_difficult_words(
+            self.text,
+            self.difficulty_threshold,
+            self.difficult_sounds,
+            table=table,
+            matcher=self.profile.matcher if self.profile else None,
+        )
+        current = {(w["start"], w["end"], w["word"], w["reason"]): w for w in words}
+
+        removed = []
+        kept = set()
+        for highlight_id, highlight in list(self.highlights.items()):
+            key = (highlight["start"], highlight["end"], highlight["word"], highlight["reason"])
+            if highlight.get("stale") or key not in current or key in kept:
+                removed.append(highlight_id)
+                del self.highlights[highlight_id]
+            else:
+                kept.add(key)
+
+        added = []
+        for key, word_info in current.items():
+            if key in kept:
+                continue
+            highlight = {
+                "id": self._next_id,
+                "word": word_info["word"],
+                "start": word_info["start"],
+                "end": word_info["end"],
+                "reason": word_info["reason"],
+                "reading": word_info["reading"],
+            }
+            self._next_id += 1
+            self.highlights[highlight["id"]] = highlight
+            added.append(highlight)
+
+        return self._delta(removed, added)
+
+    def flush_shifts(self):
+        """解析せずに、ずらし操作だけの差分を返す（解析キューが満杯のとき）"""
+        return self._delta([], [])
+
+    def _delta(self, removed, added):
+        shifts, self._pending_shifts = self._pending_shifts, []
+        return {"shifts": shifts, "removed": removed, "added": added}
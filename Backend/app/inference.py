@@ -0,0 +1,258 @@
+"""
+BERT・MeCabによる同期的な推論処理をasyncioのイベントループから切り離して実行するエグゼキュータ
+待機中の処理は優先度の順に実行し、同じクライアントの新しいバージョンのリクエストが届いた
+古いリクエストの処理は実行せずに打ち切る
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# モデル推論用のワーカー数と待機キューの長さ
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "16"))
+
+# 形態素解析用のワーカー数と待機キューの長さ
+# （各ワーカーはMeCabのTaggerをプールから借りるため、ワーカー間で解析を待ち合わせない）
+TAGGER_WORKERS = int(os.environ.get("TAGGER_WORKERS", "1"))
+TAGGER_QUEUE_SIZE = int(os.environ.get("TAGGER_QUEUE_SIZE", "64"))
+
+# キューが満杯のときにクライアントへ返す再試行までの秒数
+RETRY_AFTER_SECONDS = int(os.environ.get("INFERENCE_RETRY_AFTER", "1"))
+
+# リクエストのバージョンを記録するクライアント数の上限（超えた場合は古いものから忘れる）
+REQUEST_VERSION_CLIENTS = int(os.environ.get("REQUEST_VERSION_CLIENTS", "10000"))
+
+# 処理の優先度（値が小さいほど先に実行する。実行中の処理は中断しない）
+PRIORITY_INTERACTIVE = 0  # ポップオーバーの代替案
+PRIORITY_ANALYSIS = 1  # 編集中のテキストの解析
+PRIORITY_BULK = 2  # 文書全体の代替案の一括生成
+PRIORITY_PREFETCH = 3  # 代替案の先読み
+
+
+class QueueFullError(Exception):
+    """推論キューが満杯で新しい処理を受け付けられないときに送出される例外"""
+
+
+class SupersededError(Exception):
+    """同じクライアントから新しいバージョンのリクエストが届き、処理を打ち切ったときに送出される例外"""
+
+
+class RequestToken:
+    """1つのリクエストのバージョン（より新しいバージョンが届くと superseded になる）"""
+
+    __slots__ = ("_registry", "key", "version")
+
+    def __init__(self, registry, key, version):
+        self._registry = registry
+        self.key = key
+        self.version = version
+
+    @property
+    def superseded(self):
+        return self._registry.latest(self.key) != self.version
+
+    def check(self):
+        """新しいバージョンが届いていれば SupersededError を送出する"""
+        if self.superseded:
+            raise SupersededError(f"{self.key[1]} のバージョン {self.version} は古くなりました")
+
+
+class VersionRegistry:
+    """クライアントID・処理の種類ごとに、最後に届いたリクエストのバージョンを記録する"""
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, client_id, channel, version):
+        """
+        リクエストのトークンを返す（クライアントIDかバージョンがなければ None）
+        記録済みより古いバージョンのリクエストは SupersededError を送出する
+        """
+        if client_id is None or version is None:
+            return None
+
+        key = (client_id, channel)
+        with self._lock:
+            latest = self._latest.get(key)
+            if latest is not None and version < latest:
+                raise SupersededError(f"{channel} のバージョン {version} は古くなりました")
+            self._latest[key] = version
+            self._latest.move_to_end(key)
+            while len(self._latest) > self.max_clients:
+                self._latest.popitem(last=False)
+        return RequestToken(self, key, version)
+
+    def latest(self, key):
+        return self._latest.get(key)
+
+
+def promote_queued(pending, token, priority, token_index):
+    """
+    PriorityQueue に積まれた token の処理の優先度を priority まで上げる
+    要素は (優先度, 順番, ...) の組で、token_index 番目がトークン
+    """
+    with pending.mutex:
+        entries = pending.queue
+        changed = False
+        for i, entry in enumerate(entries):
+            if entry[token_index] is token and entry[0] > priority:
+                entries[i] = (priority,) + entry[1:]
+                changed = True
+        if changed:
+            heapq.heapify(entries)
+
+
+def effective_priority(priority, token):
+    """token が優先度を持つ場合（ポップオーバーのリクエストが相乗りした先読み）は、高い方の優先度"""
+    token_priority = getattr(token, "priority", None)
+    return priority if token_priority is None else min(priority, token_priority)
+
+
+class InferenceExecutor:
+    """
+    待機数に上限があり、優先度の順に処理するスレッドプール
+    実行中と待機中の処理の合計が max_workers + max_queue_size を超える場合は
+    キューに積まずに QueueFullError を送出する
+    token が古くなった処理は実行せずに SupersededError で終了する
+    優先度は待機中の処理の順番だけを決め、実行中の処理は中断しない（非プリエンプティブ）
+    そのため優先度の高い処理は最悪で実行中の処理1つ分待たされる。
+    低い優先度で大量の処理を行う場合は、1つの処理が長くならないよう小さく分けて積むこと
+    （例: /bulk-alternatives は BULK_ALTERNATIVES_CHUNK_SPANS 個の範囲ごとに積む）
+    """
+
+    def __init__(self, name, max_workers, max_queue_size):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._queue = queue.PriorityQueue()
+        # 同じ優先度の処理は積まれた順に実行する
+        self._sequence = itertools.count()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+        self._shutdown = False
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_size)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """実行中・待機中の処理の数"""
+        return self._pending
+
+    def submit(self, fn, *args, priority=PRIORITY_INTERACTIVE, token=None, **kwargs):
+        """
+        処理をキューに積み、concurrent.futures.Future を返す
+        token が優先度を持つ場合は、priority と高い方の優先度で積む
+        """
+        if self._shutdown:
+            raise RuntimeError(f"{self.name} のエグゼキュータは停止しています")
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(f"{self.name} の推論キューが満杯です")
+
+        with self._pending_lock:
+            self._pending += 1
+
+        future = Future()
+        future.add_done_callback(lambda _: self._release())
+        self._ensure_started()
+        self._queue.put(
+            (
+                effective_priority(priority, token),
+                next(self._sequence),
+                future,
+                fn,
+                args,
+                kwargs,
+                token,
+            )
+        )
+        return future
+
+    def promote(self, token, priority):
+        """待機中の token の処理の優先度を priority まで上げる"""
+        promote_queued(self._queue, token, priority, 6)
+
+    async def run(self, fn, *args, **kwargs):
+        """処理をワーカースレッドで実行し、イベントループをブロックせずに結果を待つ"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """待機中の処理をキャンセルし、ワーカースレッドを停止する"""
+        self._shutdown = True
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2] is not None:
+                item[2].cancel()
+
+        with self._threads_lock:
+            threads = list(self._threads)
+        for _ in threads:
+            # 停止の合図は全ての処理より後に取り出される
+            self._queue.put((float("inf"), next(self._sequence), None, None, None, None, None))
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _ensure_started(self):
+        if len(self._threads) >= self.max_workers:
+            return
+        with self._threads_lock:
+            while len(self._threads) < self.max_workers:
+                thread = threading.Thread(
+                    target=self._worker,
+                    name=f"{self.name}-inference_{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            _, _, future, fn, args, kwargs, token = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            if token is not None and token.superseded:
+                future.set_exception(
+                    SupersededError(f"{token.key[1]} のバージョン {token.version} は古くなりました")
+                )
+                continue
+
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _release(self):
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
+
+
+# BERTモデルの推論用
+model_executor = InferenceExecutor(
+    "model", INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE
+)
+
+# MeCabによる形態素解析用（モデル推論の待ちに巻き込まれないよう分離する）
+tagger_executor = InferenceExecutor("tagger", TAGGER_WORKERS, TAGGER_QUEUE_SIZE)
+
+# クライアントごとの最新のリクエストのバージョン
+request_versions = VersionRegistry(REQUEST_VERSION_CLIENTS)
@@ -1,10 +1,42 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import os
+import time
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from typing import List, Optional
 from pydantic import BaseModel
+import alternatives_cache
+import batching
+import editing_session
+import inference
+import metrics
 import nlp_utils
+import prefetch
+import profiles
+
+# /bulk-alternatives で一度に受け付ける範囲の数の上限
+BULK_ALTERNATIVES_MAX_SPANS = int(os.environ.get("BULK_ALTERNATIVES_MAX_SPANS", "200"))
+
+# /bulk-alternatives で1回の推論にまとめる範囲の数
+# （推論中の処理は中断できないため、ポップオーバーの代替案を待たせる時間はこのチャンク1つ分になる）
+BULK_ALTERNATIVES_CHUNK_SPANS = int(os.environ.get("BULK_ALTERNATIVES_CHUNK_SPANS", "8"))
+
+# ポップオーバーが /smart-alternatives に送る単語の前後の文字数（src/components/WordPopover.tsx と揃える）
+POPOVER_CONTEXT_CHARS = 250
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONへの変換にかかった時間をメトリクスに記録するレスポンス"""
+
+    def render(self, content):
+        with metrics.stage(metrics.STAGE_SERIALIZATION):
+            return super().render(content)
+
 
 app = FastAPI(
+    default_response_class=TimedJSONResponse,
     title="Fluent Assist API",
     description="吃音支援アプリケーションのバックエンドAPI",
     version="1.0.0",
@@ -20,19 +52,73 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """エンドポイントごとのリクエストの所要時間を記録する"""
+    started = time.perf_counter()
+    response = await call_next(request)
+    # ラベルの種類が増えすぎないよう、パスではなくルートのパターンを使う
+    route = request.scope.get("route")
+    if route is not None:
+        metrics.REQUEST_SECONDS.labels(route.path).observe(time.perf_counter() - started)
+    return response
+
+
 # リクエスト/レスポンスモデル
 class TextAnalysisRequest(BaseModel):
     text: str
     difficulty_threshold: Optional[float] = 0.5
     user_difficult_words: Optional[List[str]] = None
     difficult_sounds: Optional[List[str]] = None
+    # 2モーラ目以降から始まる苦手な音も数える場合の位置ごとの重み（例: [1.0, 0.5]）
+    position_weights: Optional[List[float]] = None
+    profile_id: Optional[str] = None  # POST /profiles で登録したプロファイル（指定時は音の設定より優先）
+    # 先読みする代替案の発音しやすい音（/smart-alternatives に送る設定と揃える）
+    easy_pronunciations: Optional[List[str]] = None
+    # 検出した単語の代替案をこの方法（"mlm", "embeddings", "both"）でバックグラウンドで先読みする
+    prefetch_alternatives: Optional[str] = None
+    # 同じクライアントから新しいバージョンが届いた場合、古いバージョンの処理は打ち切る
+    client_id: Optional[str] = None
+    version: Optional[int] = None
 
 
 class AlternativesRequest(BaseModel):
     text: str
     target_word: str
-    method: Optional[str] = "both"  # "mlm", "embeddings", "both"
+    method: Optional[str] = "both"  # "mlm", "embeddings", "both", "synonyms"（同義語インデックスのみ）
     easy_pronunciations: Optional[List[str]] = None  # ユーザーが発音しやすい音のリスト
+    difficult_sounds: Optional[List[str]] = None  # ユーザーが苦手な音のリスト（候補から除外）
+    max_masks: Optional[int] = 1  # 2以上の場合、複数トークンからなる単語も候補にする
+    profile_id: Optional[str] = None
+    client_id: Optional[str] = None
+    version: Optional[int] = None
+
+
+class Span(BaseModel):
+    start: int
+    end: int
+
+
+class BulkAlternativesRequest(BaseModel):
+    text: str
+    spans: List[Span]  # /analyze-realtime が返す単語の start / end
+    method: Optional[str] = "mlm"  # "mlm", "embeddings", "both"
+    easy_pronunciations: Optional[List[str]] = None
+    difficult_sounds: Optional[List[str]] = None
+    profile_id: Optional[str] = None
+
+
+class ProfileRequest(BaseModel):
+    difficult_sounds: Optional[List[str]] = None
+    easy_pronunciations: Optional[List[str]] = None
+    position_weights: Optional[List[float]] = None
+
+
+class ProfileResponse(BaseModel):
+    profile_id: str
+    difficult_sounds: List[str]
+    easy_pronunciations: List[str]
+    position_weights: Optional[List[float]] = None
 
 
 class Alternative(BaseModel):
@@ -47,39 +133,550 @@ class AlternativesResponse(BaseModel):
     alternatives: List[Alternative]
 
 
+class SpanAlternatives(BaseModel):
+    start: int
+    end: int
+    word: str
+    alternatives: List[Alternative]
+
+
+class BulkAlternativesResponse(BaseModel):
+    results: List[SpanAlternatives]
+
+
+@app.on_event("startup")
+def start_model_loading():
+    """
+    BERTモデルのロードとウォームアップをバックグラウンドで開始する
+    ロードが終わる前でも、MeCabのみを使う /analyze-realtime は応答できる
+    """
+    nlp_utils.start_model_loading()
+
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    """サーバー終了時に推論用エグゼキュータを停止する"""
+    inference.model_executor.shutdown(wait=False)
+    inference.tagger_executor.shutdown(wait=False)
+
+
 @app.get("/")
 async def root():
     return {"message": "Fluent Assist API", "status": "ok"}
 
 
+@app.get("/healthz")
+async def healthz():
+    """プロセスが起動しているかどうか（モデルのロード状態は問わない）"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """BERTモデルのロードとウォームアップが完了し、全てのエンドポイントが使えるかどうか"""
+    body = {
+        "model": nlp_utils.model_state,
+        "mecab": nlp_utils.mecab_tagger is not None,
+    }
+    if nlp_utils.model_state == nlp_utils.MODEL_FAILED:
+        body["error"] = nlp_utils.model_error
+    if not nlp_utils.is_model_ready():
+        return JSONResponse(status_code=503, content={"status": "not_ready", **body})
+    return {"status": "ready", **body}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus形式のメトリクス（処理段階ごとの所要時間・キューの長さ・キャッシュのヒット率など）"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    """代替案キャッシュのヒット数・ミス数"""
+    return {
+        "alternatives": alternatives_cache.alternatives_cache.info(),
+        "prefetch": prefetch.prefetcher.info(),
+    }
+
+
+# 発音プロファイル（苦手な音などを一度登録し、以降はIDで参照する）
+@app.post("/profiles", response_model=ProfileResponse)
+async def create_profile(request: ProfileRequest):
+    """
+    苦手な音・発音しやすい音を登録してプロファイルIDを返す
+    同じ設定であれば同じIDを返す（サーバーが再起動した場合は登録し直す）
+    """
+    profile = await inference.tagger_executor.run(
+        profiles.profile_store.create,
+        request.difficult_sounds,
+        request.easy_pronunciations,
+        request.position_weights,
+    )
+    return profile.to_dict()
+
+
+@app.get("/profiles/{profile_id}", response_model=ProfileResponse)
+async def get_profile(profile_id: str):
+    return (await _get_profile(profile_id)).to_dict()
+
+
+@app.delete("/profiles/{profile_id}")
+async def delete_profile(profile_id: str):
+    """
+    このワーカーのキャッシュからプロファイルを削除する
+    IDは設定から決まるため、削除後も同じIDで参照すれば作り直される（IDは無効にならない）
+    """
+    try:
+        profiles.profile_store.delete(profile_id)
+    except profiles.ProfileNotFoundError:
+        raise _profile_not_found(profile_id)
+    return {"status": "evicted"}
+
+
+def _profile_not_found(profile_id):
+    """プロファイルIDが不正なときに返す404エラー"""
+    return HTTPException(
+        status_code=404, detail=f"プロファイルが見つかりません: {profile_id}"
+    )
+
+
+async def _restore_profile(profile_id):
+    """
+    IDでプロファイルを取得する
+    このワーカーに保持していない場合は、IDから作り直す（語彙のマスクの作成は形態素解析用エグゼキュータ上で行う）
+    """
+    try:
+        return profiles.profile_store.get(profile_id)
+    except profiles.ProfileNotFoundError:
+        return await inference.tagger_executor.run(
+            profiles.profile_store.get_or_restore, profile_id
+        )
+
+
+async def _get_profile(profile_id):
+    try:
+        return await _restore_profile(profile_id)
+    except profiles.ProfileNotFoundError:
+        raise _profile_not_found(profile_id)
+    except inference.QueueFullError:
+        raise _service_unavailable()
+
+
+async def _apply_profile(request):
+    """
+    リクエストにプロファイルIDがあれば、その音の設定をリクエストに反映してプロファイルを返す
+    プロファイルIDがなければ None を返す
+    """
+    if not request.profile_id:
+        return None
+    profile = await _get_profile(request.profile_id)
+    request.difficult_sounds = profile.difficult_sounds
+    if hasattr(request, "easy_pronunciations"):
+        request.easy_pronunciations = profile.easy_pronunciations
+    if hasattr(request, "position_weights"):
+        request.position_weights = profile.position_weights
+    return profile
+
+
+def _service_unavailable(detail="サーバーが混雑しています。しばらくしてから再試行してください"):
+    """推論キューが満杯のとき・モデルのロード中に返す503エラー"""
+    return HTTPException(
+        status_code=503,
+        detail=detail,
+        headers={"Retry-After": str(inference.RETRY_AFTER_SECONDS)},
+    )
+
+
+def _superseded():
+    """同じクライアントから新しいバージョンのリクエストが届いていたときに返す409エラー"""
+    return HTTPException(
+        status_code=409, detail="新しいリクエストが届いたため、処理を打ち切りました"
+    )
+
+
+def _issue_token(request, channel):
+    """リクエストのバージョンを記録してトークンを返す（古いバージョンの場合は409エラー）"""
+    try:
+        return inference.request_versions.issue(request.client_id, channel, request.version)
+    except inference.SupersededError:
+        raise _superseded()
+
+
+def _require_model():
+    """BERTモデルが使えない場合は503エラーを送出する"""
+    if not nlp_utils.is_model_ready():
+        raise _service_unavailable("BERTモデルを準備中です。しばらくしてから再試行してください")
+
+
+async def _generate_smart_alternatives(
+    request: AlternativesRequest, priority=inference.PRIORITY_INTERACTIVE, token=None
+):
+    """
+    代替案生成の本体（推論はバッチスケジューラとエグゼキュータ上で実行する）
+    token が古くなった場合は、待機中の処理を実行せずに打ち切る
+    同義語インデックスに十分な候補があれば、語彙全体のTop-kの代わりにマスク位置のロジットで候補を並べ替える
+    """
+    # 同義語インデックスの候補（BERTの推論なしで引ける）
+    synonyms = nlp_utils.synonym_candidates(request.target_word, request.difficult_sounds)
+    if request.method == "synonyms":
+        return {
+            "word": request.target_word,
+            "alternatives": _synonym_alternatives(request, synonyms),
+        }
+    if _has_enough_synonyms(synonyms):
+        # マスクした1行だけを推論し、候補のロジットだけを取り出す
+        ranked = await inference.model_executor.run(
+            nlp_utils.rank_candidates_with_mlm,
+            request.text,
+            request.target_word,
+            [word for word, _ in synonyms],
+            priority=priority,
+            token=token,
+        )
+        if ranked:
+            return {
+                "word": request.target_word,
+                "alternatives": _synonym_alternatives(request, synonyms, ranked),
+            }
+
+    # MLMによる代替案生成（同時に届いた他のリクエストとまとめて推論する）
+    # 埋め込みによる方法もMLMの候補を対象に類似度を計算する
+    if request.max_masks and request.max_masks > 1:
+        # 複数マスクのビームサーチ（1リクエストで複数回の推論を行う）
+        alternatives = await inference.model_executor.run(
+            nlp_utils.generate_alternatives_with_mlm_multi,
+            request.text,
+            request.target_word,
+            top_k=30,
+            max_masks=min(request.max_masks, nlp_utils.MLM_MAX_MASKS),
+            difficult_sounds=request.difficult_sounds,
+            priority=priority,
+            token=token,
+        )
+    else:
+        alternatives = await asyncio.wrap_future(
+            batching.mlm_batcher.submit(
+                request.text,
+                request.target_word,
+                top_k=30,
+                difficult_sounds=request.difficult_sounds,
+                priority=priority,
+                token=token,
+            )
+        )
+
+    # 埋め込みの類似度による順位付け（候補をまとめて一度の推論で処理する）
+    if alternatives and request.method in ["embeddings", "both"]:
+        embedding_alternatives = await inference.model_executor.run(
+            nlp_utils.generate_alternatives_with_similar_embeddings,
+            request.text,
+            request.target_word,
+            [alt["word"] for alt in alternatives],
+            top_k=len(alternatives),
+            priority=priority,
+            token=token,
+        )
+        alternatives = nlp_utils.combine_alternatives(
+            alternatives,
+            embedding_alternatives,
+            probability_weight=0.5 if request.method == "both" else 0.0,
+        )
+
+    # モックデータベースは使用せず、MLMの結果のみを使用
+    # 代替案がない場合は空のリストを返す
+    if not alternatives:
+        return {"word": request.target_word, "alternatives": []}
+
+    # 発音のしやすさでフィルタリング（ユーザーの発音しやすい音を考慮）
+    filtered_alternatives = await inference.tagger_executor.run(
+        nlp_utils.filter_by_pronunciation_ease,
+        alternatives,
+        easy_pronunciations=request.easy_pronunciations,
+        priority=priority,
+        token=token,
+    )
+
+    return {"word": request.target_word, "alternatives": filtered_alternatives}
+
+
+def _has_enough_synonyms(synonyms):
+    return len(synonyms) >= max(nlp_utils.SYNONYM_MIN_CANDIDATES, 1)
+
+
+def _synonym_alternatives(request: AlternativesRequest, synonyms, ranked=None):
+    """
+    同義語インデックスの候補を代替案の形式で返す（読みはインデックスに含まれるため形態素解析しない）
+    ranked（MLMの確率）がなければ辞書に現れた順に並べる
+    """
+    readings = dict(synonyms)
+    if ranked is None:
+        alternatives = [{"word": word, "reading": reading} for word, reading in synonyms]
+    else:
+        alternatives = [dict(alt, reading=readings[alt["word"]]) for alt in ranked]
+    return nlp_utils.filter_by_pronunciation_ease(
+        alternatives, easy_pronunciations=request.easy_pronunciations
+    )
+
+
+def _generate_chunk_alternatives(request: BulkAlternativesRequest, spans):
+    """
+    一部の範囲のMLMと埋め込みの類似度による順位付けを行う（モデル推論用エグゼキュータ上で実行する）
+    MLMは範囲をまとめて一度の推論で、埋め込みも範囲の全ての候補をまとめて一度の推論で処理する
+    """
+    results = nlp_utils.generate_alternatives_with_mlm_spans(
+        [(request.text, span.start, span.end, 30, request.difficult_sounds) for span in spans]
+    )
+    if request.method not in ["embeddings", "both"]:
+        return results
+
+    embedding_results = nlp_utils.generate_alternatives_with_similar_embeddings_spans(
+        [
+            (request.text, span.start, span.end, [alt["word"] for alt in alternatives])
+            for span, alternatives in zip(spans, results)
+        ]
+    )
+    return [
+        nlp_utils.combine_alternatives(
+            alternatives,
+            embedding_alternatives,
+            probability_weight=0.5 if request.method == "both" else 0.0,
+        )
+        if alternatives
+        else alternatives
+        for alternatives, embedding_alternatives in zip(results, embedding_results)
+    ]
+
+
+def _filter_spans(request: BulkAlternativesRequest, results):
+    """各範囲の候補を発音のしやすさでフィルタリングする（形態素解析用エグゼキュータ上で実行する）"""
+    return [
+        nlp_utils.filter_by_pronunciation_ease(
+            alternatives, easy_pronunciations=request.easy_pronunciations
+        )
+        if alternatives
+        else []
+        for alternatives in results
+    ]
+
+
+async def _generate_bulk_alternatives(request: BulkAlternativesRequest):
+    """
+    範囲を BULK_ALTERNATIVES_CHUNK_SPANS 個ずつに分け、チャンクごとに推論して範囲ごとの代替案を返す
+    エグゼキュータは実行中の処理を中断しないため、チャンクを1つずつ積み、
+    チャンクの間にポップオーバーの代替案や編集中のテキストの解析が割り込めるようにする
+    """
+    chunk_size = max(BULK_ALTERNATIVES_CHUNK_SPANS, 1)
+    results = []
+    for offset in range(0, len(request.spans), chunk_size):
+        results.extend(
+            await inference.model_executor.run(
+                _generate_chunk_alternatives,
+                request,
+                request.spans[offset : offset + chunk_size],
+                priority=inference.PRIORITY_BULK,
+            )
+        )
+
+    results = await inference.tagger_executor.run(
+        _filter_spans, request, results, priority=inference.PRIORITY_BULK
+    )
+
+    return {
+        "results": [
+            {
+                "start": span.start,
+                "end": span.end,
+                "word": request.text[span.start : span.end],
+                "alternatives": alternatives,
+            }
+            for span, alternatives in zip(request.spans, results)
+        ]
+    }
+
+
+def _analyze_realtime(request: TextAnalysisRequest, profile=None):
+    """リアルタイム分析の同期処理（形態素解析用エグゼキュータ上で実行する）"""
+    # 形態素解析は一度だけ行い、難しい単語の検出と読みの取得で共有する
+    table = nlp_utils.analyze_text(request.text)
+
+    # 難しい単語を検出（苦手な音を含む）
+    difficult_words = nlp_utils.get_difficult_words(
+        request.text,
+        request.difficulty_threshold,
+        request.difficult_sounds,
+        table=table,
+        position_weights=request.position_weights,
+        matcher=profile.matcher if profile is not None else None,
+    )
+
+    # 各難しい単語に対して代替案を生成
+    words = []
+
+    for word_info in difficult_words:
+        word = word_info["word"]
+
+        # 結果を追加（文字位置情報を含む）
+        words.append(
+            {
+                "word": word,
+                "position": word_info["position"],
+                "difficulty": word_info["difficulty"],
+                "reason": word_info.get("reason", ""),
+                "start": word_info.get("start", 0),
+                "end": word_info.get("end", 0),
+                "reading": word_info.get("reading", ""),  # 読み情報も追加
+            }
+        )
+
+    # テキスト全体の読みを取得（2つのバージョンを返す）
+    text_pronunciation = nlp_utils.get_pronunciation(request.text, table=table)
+
+    return {
+        "text": request.text,  # 元のテキスト
+        "pronunciation": text_pronunciation,  # 読み
+        "words": words,  # 難しい単語とその代替案のオブ
+    }
+
+
+def _synonym_index_fingerprint():
+    index = nlp_utils.get_synonym_index()
+    return index.fingerprint if index is not None else None
+
+
+def _alternatives_cache_key(request: AlternativesRequest):
+    """対象単語の位置とBERTに入力する文脈の範囲が同じリクエストは同じキーになる"""
+    start, window = nlp_utils.find_context_window(request.text, request.target_word)
+    return alternatives_cache.make_key(
+        request.text,
+        request.target_word,
+        start=start,
+        window=window,
+        method=request.method,
+        easy_pronunciations=request.easy_pronunciations or [],
+        difficult_sounds=request.difficult_sounds or [],
+        max_masks=request.max_masks,
+        synonyms=_synonym_index_fingerprint(),
+        model=nlp_utils.bert_model_name,
+        backend=nlp_utils.INFERENCE_BACKEND,
+    )
+
+
+def _popover_context(text, start, end):
+    """
+    ポップオーバー（WordPopover の getContextWindow）が /smart-alternatives に送るテキストを作る
+    クリックした単語の前 POPOVER_CONTEXT_CHARS 文字と、単語の開始位置から POPOVER_CONTEXT_CHARS 文字までの後ろの文脈
+    """
+    before = text[max(0, start - POPOVER_CONTEXT_CHARS) : start].strip()
+    after = text[end : min(len(text), start + POPOVER_CONTEXT_CHARS)].strip()
+    return before + text[start:end] + after
+
+
+def _prefetch_alternatives(
+    text, words, method, difficult_sounds=None, easy_pronunciations=None, token=None
+):
+    """
+    検出した単語の /smart-alternatives の結果をバックグラウンドで計算しておく
+    ポップオーバーが送るのと同じ単語の周辺のテキストで計算し、キーも /smart-alternatives と同じ方法で作るため、
+    前後の文脈が変わっていない単語は再計算しない
+    token（解析したテキストのバージョン）が古くなった場合、未計算の単語は先読みしない
+    """
+    if not method or not words or not nlp_utils.is_model_ready():
+        return
+
+    items = {}
+    for word in words[: prefetch.PREFETCH_MAX_WORDS]:
+        request = AlternativesRequest(
+            text=_popover_context(text, word["start"], word["end"]),
+            target_word=word["word"],
+            method=method,
+            easy_pronunciations=easy_pronunciations,
+            difficult_sounds=difficult_sounds,
+        )
+        items.setdefault(
+            _alternatives_cache_key(request),
+            lambda item_token, request=request: _generate_smart_alternatives(
+                request, inference.PRIORITY_PREFETCH, item_token
+            ),
+        )
+    prefetch.prefetcher.schedule(list(items.items()), token)
+
+
+def _prefetch_session_alternatives(session, words, method):
+    """編集セッションで新たに追加されたハイライトの代替案を先読みする"""
+    _prefetch_alternatives(
+        session.text, words, method, session.difficult_sounds, session.easy_pronunciations
+    )
+
 
 # ポップオーバークリック時の代替案生成
 @app.post("/smart-alternatives", response_model=AlternativesResponse)
 async def get_smart_alternatives(request: AlternativesRequest):
     """
     BERTモデルを使用して文脈に基づいた代替案を生成
+    推論はイベントループを塞がないよう専用のスレッドで実行する
+    先読み済みの単語はキャッシュから、先読み中の単語はその計算結果を待って応答する
     """
+    await _apply_profile(request)
+    if request.method != "synonyms" and not nlp_utils.is_model_ready():
+        # モデルのロード中は、同義語インデックスの候補があれば辞書の順で返す（キャッシュには入れない）
+        synonyms = nlp_utils.synonym_candidates(request.target_word, request.difficult_sounds)
+        if not _has_enough_synonyms(synonyms):
+            _require_model()
+        return {
+            "word": request.target_word,
+            "alternatives": _synonym_alternatives(request, synonyms),
+        }
+    token = _issue_token(request, "alternatives")
+    key = _alternatives_cache_key(request)
     try:
-        alternatives = []
-
-        # MLMによる代替案生成
-        if request.method in ["mlm", "both"]:
-            mlm_alternatives = nlp_utils.generate_alternatives_with_mlm(
-                request.text, request.target_word, top_k=30
+        # 同じ文脈・設定の結果は再利用し、同時に届いた同じリクエストは一度だけ計算する
+        try:
+            return await alternatives_cache.alternatives_cache.get_or_compute(
+                key, lambda: _generate_smart_alternatives(request, token=token)
             )
-            alternatives.extend(mlm_alternatives)
-
-        # モックデータベースは使用せず、MLMの結果のみを使用
-        # 代替案がない場合は空のリストを返す
-        if not alternatives:
-            return {"word": request.target_word, "alternatives": []}
+        except inference.SupersededError:
+            if token is not None and token.superseded:
+                raise
+            # 相乗りした他のクライアントの計算が打ち切られた場合は計算し直す
+            return await alternatives_cache.alternatives_cache.get_or_compute(
+                key, lambda: _generate_smart_alternatives(request, token=token)
+            )
+    except inference.SupersededError:
+        raise _superseded()
+    except inference.QueueFullError:
+        raise _service_unavailable()
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"代替案生成中にエラーが発生しました: {str(e)}"
+        )
 
-        # 発音のしやすさでフィルタリング（ユーザーの発音しやすい音を考慮）
-        filtered_alternatives = nlp_utils.filter_by_pronunciation_ease(
-            alternatives, easy_pronunciations=request.easy_pronunciations
+# 文書内の全ての難しい単語の代替案を一度に生成する
+@app.post("/bulk-alternatives", response_model=BulkAlternativesResponse)
+async def get_bulk_alternatives(request: BulkAlternativesRequest):
+    """
+    テキストと単語の範囲（start / end）のリストを受け取り、範囲ごとの代替案を返す
+    各範囲を正確にマスクし、BULK_ALTERNATIVES_CHUNK_SPANS 個ずつまとめて推論する
+    """
+    if len(request.spans) > BULK_ALTERNATIVES_MAX_SPANS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度に指定できる範囲は{BULK_ALTERNATIVES_MAX_SPANS}個までです",
         )
+    for span in request.spans:
+        if not 0 <= span.start < span.end <= len(request.text):
+            raise HTTPException(
+                status_code=400,
+                detail=f"範囲がテキストの範囲外です: {span.start}-{span.end}",
+            )
 
-        return {"word": request.target_word, "alternatives": filtered_alternatives}
+    await _apply_profile(request)
+    _require_model()
+    try:
+        return await _generate_bulk_alternatives(request)
+    except inference.QueueFullError:
+        raise _service_unavailable()
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"代替案生成中にエラーが発生しました: {str(e)}"
@@ -92,43 +689,139 @@ async def analyze_realtime(request: TextAnalysisRequest):
     リアルタイムにテキストを分析して難しい単語と代替案を一度に返す
     形態素解析の結果を利用して正確な単語の位置情報を返す
     """
+    profile = await _apply_profile(request)
+    token = _issue_token(request, "analyze")
     try:
-        # 形態素解析と難しい単語を検出（苦手な音を含む）
-        difficult_words = nlp_utils.get_difficult_words(
-            request.text,
-            request.difficulty_threshold,
-            request.difficult_sounds,
-        )
-
-        # 各難しい単語に対して代替案を生成
-        words = []
-
-        for word_info in difficult_words:
-            word = word_info["word"]
-
-            # 結果を追加（文字位置情報を含む）
-            words.append(
-                {
-                    "word": word,
-                    "position": word_info["position"],
-                    "difficulty": word_info["difficulty"],
-                    "reason": word_info.get("reason", ""),
-                    "start": word_info.get("start", 0),
-                    "end": word_info.get("end", 0),
-                    "reading": word_info.get("reading", ""),  # 読み情報も追加
-                }
-            )
-
-        # テキスト全体の読みを取得（2つのバージョンを返す）
-        text_pronunciation = nlp_utils.get_pronunciation(request.text)
-
-        return {
-            "text": request.text,  # 元のテキスト
-            "pronunciation": text_pronunciation,  # 読み
-            "words": words,  # 難しい単語とその代替案のオブ
-        }
+        result = await inference.tagger_executor.run(
+            _analyze_realtime,
+            request,
+            profile,
+            priority=inference.PRIORITY_ANALYSIS,
+            token=token,
+        )
+    except inference.SupersededError:
+        raise _superseded()
+    except inference.QueueFullError:
+        raise _service_unavailable()
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"リアルタイム分析中にエラーが発生しました: {str(e)}",
         )
+
+    _prefetch_alternatives(
+        request.text,
+        result["words"],
+        request.prefetch_alternatives,
+        request.difficult_sounds,
+        request.easy_pronunciations,
+        token,
+    )
+    return result
+
+
+# 編集セッション（編集操作を受け取り、ハイライトの差分だけを返す）
+@app.websocket("/ws/edit-session")
+async def edit_session(websocket: WebSocket):
+    """
+    文書の状態をサーバー側で保持する編集セッション
+    クライアントは最初に init で文書全体を送り、以降は edit で編集操作だけを送る
+    サーバーは追加・削除されたハイライトと位置のずれだけを返す
+    """
+    await websocket.accept()
+    session = editing_session.EditingSession()
+    prefetch_method = None
+
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                message = None
+            if not isinstance(message, dict):
+                await websocket.send_json(
+                    {
+                        "type": "error",
+                        "version": None,
+                        "detail": "JSONオブジェクトではないメッセージです",
+                    }
+                )
+                continue
+            message_type = message.get("type")
+            version = message.get("version")
+
+            try:
+                try:
+                    editing_session.check_message(message)
+                except editing_session.EditError:
+                    version = None
+                    raise
+                profile = None
+                if message.get("profile_id"):
+                    try:
+                        profile = await _restore_profile(message["profile_id"])
+                    except profiles.ProfileNotFoundError:
+                        raise editing_session.EditError(
+                            f"プロファイルが見つかりません: {message['profile_id']}"
+                        )
+
+                if message_type == "init":
+                    prefetch_method = message.get("prefetch_alternatives")
+                    words = await inference.tagger_executor.run(
+                        session.reset,
+                        message.get("text", ""),
+                        message.get("difficult_sounds"),
+                        message.get("difficulty_threshold", 0.5),
+                        profile,
+                        message.get("easy_pronunciations"),
+                        priority=inference.PRIORITY_ANALYSIS,
+                    )
+                    await websocket.send_json(
+                        {"type": "snapshot", "version": version, "words": words}
+                    )
+                    _prefetch_session_alternatives(session, words, prefetch_method)
+                    continue
+
+                if message_type == "edit":
+                    session.apply_edits(message.get("edits", []))
+                elif message_type == "options":
+                    session.set_options(
+                        message.get("difficult_sounds"),
+                        message.get("difficulty_threshold", 0.5),
+                        profile,
+                        message.get("easy_pronunciations"),
+                    )
+                else:
+                    raise editing_session.EditError(f"不明なメッセージです: {message_type}")
+
+                try:
+                    delta = await inference.tagger_executor.run(
+                        session.refresh, priority=inference.PRIORITY_ANALYSIS
+                    )
+                    pending = False
+                except inference.QueueFullError:
+                    # 位置のずれだけを返し、ハイライトは次の編集で更新する
+                    delta = session.flush_shifts()
+                    pending = True
+                await websocket.send_json(
+                    {"type": "delta", "version": version, "pending": pending, **delta}
+                )
+                _prefetch_session_alternatives(session, delta["added"], prefetch_method)
+            except editing_session.EditError as e:
+                # クライアントは init で文書全体を送り直して同期する
+                await websocket.send_json(
+                    {"type": "error", "version": version, "detail": str(e)}
+                )
+            except inference.QueueFullError:
+                # クライアントは retry_after 秒待ってから init を送り直す
+                await websocket.send_json(
+                    {
+                        "type": "busy",
+                        "version": version,
+                        "retry_after": inference.RETRY_AFTER_SECONDS,
+                        "detail": "サーバーが混雑しています。しばらくしてから再試行してください",
+                    }
+                )
+    except WebSocketDisconnect:
+        pass
+
@@ -0,0 +1,180 @@
+"""
+Prometheus形式のメトリクス
+処理段階ごとの所要時間のヒストグラムと、キューの長さ・バッチサイズ・キャッシュのヒット率・
+モデルのメモリ使用量を /metrics で公開する
+
+pre-fork型サーバー（serve.py）では PROMETHEUS_MULTIPROC_DIR を設定し、
+ヒストグラムとカウンターを全ワーカーで集計する（キューの長さなどは応答したワーカーの値）
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# 処理段階（ラベル値）
+STAGE_MECAB_PARSE = "mecab_parse"
+STAGE_TOKENIZATION = "tokenization"
+STAGE_MODEL_FORWARD = "model_forward"
+STAGE_TOPK = "topk"
+STAGE_READING_LOOKUP = "reading_lookup"
+STAGE_SERIALIZATION = "serialization"
+
+STAGES = [
+    STAGE_MECAB_PARSE,
+    STAGE_TOKENIZATION,
+    STAGE_MODEL_FORWARD,
+    STAGE_TOPK,
+    STAGE_READING_LOOKUP,
+    STAGE_SERIALIZATION,
+]
+
+# 0.1ミリ秒〜5秒
+_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "fluent_assist_stage_seconds",
+    "処理段階ごとの所要時間（秒）",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+
+REQUEST_SECONDS = Histogram(
+    "fluent_assist_request_seconds",
+    "エンドポイントごとのリクエストの所要時間（秒）",
+    ["endpoint"],
+    buckets=_LATENCY_BUCKETS,
+)
+
+BATCH_SIZE = Histogram(
+    "fluent_assist_batch_size",
+    "1回のモデル推論にまとめた入力の数",
+    ["kind"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+CACHE_LOOKUPS = Counter(
+    "fluent_assist_cache_lookups_total",
+    "キャッシュの参照回数",
+    ["cache", "result"],
+)
+
+# ラベル付きの子メトリクスは毎回探さずに済むよう先に作っておく
+_stage_histograms = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+
+
+@contextmanager
+def stage(name):
+    """with ブロックの所要時間を処理段階 name のヒストグラムに記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_histograms[name].observe(time.perf_counter() - started)
+
+
+def observe_stage(name, seconds):
+    """計測済みの所要時間を記録する"""
+    _stage_histograms[name].observe(seconds)
+
+
+def observe_batch_size(kind, size):
+    """1回の推論にまとめた入力の数を記録する"""
+    BATCH_SIZE.labels(kind).observe(size)
+
+
+def count_cache_lookups(cache, hits, misses):
+    """キャッシュの参照結果（ヒット数・ミス数）を記録する"""
+    if hits:
+        CACHE_LOOKUPS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, "miss").inc(misses)
+
+
+class _RuntimeCollector:
+    """スクレイプ時点のキューの長さ・キャッシュの状態・モデルのメモリ使用量を返す"""
+
+    def describe(self):
+        # 登録時に collect() が呼ばれないようにする（各モジュールの読み込み前に登録するため）
+        return []
+
+    def collect(self):
+        import alternatives_cache
+        import batching
+        import inference
+        import nlp_utils
+        import prefetch
+
+        queue_depth = GaugeMetricFamily(
+            "fluent_assist_queue_depth",
+            "実行中・待機中の処理の数",
+            labels=["queue"],
+        )
+        queue_depth.add_metric(["model_executor"], inference.model_executor.pending)
+        queue_depth.add_metric(["tagger_executor"], inference.tagger_executor.pending)
+        queue_depth.add_metric(["mlm_batcher"], batching.mlm_batcher.pending)
+        queue_depth.add_metric(["prefetch"], prefetch.prefetcher.pending)
+        yield queue_depth
+
+        cache_info = alternatives_cache.alternatives_cache.info()
+        lookups = cache_info["hits"] + cache_info["db_hits"] + cache_info["misses"]
+        hit_ratio = GaugeMetricFamily(
+            "fluent_assist_alternatives_cache_hit_ratio",
+            "代替案キャッシュのヒット率（メモリとSQLiteの合計）",
+        )
+        hit_ratio.add_metric(
+            [], (cache_info["hits"] + cache_info["db_hits"]) / lookups if lookups else 0.0
+        )
+        yield hit_ratio
+
+        cache_entries = GaugeMetricFamily(
+            "fluent_assist_cache_entries",
+            "キャッシュに保持している件数",
+            labels=["cache"],
+        )
+        cache_entries.add_metric(["alternatives"], cache_info["size"])
+        cache_entries.add_metric(["segment"], len(nlp_utils._segment_cache))
+        cache_entries.add_metric(["reading"], len(nlp_utils._reading_cache))
+        yield cache_entries
+
+        model_bytes = GaugeMetricFamily(
+            "fluent_assist_model_parameter_bytes",
+            "ロード済みのBERTモデルのパラメータとバッファのバイト数",
+        )
+        model_bytes.add_metric([], _model_memory_bytes(nlp_utils.bert_model))
+        yield model_bytes
+
+
+def _model_memory_bytes(model):
+    """モデルのパラメータとバッファの合計バイト数（ONNX Runtimeの場合は0）"""
+    if model is None or not hasattr(model, "parameters"):
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+REGISTRY.register(_RuntimeCollector())
+
+
+def render():
+    """/metrics の応答本文と Content-Type を返す"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_RuntimeCollector())
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
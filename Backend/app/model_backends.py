@@ -0,0 +1,249 @@
+"""
+BERTの推論バックエンド
+環境変数 INFERENCE_BACKEND で以下のいずれかを選択する
+- torch: PyTorch（fp32）
+- torch-int8: PyTorchの動的int8量子化
+- onnx: ONNX Runtime（fp32）
+- onnx-int8: ONNX Runtimeの動的int8量子化
+量子化やエクスポートの結果はキャッシュディレクトリに保存し、次回の起動時に再利用する
+
+どのバックエンドも encode（エンコーダーの最終隠れ層を返す）と predict（MLMヘッド）を持つ
+代替案の生成ではマスク位置の隠れ層だけにMLMヘッドを適用する（masked_logits）
+"""
+
+import copy
+import logging
+import os
+import re
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+BACKEND_TORCH = "torch"
+BACKEND_TORCH_INT8 = "torch-int8"
+BACKEND_ONNX = "onnx"
+BACKEND_ONNX_INT8 = "onnx-int8"
+
+BACKENDS = (BACKEND_TORCH, BACKEND_TORCH_INT8, BACKEND_ONNX, BACKEND_ONNX_INT8)
+
+# ONNXへのエクスポートに使うopsetのバージョン
+ONNX_OPSET_VERSION = 14
+
+
+def _artifact_path(cache_dir, model_name, suffix):
+    """モデル名からキャッシュファイルのパスを作る"""
+    safe_name = re.sub(r"[^0-9A-Za-z_.-]+", "_", model_name)
+    return os.path.join(cache_dir, f"{safe_name}-{suffix}")
+
+
+class TorchBackend:
+    """PyTorchのモデルをそのまま使うバックエンド"""
+
+    def __init__(self, model, name=BACKEND_TORCH):
+        self.name = name
+        self.model = model.eval()
+        self.head = model.cls
+
+    def encode(self, input_ids, attention_mask, token_type_ids):
+        """エンコーダーを実行し、最終隠れ層を返す"""
+        with torch.no_grad():
+            return self.model.base_model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+            ).last_hidden_state
+
+    def predict(self, hidden_states):
+        """隠れ層にMLMヘッドを適用し、語彙全体に対するロジットを返す"""
+        with torch.no_grad():
+            return self.head(hidden_states)
+
+    def logits(self, input_ids, attention_mask, token_type_ids):
+        """全位置のロジットを返す"""
+        return self.predict(self.encode(input_ids, attention_mask, token_type_ids))
+
+    def masked_logits(self, input_ids, attention_mask, token_type_ids, rows, cols):
+        """
+        (rows[i], cols[i]) の位置のロジットだけを返す（形状は [len(rows), 語彙数]）
+        MLMヘッド（語彙全体への射影）は指定された位置の隠れ層にのみ適用する
+        """
+        hidden_states = self.encode(input_ids, attention_mask, token_type_ids)
+        return self.predict(hidden_states[rows, cols])
+
+
+class OnnxBackend(TorchBackend):
+    """
+    エンコーダーをONNX Runtimeで実行するバックエンド
+    MLMヘッドは小さいためPyTorchで実行する
+    """
+
+    def __init__(self, session, head, name=BACKEND_ONNX):
+        self.name = name
+        self.model = None
+        self.session = session
+        self.head = head.eval()
+
+    def encode(self, input_ids, attention_mask, token_type_ids):
+        (hidden_states,) = self.session.run(
+            None,
+            {
+                "input_ids": input_ids.numpy(),
+                "attention_mask": attention_mask.numpy(),
+                "token_type_ids": token_type_ids.numpy(),
+            },
+        )
+        return torch.from_numpy(hidden_states)
+
+
+class _EncoderForExport(torch.nn.Module):
+    """ONNXへのエクスポート用に、エンコーダーの最終隠れ層だけを返すラッパー"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.base_model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.encoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        ).last_hidden_state
+
+
+def _quantized_skeleton(model):
+    """
+    全結合層を、重みが未設定の動的int8量子化層に置き換えたモデルを返す
+    （量子化の計算をせずに、キャッシュした重みを読み込むための入れ物）
+    """
+    skeleton = copy.deepcopy(model).eval()
+    for name, module in list(skeleton.named_modules()):
+        if not isinstance(module, torch.nn.Linear):
+            continue
+        parent_name, _, child_name = name.rpartition(".")
+        parent = skeleton.get_submodule(parent_name) if parent_name else skeleton
+        setattr(
+            parent,
+            child_name,
+            torch.ao.nn.quantized.dynamic.Linear(
+                module.in_features,
+                module.out_features,
+                bias_=module.bias is not None,
+                dtype=torch.qint8,
+            ),
+        )
+    return skeleton
+
+
+def quantize_torch_model(model, model_name, cache_dir):
+    """
+    全結合層を動的int8量子化したモデルを返す
+    量子化済みの重みはキャッシュし、次回は量子化せずに読み込む
+    """
+    path = _artifact_path(cache_dir, model_name, "int8.pt")
+    if os.path.exists(path):
+        try:
+            quantized = _quantized_skeleton(model)
+            quantized.load_state_dict(torch.load(path))
+            logger.info(f"量子化済みの重みを読み込みました: {path}")
+            return quantized
+        except Exception as e:
+            logger.warning(f"量子化済みの重みを読み込めませんでした: {e}")
+
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model.eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(quantized.state_dict(), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"量子化済みの重みを保存できませんでした: {e}")
+
+    return quantized
+
+
+def export_onnx_encoder(model, model_name, cache_dir, quantize=False):
+    """
+    エンコーダーをONNX形式にエクスポートし、そのパスを返す（キャッシュ済みなら再利用する）
+    quantize=True の場合は動的int8量子化したグラフのパスを返す
+    """
+    path = _artifact_path(cache_dir, model_name, "encoder.onnx")
+    if not os.path.exists(path):
+        logger.info(f"エンコーダーをONNX形式にエクスポート中: {path}")
+        os.makedirs(cache_dir, exist_ok=True)
+        dummy = torch.ones((1, 8), dtype=torch.long)
+        torch.onnx.export(
+            _EncoderForExport(model.eval()),
+            (dummy, dummy, torch.zeros_like(dummy)),
+            f"{path}.tmp",
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_type_ids": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=ONNX_OPSET_VERSION,
+        )
+        os.replace(f"{path}.tmp", path)
+
+    if not quantize:
+        return path
+
+    quantized_path = _artifact_path(cache_dir, model_name, "encoder-int8.onnx")
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logger.info(f"ONNXグラフを量子化中: {quantized_path}")
+        quantize_dynamic(path, f"{quantized_path}.tmp", weight_type=QuantType.QInt8)
+        os.replace(f"{quantized_path}.tmp", quantized_path)
+
+    return quantized_path
+
+
+def create_onnx_session(path):
+    """ONNX Runtimeのセッションを作成する"""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    num_threads = os.environ.get("TORCH_NUM_THREADS")
+    if num_threads:
+        options.intra_op_num_threads = int(num_threads)
+    return onnxruntime.InferenceSession(
+        path, sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+
+def create_backend(name, model, model_name, cache_dir):
+    """
+    指定された種類のバックエンドを作成する
+    作成に失敗した場合はfp32のPyTorchバックエンドにフォールバックする
+    """
+    if name not in BACKENDS:
+        logger.warning(f"不明な推論バックエンド '{name}' のため、'{BACKEND_TORCH}' を使用します")
+        name = BACKEND_TORCH
+
+    try:
+        if name == BACKEND_TORCH_INT8:
+            return TorchBackend(
+                quantize_torch_model(model, model_name, cache_dir), name=name
+            )
+        if name in (BACKEND_ONNX, BACKEND_ONNX_INT8):
+            path = export_onnx_encoder(
+                model, model_name, cache_dir, quantize=name == BACKEND_ONNX_INT8
+            )
+            return OnnxBackend(create_onnx_session(path), model.cls, name=name)
+    except ImportError as e:
+        logger.warning(
+            f"推論バックエンド '{name}' に必要なパッケージがないため、'{BACKEND_TORCH}' を使用します"
+            f"（pip install -r requirements-onnx.txt でインストールできます）: {e}"
+        )
+    except Exception as e:
+        logger.warning(
+            f"推論バックエンド '{name}' の作成に失敗したため、'{BACKEND_TORCH}' を使用します: {e}"
+        )
+
+    return TorchBackend(model)
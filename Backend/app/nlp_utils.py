@@ -1,14 +1,23 @@
-import torch
-from transformers import AutoTokenizer, AutoModelForMaskedLM
+# torch・transformersは読み込みに時間がかかるため、モデルのロード時に遅延インポートする
 import MeCab
-import fugashi
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import os
+import re
+import math
+import time
+import hashlib
+import threading
 import logging
 import unicodedata
 import string
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import jaconv  # jaconvライブラリを使用してひらがな⇔カタカナ変換
+import metrics
+import phonetics
+import synonym_index
+import tagger_pool
+import vocab_index
 
 
 # ロガーのセットアップ
@@ -16,7 +25,27 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # グローバル変数としてモデルとトークナイザ、形態素解析器を初期化
-bert_model_name = "cl-tohoku/bert-base-japanese-v3"
+bert_model_name = os.environ.get("BERT_MODEL_NAME", "cl-tohoku/bert-base-japanese-v3")
+
+# 推論バックエンド（torch / torch-int8 / onnx / onnx-int8）
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+
+# 語彙インデックスなどのキャッシュファイルを置くディレクトリ
+CACHE_DIR = os.environ.get(
+    "FLUENT_ASSIST_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "fluent_assist"),
+)
+VOCAB_INDEX_PATH = os.environ.get(
+    "VOCAB_INDEX_PATH", os.path.join(CACHE_DIR, "vocab_index.npz")
+)
+
+# 同義語インデックス（synonym_index.py で作成する。ファイルがなければ使わない）
+SYNONYM_INDEX_PATH = os.environ.get(
+    "SYNONYM_INDEX_PATH", os.path.join(CACHE_DIR, "synonyms.idx")
+)
+
+# 同義語インデックスの候補がこの数以上あれば、語彙全体のTop-kの代わりにその候補を並べ替えて使う
+SYNONYM_MIN_CANDIDATES = int(os.environ.get("SYNONYM_MIN_CANDIDATES", "3"))
 
 
 # MeCab形態素解析器の初期化
@@ -38,11 +67,9 @@ try:
                 logger.info(f"MeCab設定ファイルを見つけました: {path}")
                 break
 
-    # MeCabの初期化
-    if mecab_rc_path:
-        mecab_tagger = MeCab.Tagger(f"-r {mecab_rc_path}")
-    else:
-        mecab_tagger = MeCab.Tagger()
+    # MeCabの初期化（プールで追加のTaggerを作る際も同じ引数を使う）
+    mecab_args = f"-r {mecab_rc_path}" if mecab_rc_path else None
+    mecab_tagger = MeCab.Tagger(mecab_args) if mecab_args else MeCab.Tagger()
 
     # 初期化テスト
     result = mecab_tagger.parse("テスト")
@@ -51,27 +78,59 @@ except Exception as e:
     logger.error(f"MeCab形態素解析器の初期化中にエラーが発生しました: {e}")
     # フォールバックとして、オプションなしで初期化を試みる
     try:
-        mecab_tagger = MeCab.Tagger("")
+        mecab_args = ""
+        mecab_tagger = MeCab.Tagger(mecab_args)
         logger.warning("オプションなしでMeCab形態素解析器を初期化しました")
     except Exception as e2:
         logger.error(f"MeCabフォールバック初期化も失敗しました: {e2}")
         mecab_tagger = None
         logger.warning("MeCab形態素解析機能は無効になります")
 
-# Fugashi形態素解析器の初期化（BERTトークナイザー用）
-try:
-    # Fugashiの初期化
-    fugashi_tagger = fugashi.Tagger()
-    logger.info("Fugashi形態素解析器の初期化に成功しました")
-except Exception as e:
-    logger.error(f"Fugashi形態素解析器の初期化中にエラーが発生しました: {e}")
-    fugashi_tagger = None
-    logger.warning("Fugashi形態素解析機能は無効になります")
+# MeCabのTaggerはスレッドセーフではないため、スレッドごとにプールから借りて使う
+MECAB_POOL_SIZE = int(os.environ.get("MECAB_POOL_SIZE", str(os.cpu_count() or 1)))
+
+# 未解析の文がこの数以上ある場合は、文を分けて複数のスレッドで解析する
+MECAB_PARALLEL_SEGMENTS = int(os.environ.get("MECAB_PARALLEL_SEGMENTS", "32"))
+
+
+def _create_tagger():
+    """プール用に、初期化に成功したときと同じ引数でTaggerを作成する"""
+    return MeCab.Tagger(mecab_args) if mecab_args is not None else MeCab.Tagger()
+
+
+mecab_pool = (
+    tagger_pool.TaggerPool(_create_tagger, MECAB_POOL_SIZE, initial=[mecab_tagger])
+    if mecab_tagger is not None
+    else None
+)
+
+# 長い文書を分割して解析するスレッド（初回使用時に作成する）
+_morphology_executor = None
+_morphology_executor_lock = threading.Lock()
+
+
+def configure_torch_threads():
+    """環境変数に従ってPyTorchのスレッド数を設定する"""
+    import torch
+
+    num_threads = os.environ.get("TORCH_NUM_THREADS")
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+
+    interop_threads = os.environ.get("TORCH_INTEROP_THREADS")
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(int(interop_threads))
+        except RuntimeError as e:
+            # 並列処理の開始後は変更できない
+            logger.warning(f"PyTorchのinter-opスレッド数を設定できませんでした: {e}")
 
 
 def load_model():
     """BERTモデルとトークナイザをロードする関数"""
     try:
+        from transformers import AutoTokenizer, AutoModelForMaskedLM
+
         logger.info(f"日本語BERTモデル '{bert_model_name}' をロード中...")
         # fugashiが必要なので、明示的に辞書のパスを指定しない
         tokenizer = AutoTokenizer.from_pretrained(bert_model_name)
@@ -83,79 +142,595 @@ def load_model():
         return None, None
 
 
-# モデルとトークナイザをグローバル変数として一度だけロード
-bert_model, bert_tokenizer = load_model()
+def load_backend(model):
+    """ロードしたモデルから環境変数で指定された推論バックエンドを作成する"""
+    if model is None:
+        return None
 
+    import model_backends
 
-def analyze_morphology(text):
+    backend = model_backends.create_backend(
+        INFERENCE_BACKEND, model, bert_model_name, CACHE_DIR
+    )
+    logger.info(f"推論バックエンド '{backend.name}' を使用します")
+    return backend
+
+
+# モデルのロード状態
+MODEL_NOT_LOADED = "not_loaded"
+MODEL_LOADING = "loading"
+MODEL_READY = "ready"
+MODEL_FAILED = "failed"
+
+# モデルとトークナイザはバックグラウンドでロードし、完了後にグローバル変数へ設定する
+bert_model = None
+bert_tokenizer = None
+inference_backend = None
+model_state = MODEL_NOT_LOADED
+# ロードに失敗した場合のエラーの内容（/readyz で返す）
+model_error = None
+_model_ready = threading.Event()
+_model_state_lock = threading.Lock()
+
+# pre-fork型サーバーのマスタープロセスで事前にロードした (モデル, トークナイザ, バックエンド)
+_preloaded = None
+
+
+def preload_model():
     """
-    テキストを形態素解析し、単語と品詞情報、読み情報を返す（MeCabを使用）
+    pre-fork型サーバーのマスタープロセスで、ワーカーをforkする前にモデルをロードする
+    ロードした重みと語彙インデックスはfork後のワーカー間でコピーオンライトにより共有される
+    fork後に問題となるスレッドプールを作らないよう、ロードは単一スレッドで行う
+    """
+    global _preloaded, bert_tokenizer
+
+    import torch
+
+    torch.set_num_threads(1)
+
+    model, tokenizer = load_model()
+    if model is None:
+        return False
+
+    backend = None
+    if INFERENCE_BACKEND.startswith("onnx"):
+        # ONNX Runtimeのセッションはスレッドを持つためfork後に作成し、エクスポートだけ済ませておく
+        import model_backends
+
+        try:
+            model_backends.export_onnx_encoder(
+                model, bert_model_name, CACHE_DIR, quantize=INFERENCE_BACKEND == "onnx-int8"
+            )
+        except Exception as e:
+            logger.error(f"ONNX形式へのエクスポートに失敗しました: {e}")
+    else:
+        backend = load_backend(model)
+
+    _preloaded = (model, tokenizer, backend)
+
+    bert_tokenizer = tokenizer
+    get_vocab_index()
+    get_synonym_index()
+    return True
+
+
+def start_model_loading():
+    """
+    バックグラウンドスレッドでモデルのロードとウォームアップを開始する
+    （ロード中・ロード済みの場合は何もしない）
+    """
+    global model_state
+
+    with _model_state_lock:
+        if model_state != MODEL_NOT_LOADED:
+            return
+        model_state = MODEL_LOADING
+
+    threading.Thread(target=_load_model_in_background, name="model-loader", daemon=True).start()
+
+
+def _load_model_in_background():
+    """モデルをロードし、失敗した場合もエラーを記録して待っている処理を起こす"""
+    global model_state, model_error
+
+    try:
+        _load_model()
+    except Exception as e:
+        logger.exception(f"モデルのロード中にエラーが発生しました: {e}")
+        model_error = f"{type(e).__name__}: {e}"
+        model_state = MODEL_FAILED
+        _model_ready.set()
+
+
+def _load_model():
+    global bert_model, bert_tokenizer, inference_backend, model_state, model_error
+
+    configure_torch_threads()
+
+    if _preloaded is not None:
+        model, tokenizer, backend = _preloaded
+        if backend is None:
+            backend = load_backend(model)
+    else:
+        model, tokenizer = load_model()
+        backend = load_backend(model)
+
+    if backend is None:
+        model_error = "モデルまたは推論バックエンドをロードできませんでした"
+        model_state = MODEL_FAILED
+        _model_ready.set()
+        return
+
+    # ONNX Runtimeのバックエンドではエンコーダーの重みを保持しない
+    bert_tokenizer = tokenizer
+    inference_backend = backend
+    bert_model = backend.model
+
+    # 語彙インデックスの読み込み（初回は作成）・同義語インデックスの読み込みと、初回推論の遅延をなくすためのウォームアップ
+    get_vocab_index()
+    get_synonym_index()
+    try:
+        generate_alternatives_with_mlm("これはウォームアップです。", "ウォームアップ", top_k=1)
+        logger.info("モデルのウォームアップが完了しました")
+    except Exception as e:
+        logger.warning(f"モデルのウォームアップ中にエラーが発生しました: {e}")
+
+    model_state = MODEL_READY
+    _model_ready.set()
+
+
+def wait_for_model(timeout=None):
+    """モデルのロードを開始し、完了するまで待つ（ロードできた場合はTrue）"""
+    start_model_loading()
+    _model_ready.wait(timeout)
+    return model_state == MODEL_READY
+
+
+def is_model_ready():
+    """BERTモデルが推論可能な状態かどうか"""
+    return model_state == MODEL_READY
+
+
+# 複数トークンの代替案生成（ビームサーチ）の設定
+MLM_MAX_MASKS = int(os.environ.get("MLM_MAX_MASKS", "3"))
+MLM_BEAM_SIZE = int(os.environ.get("MLM_BEAM_SIZE", "5"))
+MLM_BEAM_TIME_BUDGET_MS = float(os.environ.get("MLM_BEAM_TIME_BUDGET_MS", "300"))
+
+# モデルに入力する文脈の範囲（対象単語の前後の文数と、特殊トークンを含む最大トークン数）
+MLM_CONTEXT_SENTENCES = int(os.environ.get("MLM_CONTEXT_SENTENCES", "2"))
+MLM_CONTEXT_TOKENS = int(os.environ.get("MLM_CONTEXT_TOKENS", "128"))
+
+# 文脈のトークン数を決めるときに、対象範囲（マスクや候補単語）のために空けておくトークン数
+_SPAN_TOKEN_RESERVE = 16
+
+# 文脈の範囲を探す際に見る文字数（1トークンあたりの文字数の目安）
+_CHARS_PER_TOKEN = 4
+
+# 文の区切り（文末記号と直後の閉じ括弧）
+_sentence_end_pattern = re.compile(r"[。！？!?\n]+[」』）)]*")
+
+# 語彙インデックス（初回使用時に読み込みまたは作成する）
+_vocab_index = None
+_vocab_index_failed = False
+_vocab_index_lock = threading.Lock()
+
+# 同義語インデックス（初回使用時にメモリマップで開く）
+_synonym_index = None
+_synonym_index_loaded = False
+_synonym_index_lock = threading.Lock()
+
+# 文単位の形態素解析キャッシュの設定
+SEGMENT_CACHE_SIZE = int(os.environ.get("SEGMENT_CACHE_SIZE", "4096"))
+
+# 文末記号（直後の閉じ括弧も同じ文に含める）で区切る
+_segment_pattern = re.compile(r"[^。！？!?\n]*(?:[。！？!?\n]+[」』）)]*|$)")
+
+# 文の内容ハッシュ -> 形態素解析結果 のLRUキャッシュ
+_segment_cache = OrderedDict()
+_segment_cache_lock = threading.Lock()
+
+# 単語の表層形 -> 読み のLRUキャッシュ（代替案の候補はリクエスト間で頻繁に重複する）
+READING_CACHE_SIZE = int(os.environ.get("READING_CACHE_SIZE", "65536"))
+_reading_cache = OrderedDict()
+_reading_cache_lock = threading.Lock()
+
+
+# 品詞名 <-> 品詞ID の対応表（トークン表では品詞をIDで保持する）
+_pos_names = []
+_pos_ids = {}
+_pos_lock = threading.Lock()
+
+
+def pos_id(pos):
+    """品詞名に対応する品詞IDを返す（未登録の場合は登録する）"""
+    pid = _pos_ids.get(pos)
+    if pid is None:
+        with _pos_lock:
+            pid = _pos_ids.get(pos)
+            if pid is None:
+                pid = len(_pos_names)
+                _pos_names.append(pos)
+                _pos_ids[pos] = pid
+    return pid
+
+
+def pos_name(pid):
+    """品詞IDに対応する品詞名を返す"""
+    return _pos_names[pid]
+
+
+class TokenTable:
+    """
+    形態素解析結果を列指向で保持するトークン表
+    表層形・品詞ID・読み・開始位置・終了位置を列ごとの配列で持ち、
+    トークン番号（position）は配列のインデックスに対応する
     """
+
+    __slots__ = ("surfaces", "pos_ids", "readings", "starts", "ends")
+
+    def __init__(self):
+        self.surfaces = []
+        self.pos_ids = array("i")
+        self.readings = []
+        self.starts = array("i")
+        self.ends = array("i")
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def append(self, surface, pid, reading, start, end):
+        self.surfaces.append(surface)
+        self.pos_ids.append(pid)
+        self.readings.append(reading)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def extend(self, other, offset=0):
+        """別のトークン表を、文字位置をoffsetだけずらして末尾に追加する"""
+        self.surfaces.extend(other.surfaces)
+        self.pos_ids.extend(other.pos_ids)
+        self.readings.extend(other.readings)
+        if offset:
+            self.starts.extend(start + offset for start in other.starts)
+            self.ends.extend(end + offset for end in other.ends)
+        else:
+            self.starts.extend(other.starts)
+            self.ends.extend(other.ends)
+
+    def to_dicts(self):
+        """従来の形式（単語ごとの辞書のリスト）に変換する"""
+        return [
+            {
+                "surface": self.surfaces[i],
+                "pos": _pos_names[self.pos_ids[i]],
+                "position": i,
+                "start": self.starts[i],
+                "end": self.ends[i],
+                "reading": self.readings[i],
+            }
+            for i in range(len(self.surfaces))
+        ]
+
+
+def build_token_table(text):
+    """
+    テキストを一度だけ形態素解析し、トークン表を作成する（MeCabを使用）
+    接尾辞は直前の単語と結合する
+    """
+    table = TokenTable()
     if mecab_tagger is None:
         logger.warning("MeCab形態素解析器が無効なため、形態素解析をスキップします")
-        return []
+        return table
 
-    raw_mecab_output = mecab_tagger.parse(text)
-    logger.info(f"MeCab生出力: {raw_mecab_output}")
+    suffix_pid = pos_id("接尾辞")
 
-    words = []
-    temp_words = []  # 一時的な形態素情報を保持
-    node = mecab_tagger.parseToNode(text)
-    position = 0
+    with mecab_pool.checkout() as tagger, metrics.stage(metrics.STAGE_MECAB_PARSE):
+        _fill_token_table(table, tagger, text, suffix_pid)
+
+    return table
+
+
+def _fill_token_table(table, tagger, text, suffix_pid):
+    """MeCabのノード列を走査してトークン表を埋める"""
     char_position = 0
+    node = tagger.parseToNode(text)
 
     while node:
-        if node.surface:
-            surface = node.surface
-            feature = node.feature.split(",")
-            pos = feature[0] if len(feature) > 0 else "UNK"
-            option_pos = feature[1] if len(feature) > 1 else ""
-            reading = feature[9] if len(feature) >= 8 else ""
-
-            current_word = {
-                "surface": surface,
-                "pos": pos,
-                "option_pos": option_pos,
-                "position": position,
-                "start": text.find(surface, char_position),
-                "end": text.find(surface, char_position) + len(surface),
-                "reading": reading,
-                "feature": feature,
-            }
-
-            # 接尾辞との結合処理
-            if pos == "接尾辞" and temp_words:
-                # 直前の単語と結合
-                prev_word = temp_words[-1]
-                combined_word = {
-                    "surface": prev_word["surface"] + surface,
-                    "pos": prev_word["pos"],  # 元の品詞を保持
-                    "position": prev_word["position"],
-                    "start": prev_word["start"],
-                    "end": current_word["end"],
-                    "reading": (
-                        (prev_word["reading"] + reading)
-                        if prev_word["reading"] and reading
-                        else ""
-                    ),
-                    "feature": prev_word["feature"],  # 元の品詞情報を保持
-                }
-                temp_words[-1] = combined_word
+        surface = node.surface
+        if surface:
+            # 読みは10番目の素性までしか使わないため、分割は必要な分だけ行う
+            feature = node.feature.split(",", 10)
+            pid = pos_id(feature[0]) if feature[0] else pos_id("UNK")
+            reading = feature[9] if len(feature) > 9 else ""
+
+            # 空白などを読み飛ばした場合のみ検索する
+            if text.startswith(surface, char_position):
+                start = char_position
+            else:
+                start = text.find(surface, char_position)
+                if start < 0:
+                    start = char_position
+            end = start + len(surface)
+
+            # 接尾辞との結合処理（元の品詞を保持）
+            # 改行や空白をまたいで結合しない（analyze_words では改行が単語の区切りになる）
+            if pid == suffix_pid and len(table) and table.ends[-1] == start:
+                prev_reading = table.readings[-1]
+                table.surfaces[-1] += surface
+                table.ends[-1] = end
+                table.readings[-1] = (
+                    (prev_reading + reading) if prev_reading and reading else ""
+                )
             else:
-                temp_words.append(current_word)
-                position += 1
+                table.append(surface, pid, reading, start, end)
 
-            char_position = current_word["end"]
+            char_position = end
 
         node = node.next
 
-    # 結合された形態素情報を最終的なリストに追加
-    words = temp_words
 
-    return words
+def analyze_morphology(text):
+    """
+    テキストを形態素解析し、単語と品詞情報、読み情報を返す（MeCabを使用）
+    """
+    return build_token_table(text).to_dicts()
+
+
+def analyze_words(words):
+    """
+    単語のリストをまとめて形態素解析し、各単語の (読み, 先頭の品詞名) のリストを返す
+    単語を改行区切りで連結し、一度の形態素解析で処理する
+    （改行は形態素の区切りになるため、単語をまたぐ形態素はできない）
+    """
+    table = build_token_table("\n".join(words))
+
+    results = []
+    token_index = 0
+    word_start = 0
+    for word in words:
+        word_end = word_start + len(word)
+        parts = []
+        pos = ""
+        while token_index < len(table) and table.starts[token_index] < word_end:
+            if table.starts[token_index] >= word_start:
+                if not pos:
+                    pos = _pos_names[table.pos_ids[token_index]]
+                if table.readings[token_index]:
+                    parts.append(table.readings[token_index])
+            token_index += 1
+        results.append(("".join(parts), pos))
+        word_start = word_end + 1
+
+    return results
+
+
+def get_readings(words):
+    """
+    複数の単語の読みをまとめて取得し、{単語: 読み} の辞書を返す
+    キャッシュにない単語だけを一度の形態素解析で処理する
+    """
+    readings = {}
+    missing = []
+
+    with _reading_cache_lock:
+        for word in dict.fromkeys(words):
+            reading = _reading_cache.get(word)
+            if reading is None:
+                missing.append(word)
+            else:
+                _reading_cache.move_to_end(word)
+                readings[word] = reading
+
+    metrics.count_cache_lookups("reading", len(readings), len(missing))
+    if not missing:
+        return readings
+
+    try:
+        with metrics.stage(metrics.STAGE_READING_LOOKUP):
+            analyzed = analyze_words(missing)
+    except Exception as e:
+        logger.warning(f"単語の読み取得中にエラー: {e}")
+        analyzed = [("", "")] * len(missing)
+
+    resolved = {word: reading for word, (reading, _) in zip(missing, analyzed)}
+
+    with _reading_cache_lock:
+        for word, reading in resolved.items():
+            _reading_cache[word] = reading
+        while len(_reading_cache) > READING_CACHE_SIZE:
+            _reading_cache.popitem(last=False)
+
+    readings.update(resolved)
+    return readings
+
+
+def get_vocab_index():
+    """
+    BERTの語彙インデックスを返す（作成できない場合はNone）
+    """
+    global _vocab_index, _vocab_index_failed
+
+    if _vocab_index is not None or _vocab_index_failed or bert_tokenizer is None:
+        return _vocab_index
+
+    with _vocab_index_lock:
+        if _vocab_index is None and not _vocab_index_failed:
+            try:
+                _vocab_index = vocab_index.load_or_build_vocab_index(
+                    bert_tokenizer, bert_model_name, VOCAB_INDEX_PATH, analyze_words
+                )
+            except Exception as e:
+                logger.error(f"語彙インデックスの作成中にエラーが発生しました: {e}")
+                _vocab_index_failed = True
+
+    return _vocab_index
+
+
+def get_synonym_index():
+    """
+    同義語インデックスを返す（ファイルがない場合はNone）
+    ファイルはメモリマップで開くため、ページはワーカー間でOSのページキャッシュを共有する
+    """
+    global _synonym_index, _synonym_index_loaded
+
+    if _synonym_index_loaded:
+        return _synonym_index
+
+    with _synonym_index_lock:
+        if not _synonym_index_loaded:
+            _synonym_index = synonym_index.load_synonym_index(SYNONYM_INDEX_PATH)
+            _synonym_index_loaded = True
+
+    return _synonym_index
+
+
+def synonym_candidates(target_word, difficult_sounds=None):
+    """
+    同義語インデックスから対象単語の同義語を (単語, 読み) のリストで返す
+    苦手な音で始まる候補はMLMの候補と同じく除外する
+    """
+    index = get_synonym_index()
+    if index is None:
+        return []
+
+    candidates = [
+        (word, reading) for word, reading in index.synonyms(target_word) if word != target_word
+    ]
+    matcher = phonetics.compile_sound_matcher(difficult_sounds)
+    if matcher and candidates:
+        scores = matcher.scores([reading for _, reading in candidates])
+        candidates = [
+            candidate for candidate, score in zip(candidates, scores) if score <= 0.0
+        ]
+    return candidates
+
+
+def split_segments(text):
+    """
+    テキストを文単位に分割し、(開始位置, 文) のリストを返す
+    """
+    segments = []
+    for match in _segment_pattern.finditer(text):
+        if match.start() != match.end():
+            segments.append((match.start(), match.group()))
+    return segments
+
+
+def _segment_key(segment):
+    return hashlib.blake2b(segment.encode("utf-8"), digest_size=16).digest()
+
+
+def _cache_segment(key, table):
+    with _segment_cache_lock:
+        _segment_cache[key] = table
+        while len(_segment_cache) > SEGMENT_CACHE_SIZE:
+            _segment_cache.popitem(last=False)
 
 
-def get_pronunciation(text, keep_unknown=False):
+def _analyze_segment(segment):
+    """
+    1文分のトークン表をキャッシュから取得する（未キャッシュの場合のみ解析）
+    """
+    key = _segment_key(segment)
+
+    with _segment_cache_lock:
+        cached = _segment_cache.get(key)
+        if cached is not None:
+            _segment_cache.move_to_end(key)
+    metrics.count_cache_lookups("segment", cached is not None, cached is None)
+    if cached is not None:
+        return cached
+
+    table = build_token_table(segment)
+    _cache_segment(key, table)
+    return table
+
+
+def _get_morphology_executor():
+    global _morphology_executor
+    if _morphology_executor is None:
+        with _morphology_executor_lock:
+            if _morphology_executor is None:
+                _morphology_executor = ThreadPoolExecutor(
+                    max_workers=mecab_pool.size, thread_name_prefix="mecab"
+                )
+    return _morphology_executor
+
+
+def _build_token_tables(segments):
+    """複数の文を順に解析し、文ごとのトークン表のリストを返す（1つのスレッドで実行する分）"""
+    return [build_token_table(segment) for segment in segments]
+
+
+def _analyze_segments_parallel(segments):
+    """
+    未キャッシュの文を含む文のリストを、スレッド数に分けて並列に解析する
+    キャッシュ済みの文は解析せず、同じ文は一度だけ解析する
+    """
+    keys = [_segment_key(segment) for segment in segments]
+    tables = {}
+    with _segment_cache_lock:
+        for key in keys:
+            cached = _segment_cache.get(key)
+            if cached is not None:
+                _segment_cache.move_to_end(key)
+                tables[key] = cached
+    missing = {}
+    for key, segment in zip(keys, segments):
+        if key not in tables:
+            missing.setdefault(key, segment)
+    metrics.count_cache_lookups("segment", len(keys) - len(missing), len(missing))
+
+    if len(missing) >= MECAB_PARALLEL_SEGMENTS and mecab_pool.size > 1:
+        # 連続した文をまとめてスレッドごとの分担にする（スレッド間の受け渡しを減らす）
+        missing_keys = list(missing)
+        shard_size = math.ceil(len(missing_keys) / mecab_pool.size)
+        shards = [
+            missing_keys[i : i + shard_size] for i in range(0, len(missing_keys), shard_size)
+        ]
+        results = _get_morphology_executor().map(
+            _build_token_tables, [[missing[key] for key in shard] for shard in shards]
+        )
+        for shard, shard_tables in zip(shards, results):
+            for key, table in zip(shard, shard_tables):
+                tables[key] = table
+                _cache_segment(key, table)
+    else:
+        for key, segment in missing.items():
+            table = build_token_table(segment)
+            tables[key] = table
+            _cache_segment(key, table)
+
+    return [tables[key] for key in keys]
+
+
+def analyze_text(text):
+    """
+    文単位のキャッシュを利用してテキスト全体のトークン表を作成する
+    変更のあった文のみ再解析し、キャッシュ済みの結果は文字位置を補正して結合する
+    未解析の文が多い場合（長い文書の初回など）は文を分けて複数のスレッドで解析する
+    """
+    segments = split_segments(text)
+    table = TokenTable()
+    if mecab_pool is None or len(segments) < MECAB_PARALLEL_SEGMENTS:
+        for segment_start, segment in segments:
+            table.extend(_analyze_segment(segment), offset=segment_start)
+        return table
+
+    segment_tables = _analyze_segments_parallel([segment for _, segment in segments])
+    for (segment_start, _), segment_table in zip(segments, segment_tables):
+        table.extend(segment_table, offset=segment_start)
+    return table
+
+
+def analyze_morphology_incremental(text):
+    """
+    文単位のキャッシュを利用してテキスト全体を形態素解析する（従来の辞書形式）
+    """
+    return analyze_text(text).to_dicts()
+
+
+def get_pronunciation(text, keep_unknown=False, table=None):
     """
     テキストの発音をカタカナで取得する関数
     例：「今日はよく寝ました」→「キョウワヨクネマシタ」
@@ -163,24 +738,29 @@ def get_pronunciation(text, keep_unknown=False):
     Parameters:
     - text: 変換するテキスト
     - keep_unknown: 読みが不明な文字をそのまま残すかどうか
+    - table: 解析済みのトークン表（省略時はtextを解析する）
     """
-    # MeCabを使用して形態素解析
-    words_info = analyze_morphology(text)
+    if table is None:
+        table = analyze_text(text)
 
     # 発音の結果を構築
-    pronunciation = ""
-
-    for word_info in words_info:
-        surface = word_info["surface"]
-        reading = word_info.get("reading", "")
+    parts = []
+    for surface, reading in zip(table.surfaces, table.readings):
+        if reading:
+            parts.append(reading)
+        elif all(is_kana(char) for char in surface):
+            # 辞書に読みがない仮名はそのままカタカナに変換
+            parts.append(jaconv.hira2kata(surface))
+        elif keep_unknown:
+            parts.append(surface)
+    pronunciation = "".join(parts)
 
     # 区切り文字や記号を削除（keep_unknownがTrueの場合は保持）
     if not keep_unknown:
-        table = str.maketrans("", "", string.punctuation + "「」、。・")
-        pronunciation = pronunciation.translate(table)
+        punctuation_table = str.maketrans("", "", string.punctuation + "「」、。・")
+        pronunciation = pronunciation.translate(punctuation_table)
 
-    # 最終結果のログ出力
-    logger.info(f"テキスト '{text}' の発音結果: {pronunciation}")
+    logger.debug(f"テキスト '{text}' の発音結果: {pronunciation}")
 
     return pronunciation
 
@@ -205,72 +785,81 @@ def format_text(text):
     return text
 
 
-def check_difficult_sounds(word, difficult_sounds, reading=None):
+def check_difficult_sounds(word, difficult_sounds, reading=None, position_weights=None):
     """
-    単語が苦手な音で始まるか、苦手な音を含むかを確認
+    単語の読みが苦手な音で始まるか（position_weights を指定した場合は2モーラ目以降も）を確認
 
     Parameters:
     - word: 確認する単語
     - difficult_sounds: 苦手な音のリスト (例: ['し', 'は', 'き'])
     - reading: 単語の読み（形態素解析から取得）
+    - position_weights: 何モーラ目から始まる一致まで数えるかと、その重み（例: [1.0, 0.5]）
 
     Returns:
     - (boolean, float): 苦手かどうかのフラグと、難易度スコア
     """
-    if not word or not difficult_sounds:
+    if not word or not difficult_sounds or not reading:
         return False, 0.0
 
-    # 読みが存在する場合
-    if reading:
-        # 単語の先頭が苦手な音から始まるか（カタカナに変換してから比較
-        for sound in difficult_sounds:
-            katakana_sound = jaconv.hira2kata(sound)  # ひらがなをカタカナに変換
-            if reading.startswith(katakana_sound):
-                logger.info(
-                    f"苦手な音 '{sound}'(カタカナ: {katakana_sound}) が読み '{reading}' の先頭にマッチしました"
-                )
-                return True, 0.9
-
-    return False, 0.0
+    difficulty = phonetics.compile_sound_matcher(difficult_sounds, position_weights).score(
+        reading
+    )
+    return difficulty > 0.0, difficulty
 
 
-def get_difficult_words(text, difficulty_threshold=0.5, difficult_sounds=None):
+def get_difficult_words(
+    text,
+    difficulty_threshold=0.5,
+    difficult_sounds=None,
+    table=None,
+    position_weights=None,
+    matcher=None,
+):
     """
     テキスト内の難しい単語を特定する
     difficulty_threshold: 難しさの閾値
     difficult_sounds: ユーザーが苦手とする音のリスト (例: ['し', 'は', 'き'])
+    table: 解析済みのトークン表（省略時はtextを解析する）
+    position_weights: 2モーラ目以降の一致も数える場合の位置ごとの重み（例: [1.0, 0.5]）
+    matcher: 作成済みの照合器（発音プロファイルが保持するもの。指定時は difficult_sounds を無視する）
     """
-    words = analyze_morphology(text)
+    if table is None:
+        table = analyze_text(text)
     difficult_words = []
 
+    # 苦手な音はモーラ単位の照合器に一度だけ変換する（同じ音のセットではキャッシュを再利用）
+    if matcher is None:
+        matcher = phonetics.compile_sound_matcher(difficult_sounds, position_weights)
+
     # ハイライトから除外する品詞リスト
     exclude_pos = ["助詞", "助動詞", "接尾辞"]
-    exclude_option_pos = ["非自立可能"]
 
-    for word_info in words:
-        word = word_info["surface"]
-        pos = word_info["pos"]  # 　品詞
-        # option_pos = word_info["option_pos"]
-        position = word_info["position"]
-        start = word_info.get("start", 0)
-        end = word_info.get("end", 0)
-        reading = word_info.get("reading", "")  # 読み情報を取得
+    # 品詞IDごとに除外判定の結果をメモする
+    excluded_by_pid = {}
 
+    for position in range(len(table)):
+        pid = table.pos_ids[position]
+        excluded = excluded_by_pid.get(pid)
+        if excluded is None:
+            pos = _pos_names[pid]
+            excluded = excluded_by_pid[pid] = any(
+                excluded_pos in pos for excluded_pos in exclude_pos
+            )
 
         # 助詞、助動詞、接尾辞はスキップ
-        if any(excluded in pos for excluded in exclude_pos):
+        if excluded:
             continue
-        
+
+        word = table.surfaces[position]
+        reading = table.readings[position]  # 読み情報を取得
 
         difficulty = 0.0
         reason = ""
 
         # 苦手な音を含むか確認
-        if difficult_sounds:
-            is_difficult, sound_difficulty = check_difficult_sounds(
-                word, difficult_sounds, reading
-            )
-            if is_difficult:
+        if matcher:
+            sound_difficulty = matcher.score(reading)
+            if sound_difficulty > 0.0:
                 difficulty = max(difficulty, sound_difficulty)
                 reason = "difficult_sound"
 
@@ -282,129 +871,514 @@ def get_difficult_words(text, difficulty_threshold=0.5, difficult_sounds=None):
                     "position": position,
                     "difficulty": difficulty,
                     "reason": reason,
-                    "start": start,
-                    "end": end,
+                    "start": table.starts[position],
+                    "end": table.ends[position],
                     "reading": reading,  # 読み情報も結果に含める
-                    "pos": pos,  # 品詞情報も追加
+                    "pos": _pos_names[pid],  # 品詞情報も追加
                 }
             )
 
     return difficult_words
 
 
+def _context_window(text, start, end, sentences=None):
+    """
+    対象範囲を含む文と前後 sentences 文の範囲 (開始位置, 終了位置) を返す
+    長い文書でも対象の周辺の一定の文字数だけを調べる
+    """
+    if sentences is None:
+        sentences = MLM_CONTEXT_SENTENCES
+    max_chars = MLM_CONTEXT_TOKENS * _CHARS_PER_TOKEN
+    lower = max(0, start - max_chars)
+    upper = min(len(text), end + max_chars)
+
+    # 対象の文の開始位置と、その前の文の開始位置
+    boundaries = [m.end() for m in _sentence_end_pattern.finditer(text, lower, start)]
+    window_start = boundaries[-(sentences + 1)] if len(boundaries) > sentences else lower
+
+    # 対象の文の終了位置と、その後の文の終了位置
+    boundaries = [m.end() for m in _sentence_end_pattern.finditer(text, end, upper)]
+    window_end = boundaries[sentences] if len(boundaries) > sentences else upper
+
+    return window_start, window_end
+
+
+def find_context_window(text, target_word):
+    """
+    代替案の生成と同じ方法で対象単語の位置を求め、(開始位置, BERTに入力する文脈の範囲) を返す
+    対象単語がテキストにない場合は (-1, None)
+    """
+    start = text.find(target_word)
+    if start < 0:
+        return -1, None
+    return start, _context_window(text, start, start + len(target_word))
+
+
+def _tokenize_context(text, start, end):
+    """
+    対象範囲の前後の文脈をそれぞれトークン化し、(前のID列, 後のID列) を返す
+    文脈は対象の周辺の文に限り、さらに MLM_CONTEXT_TOKENS に収まるよう
+    対象範囲が中央になるように前後を切り詰める（長い文書でも推論時間が一定になる）
+    """
+    window_start, window_end = _context_window(text, start, end)
+    with metrics.stage(metrics.STAGE_TOKENIZATION):
+        prefix_ids = bert_tokenizer.convert_tokens_to_ids(
+            bert_tokenizer.tokenize(text[window_start:start])
+        )
+        suffix_ids = bert_tokenizer.convert_tokens_to_ids(
+            bert_tokenizer.tokenize(text[end:window_end])
+        )
+
+    max_tokens = min(MLM_CONTEXT_TOKENS, bert_tokenizer.model_max_length)
+    budget = max(0, max_tokens - 2 - _SPAN_TOKEN_RESERVE)  # CLS・SEPの分を除く
+    if len(prefix_ids) + len(suffix_ids) <= budget:
+        return prefix_ids, suffix_ids
+
+    # 前後に半分ずつ割り当て、片側が短い場合は残りをもう片側に回す
+    left = budget // 2
+    right = budget - left
+    if len(prefix_ids) < left:
+        right += left - len(prefix_ids)
+    elif len(suffix_ids) < right:
+        left += right - len(suffix_ids)
+
+    prefix_ids = prefix_ids[len(prefix_ids) - left :] if left > 0 else []
+    return prefix_ids, suffix_ids[:right]
+
+
+def _build_span_input(prefix_ids, span_ids, suffix_ids):
+    """
+    前後の文脈と対象範囲のID列を連結し、
+    (入力ID列, 対象のトークン開始位置, 対象のトークン終了位置) を返す
+    """
+    input_ids = bert_tokenizer.build_inputs_with_special_tokens(
+        list(prefix_ids) + list(span_ids) + list(suffix_ids)
+    )
+    span_start = len(prefix_ids) + 1  # CLS分の+1
+    return input_ids, span_start, span_start + len(span_ids)
+
+
+def _encode_with_span(text, start, end, replacement=None):
+    """
+    テキストを「前・対象・後」に分けてトークン化し、
+    (入力ID列, 対象のトークン開始位置, 対象のトークン終了位置) を返す
+    replacement: 指定した場合、対象の範囲をこの文字列に置き換えてトークン化する
+    """
+    target = text[start:end] if replacement is None else replacement
+    prefix_ids, suffix_ids = _tokenize_context(text, start, end)
+    target_ids = bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(target))
+    return _build_span_input(prefix_ids, target_ids, suffix_ids)
+
+
+def _pad_batch(batch_input_ids):
+    """入力ID列のリストをパディングしてモデルの入力テンソルにする"""
+    import torch
+
+    max_length = max(len(input_ids) for input_ids in batch_input_ids)
+    input_ids = torch.full(
+        (len(batch_input_ids), max_length), bert_tokenizer.pad_token_id, dtype=torch.long
+    )
+    attention_mask = torch.zeros((len(batch_input_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(batch_input_ids):
+        input_ids[row, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, : len(ids)] = 1
+
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "token_type_ids": torch.zeros_like(input_ids),
+    }
+
+
+def _span_embeddings(encodings):
+    """
+    (入力ID列, 開始位置, 終了位置) のリストを一度の推論で処理し、
+    各対象範囲の最終隠れ層を平均した埋め込み（L2正規化済み）を返す
+    """
+    import torch
+
+    inputs = _pad_batch([input_ids for input_ids, _, _ in encodings])
+
+    # MLMヘッドは不要なのでエンコーダーのみを実行する
+    metrics.observe_batch_size("embeddings", len(encodings))
+    with metrics.stage(metrics.STAGE_MODEL_FORWARD):
+        hidden_states = inference_backend.encode(**inputs)
+
+    # 対象範囲のトークンだけを1とする重みで平均する
+    span_weights = torch.zeros(hidden_states.shape[:2], dtype=hidden_states.dtype)
+    for row, (_, span_start, span_end) in enumerate(encodings):
+        span_weights[row, span_start:max(span_end, span_start + 1)] = 1.0
+    span_weights /= span_weights.sum(dim=1, keepdim=True)
+    embeddings = torch.einsum("bt,bth->bh", span_weights, hidden_states)
+
+    return torch.nn.functional.normalize(embeddings, dim=-1)
+
+
 def get_word_embedding(text, target_word):
     """
     文章内の特定の単語の埋め込みベクトルを取得
     """
-    if bert_model is None or bert_tokenizer is None:
+    if inference_backend is None or bert_tokenizer is None:
+        return None
+
+    start = text.find(target_word)
+    if start < 0:
         return None
 
-    inputs = bert_tokenizer(text, return_tensors="pt")
+    encoding = _encode_with_span(text, start, start + len(target_word))
+    return _span_embeddings([encoding])[0].numpy()
 
-    # モデルの出力を取得
-    with torch.no_grad():
-        outputs = bert_model(**inputs, output_hidden_states=True)
 
-    # 最後の隠れ層の出力を取得
-    hidden_states = outputs.hidden_states[-1][0]
+def generate_alternatives_with_mlm(text, target_word, top_k=5, difficult_sounds=None):
+    """
+    マスク言語モデリングを使用して代替案を生成
+    difficult_sounds: 指定した場合、これらの音で始まる候補はTop-kの前に除外する
+    """
+    return generate_alternatives_with_mlm_batch(
+        [(text, target_word, top_k, difficult_sounds)]
+    )[0]
+
 
-    # 単語のトークン位置を特定
-    tokens = bert_tokenizer.tokenize(text)
-    target_tokens = bert_tokenizer.tokenize(target_word)
+def generate_alternatives_with_mlm_batch(items):
+    """
+    複数の (テキスト, 対象単語, top_k, 苦手な音) をパディングして一度の推論で処理し、
+    それぞれの代替案のリストを入力と同じ順序で返す
+    対象単語はテキスト内で最初に現れる位置をマスクする
+    """
+    spans = []
+    for text, target_word, top_k, difficult_sounds in items:
+        start = text.find(target_word)
+        if start < 0:
+            spans.append(None)
+        else:
+            spans.append((text, start, start + len(target_word), top_k, difficult_sounds))
+    return generate_alternatives_with_mlm_spans(spans)
 
-    # 単語が複数のトークンに分割されている場合は、最初のトークンの位置を使用
-    target_token = target_tokens[0]
-    target_positions = [i for i, t in enumerate(tokens) if t == target_token]
 
-    if not target_positions:
-        return None
+def generate_alternatives_with_mlm_spans(items):
+    """
+    複数の (テキスト, 開始位置, 終了位置, top_k, 苦手な音) をパディングして一度の推論で処理し、
+    それぞれの代替案のリストを入力と同じ順序で返す
+    開始・終了位置は形態素解析の文字位置で、その範囲だけを1つのマスクに置き換える
+    （前後の文脈と対象範囲を別々にトークン化するため、トークン境界は必ず文字位置と一致する）
+    None の要素には空のリストを返す
+    """
+    import torch
+
+    if inference_backend is None or bert_tokenizer is None:
+        return [[] for _ in items]
+
+    # 対象範囲をマスクに置き換え、周辺の文脈だけを入力にする
+    mask_positions = {}
+    batch_input_ids = []
+    for row, item in enumerate(items):
+        if item is None:
+            continue
+        text, start, end, _, _ = item
+        prefix_ids, suffix_ids = _tokenize_context(text, start, end)
+        input_ids, span_start, _ = _build_span_input(
+            prefix_ids, [bert_tokenizer.mask_token_id], suffix_ids
+        )
+        mask_positions[row] = (len(batch_input_ids), span_start)
+        batch_input_ids.append(input_ids)
+
+    results = [[] for _ in items]
+    if not mask_positions:
+        return results
+
+    inputs = _pad_batch(batch_input_ids)
+
+    # マスク位置の予測だけを取得する（行はmask_positionsの順）
+    positions = list(mask_positions.values())
+    rows = torch.tensor([batch_row for batch_row, _ in positions])
+    cols = torch.tensor([col for _, col in positions])
+    metrics.observe_batch_size("mlm", len(batch_input_ids))
+    with metrics.stage(metrics.STAGE_MODEL_FORWARD):
+        logits = inference_backend.masked_logits(**inputs, rows=rows, cols=cols)
 
-    # 単語の埋め込みを取得（複数位置ある場合は最初の位置を使用）
-    token_idx = target_positions[0] + 1  # CLS分の+1
-    word_embedding = hidden_states[token_idx].numpy()
+    index = get_vocab_index()
+    if index is not None and len(index) != logits.shape[-1]:
+        index = None
 
-    return word_embedding
+    topk_started = time.perf_counter()
+    for logits_row, row in enumerate(mask_positions):
+        _, _, _, top_k, difficult_sounds = items[row]
 
+        # サブワード・記号・苦手な音で始まる候補をTop-kの前に除外する
+        blocked = None
+        if index is not None:
+            blocked = torch.from_numpy(index.blocked_mask(difficult_sounds))
 
-def generate_alternatives_with_mlm(text, target_word, top_k=5):
+        topk_log_probs, topk_indices = _topk_log_probs(logits[logits_row], top_k, blocked)
+        topk_probs = topk_log_probs.exp().masked_fill(topk_log_probs == -float("inf"), -1.0)
+        results[row] = _decode_mlm_predictions(topk_probs, topk_indices, index)
+    metrics.observe_stage(metrics.STAGE_TOPK, time.perf_counter() - topk_started)
+
+    return results
+
+
+def rank_candidates_with_mlm(text, target_word, candidates):
     """
-    マスク言語モデリングを使用して代替案を生成
+    対象単語を1つのマスクに置き換えた1行だけを推論し、そのマスク位置のロジットで候補を並べ替える
+    （同義語インデックスの候補など、候補が決まっている場合に語彙全体のTop-kの代わりに使う）
+    複数トークンからなる候補は先頭トークンの確率で評価する
+    対象単語そのものは候補から除く
     """
-    if bert_model is None or bert_tokenizer is None:
+    import torch
+
+    candidates = [word for word in dict.fromkeys(candidates) if word != target_word]
+    if inference_backend is None or bert_tokenizer is None or not candidates:
         return []
 
-    # ターゲット単語をマスクに置き換える
-    masked_text = text.replace(target_word, bert_tokenizer.mask_token)
+    start = text.find(target_word)
+    if start < 0:
+        return []
+
+    prefix_ids, suffix_ids = _tokenize_context(text, start, start + len(target_word))
+    input_ids, mask_position, _ = _build_span_input(
+        prefix_ids, [bert_tokenizer.mask_token_id], suffix_ids
+    )
+    first_token_ids = []
+    for word in candidates:
+        token_ids = bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(word))
+        first_token_ids.append(token_ids[0] if token_ids else bert_tokenizer.unk_token_id)
 
-    inputs = bert_tokenizer(masked_text, return_tensors="pt")
+    metrics.observe_batch_size("mlm", 1)
+    with metrics.stage(metrics.STAGE_MODEL_FORWARD):
+        logits = inference_backend.masked_logits(
+            **_pad_batch([input_ids]),
+            rows=torch.tensor([0]),
+            cols=torch.tensor([mask_position]),
+        )[0]
 
-    # マスクトークンの位置を取得
-    mask_idx = torch.where(inputs["input_ids"][0] == bert_tokenizer.mask_token_id)[0]
+    log_probs = logits[first_token_ids] - torch.logsumexp(logits, dim=-1)
+    ranked = sorted(zip(candidates, log_probs.exp().tolist()), key=lambda x: x[1], reverse=True)
+    return [{"word": word, "probability": float(prob)} for word, prob in ranked]
 
-    if len(mask_idx) == 0:
-        return []
 
-    # モデルの予測を取得
-    with torch.no_grad():
-        outputs = bert_model(**inputs)
+def _topk_log_probs(logits, k, blocked=None):
+    """
+    ロジットから除外されていない上位k件の対数確率とトークンIDを返す
+    順位はロジットで決まるため、語彙全体のsoftmaxは計算せず、上位k件だけを正規化する
+    除外された候補しか残らない場合、その分の対数確率は -inf になる
+    """
+    import torch
 
-    # マスク位置での予測確率
-    logits = outputs.logits[0, mask_idx[0]]
+    log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+    if blocked is not None:
+        logits = logits.masked_fill(blocked, -float("inf"))
+    topk_logits, topk_indices = torch.topk(logits, k=k, dim=-1)
+    return topk_logits - log_normalizer, topk_indices
 
-    # Top-k予測を取得
-    topk_probs, topk_indices = torch.topk(torch.softmax(logits, dim=-1), k=top_k)
 
+def _decode_mlm_predictions(topk_probs, topk_indices, index=None):
+    """Top-kの予測結果を代替案のリストに変換する"""
     alternatives = []
-    for prob, idx in zip(topk_probs.tolist(), topk_indices.tolist()):
-        token = bert_tokenizer.convert_ids_to_tokens([idx])[0]
+    token_ids = topk_indices.tolist()
+    tokens = bert_tokenizer.convert_ids_to_tokens(token_ids)
+    for prob, token_id, token in zip(topk_probs.tolist(), token_ids, tokens):
+        # 除外された候補
+        if prob < 0:
+            continue
         # サブワードトークンから元の単語を復元（##を削除）
         if token.startswith("##"):
             token = token[2:]
-        alternatives.append({"word": token, "probability": prob})
+        alternative = {"word": token, "probability": prob}
+        if index is not None:
+            # 語彙インデックスに読みがあれば形態素解析を省略できる
+            alternative["reading"] = str(index.readings[token_id])
+        alternatives.append(alternative)
 
     return alternatives
 
 
-def generate_alternatives_with_similar_embeddings(
-    text, target_word, candidates, top_k=5
+def generate_alternatives_with_mlm_multi(
+    text,
+    target_word,
+    top_k=5,
+    max_masks=MLM_MAX_MASKS,
+    beam_size=MLM_BEAM_SIZE,
+    difficult_sounds=None,
 ):
     """
-    単語埋め込みの類似度に基づいて代替案を生成
+    対象単語の位置に1〜max_masks個のマスクを置き、左から順にビームサーチで埋めて
+    複数トークンからなる単語の代替案を生成する
+    各ステップで全長さ・全ビームをまとめて一度の推論で処理し、長さごとに beam_size 本に枝刈りする
+    スコアはトークンごとの対数確率の平均（長さで正規化した確率）
     """
-    if bert_model is None or bert_tokenizer is None:
-        return []
+    import torch
 
-    # ターゲット単語の埋め込みを取得
-    target_embedding = get_word_embedding(text, target_word)
+    if inference_backend is None or bert_tokenizer is None:
+        return []
 
-    if target_embedding is None:
+    start = text.find(target_word)
+    if start < 0:
         return []
 
-    # 候補単語の埋め込みを取得
-    candidate_embeddings = []
-    for candidate in candidates:
-        # 候補単語を元のテキストに埋め込んだ文を作成
-        candidate_text = text.replace(target_word, candidate)
-        candidate_embedding = get_word_embedding(candidate_text, candidate)
+    prefix_ids, suffix_ids = _tokenize_context(text, start, start + len(target_word))
+    mask_id = bert_tokenizer.mask_token_id
 
-        if candidate_embedding is not None:
-            candidate_embeddings.append((candidate, candidate_embedding))
+    index = get_vocab_index()
+    if index is not None:
+        first_blocked = torch.from_numpy(index.blocked_mask(difficult_sounds))
+        next_blocked = torch.from_numpy(index.continuation_blocked)
+    else:
+        first_blocked = next_blocked = torch.zeros(len(bert_tokenizer), dtype=torch.bool)
+        first_blocked[bert_tokenizer.all_special_ids] = True
+        next_blocked[bert_tokenizer.all_special_ids] = True
 
-    # コサイン類似度を計算して順位付け
-    similarities = []
-    for candidate, embedding in candidate_embeddings:
-        sim = cosine_similarity([target_embedding], [embedding])[0][0]
-        similarities.append((candidate, sim))
+    deadline = time.monotonic() + MLM_BEAM_TIME_BUDGET_MS / 1000.0
 
-    # 類似度でソート
-    similarities.sort(key=lambda x: x[1], reverse=True)
+    # ビーム: (マスク数, 埋めたトークンID, 対数確率の合計)
+    beams = [(n, (), 0.0) for n in range(1, max_masks + 1)]
+    completed = []
 
-    # 上位k個の候補を返す
-    alternatives = []
-    for candidate, sim in similarities[:top_k]:
-        alternatives.append({"word": candidate, "similarity": float(sim)})
+    for step in range(max_masks):
+        if not beams:
+            break
 
-    return alternatives
+        encodings = [
+            _build_span_input(
+                prefix_ids, list(filled) + [mask_id] * (n - len(filled)), suffix_ids
+            )
+            for n, filled, _ in beams
+        ]
+        inputs = _pad_batch([input_ids for input_ids, _, _ in encodings])
+        rows = torch.arange(len(beams))
+        cols = torch.tensor([span_start + step for _, span_start, _ in encodings])
+
+        metrics.observe_batch_size("beam", len(beams))
+        with metrics.stage(metrics.STAGE_MODEL_FORWARD):
+            logits = inference_backend.masked_logits(**inputs, rows=rows, cols=cols)
+        if logits.shape[-1] != first_blocked.shape[0]:
+            break
+
+        with metrics.stage(metrics.STAGE_TOPK):
+            blocked = first_blocked if step == 0 else next_blocked
+            topk_log_probs, topk_indices = _topk_log_probs(logits, beam_size, blocked)
+
+        # 長さごとに候補を集め、上位 beam_size 本に枝刈りする
+        expanded = {}
+        for (n, filled, total), row_log_probs, row_indices in zip(
+            beams, topk_log_probs.tolist(), topk_indices.tolist()
+        ):
+            for log_prob, token_id in zip(row_log_probs, row_indices):
+                if log_prob == -float("inf"):
+                    continue
+                expanded.setdefault(n, []).append((n, filled + (token_id,), total + log_prob))
+
+        beams = []
+        for n, candidates in expanded.items():
+            candidates.sort(key=lambda beam: beam[2], reverse=True)
+            for beam in candidates[:beam_size]:
+                (completed if len(beam[1]) == n else beams).append(beam)
+
+        # 時間の上限を超えた場合は、より長い候補の探索を打ち切る
+        if time.monotonic() > deadline:
+            break
+
+    # 単語に復元し、同じ単語は最も高いスコアのものを残す
+    scores = {}
+    for n, filled, total in completed:
+        tokens = bert_tokenizer.convert_ids_to_tokens(list(filled))
+        word = "".join(token[2:] if token.startswith("##") else token for token in tokens)
+        if not word or word == target_word:
+            continue
+        score = math.exp(total / n)
+        if score > scores.get(word, 0.0):
+            scores[word] = score
+
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return [{"word": word, "probability": score} for word, score in ranked[:top_k]]
+
+
+def generate_alternatives_with_similar_embeddings(
+    text, target_word, candidates, top_k=5, start=None
+):
+    """
+    単語埋め込みの類似度に基づいて代替案を生成
+    元の文と各候補で置き換えた文をまとめて一度の推論で処理し、
+    対象範囲の埋め込み同士のコサイン類似度を行列演算で求める
+    start: 対象単語の文字位置（省略時はテキスト内で最初に現れる位置）
+    対象単語そのものは候補から除く
+    """
+    if start is None:
+        start = text.find(target_word)
+    if start < 0:
+        return []
+    (ranked,) = generate_alternatives_with_similar_embeddings_spans(
+        [(text, start, start + len(target_word), candidates)]
+    )
+    return ranked[:top_k]
+
+
+def generate_alternatives_with_similar_embeddings_spans(items):
+    """
+    複数の (テキスト, 開始位置, 終了位置, 候補のリスト) の類似度を一度の推論でまとめて計算し、
+    それぞれの候補を類似度の高い順に並べたリストを入力と同じ順序で返す
+    対象範囲そのものと同じ候補は除く
+    """
+    results = [[] for _ in items]
+    if inference_backend is None or bert_tokenizer is None:
+        return results
+
+    # 範囲ごとに、先頭が元の文、以降が候補単語を埋め込んだ文（前後の文脈のトークン化は一度だけ行う）
+    encodings = []
+    groups = []
+    for row, (text, start, end, candidates) in enumerate(items):
+        target_word = text[start:end]
+        candidates = [word for word in dict.fromkeys(candidates) if word != target_word]
+        if not candidates:
+            continue
+        prefix_ids, suffix_ids = _tokenize_context(text, start, end)
+        groups.append((row, len(encodings), candidates))
+        encodings.extend(
+            _build_span_input(
+                prefix_ids,
+                bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(word)),
+                suffix_ids,
+            )
+            for word in [target_word] + candidates
+        )
+
+    if not encodings:
+        return results
+    embeddings = _span_embeddings(encodings)
+
+    for row, offset, candidates in groups:
+        # 正規化済みなので内積がコサイン類似度になる
+        similarities = (
+            embeddings[offset + 1 : offset + 1 + len(candidates)] @ embeddings[offset]
+        ).tolist()
+        ranked = sorted(zip(candidates, similarities), key=lambda x: x[1], reverse=True)
+        results[row] = [
+            {"word": candidate, "similarity": float(sim)} for candidate, sim in ranked
+        ]
+    return results
+
+
+def combine_alternatives(mlm_alternatives, embedding_alternatives, probability_weight=0.5):
+    """
+    MLMの確率と埋め込みの類似度を組み合わせたスコアを付けた代替案を返す
+    確率は最大値で正規化し、probability_weight の重みで類似度と加重平均する
+    （probability_weight=0 の場合は類似度のみでスコアを付ける）
+    """
+    similarities = {alt["word"]: alt["similarity"] for alt in embedding_alternatives}
+    max_probability = max(
+        (alt["probability"] for alt in mlm_alternatives), default=0.0
+    ) or 1.0
+
+    combined = []
+    for alt in mlm_alternatives:
+        if alt["word"] not in similarities:
+            continue
+        similarity = similarities[alt["word"]]
+        score = (
+            probability_weight * alt["probability"] / max_probability
+            + (1.0 - probability_weight) * similarity
+        )
+        combined.append(dict(alt, similarity=similarity, score=score))
+    return combined
 
 
 def filter_by_pronunciation_ease(alternatives, difficult_patterns=None, easy_pronunciations=None):
@@ -420,22 +1394,24 @@ def filter_by_pronunciation_ease(alternatives, difficult_patterns=None, easy_pro
         # 吃音者が発音しにくい可能性のあるパターン（例示）
         difficult_patterns = ["sp", "st", "pr", "tr", "kr", "き", "か", "た", "は"]
 
+    # 読みが未取得の候補のみ、まとめて一度の形態素解析で取得する
+    readings = get_readings(
+        [alt["word"] for alt in alternatives if "reading" not in alt]
+    )
+
     filtered_alts = []
     for alt in alternatives:
         word = alt["word"]
-        
-        # 形態素解析で単語の読みを取得
-        word_reading = ""
-        try:
-            word_morphology = analyze_morphology(word)
-            if word_morphology:
-                word_reading = word_morphology[0].get("reading", "")
-        except Exception as e:
-            logger.warning(f"単語 '{word}' の読み取得中にエラー: {e}")
-        
+        word_reading = alt.get("reading")
+        if word_reading is None:
+            word_reading = readings.get(word, "")
+
         # 意味的類似度のみを使用（発音のボーナスは削除）
         base_score = 1.0
-        if "similarity" in alt:
+        if "score" in alt:
+            # MLMと埋め込みを組み合わせたスコア
+            base_score = alt["score"]
+        elif "similarity" in alt:
             base_score = alt["similarity"]
         elif "probability" in alt:
             base_score = alt["probability"]
@@ -459,8 +1435,11 @@ def filter_by_pronunciation_ease(alternatives, difficult_patterns=None, easy_pro
     filtered_alts.sort(key=lambda x: x["score"], reverse=True)
     
     # ログ出力（デバッグ用）
-    logger.info(f"文脈的類似度による代替案ランキング")
-    for i, alt in enumerate(filtered_alts[:5]):  # 上位5件のみログ出力
-        logger.info(f"  {i+1}. {alt['word']} (スコア: {alt['score']:.3f}, 読み: {alt['reading']})")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("文脈的類似度による代替案ランキング")
+        for i, alt in enumerate(filtered_alts[:5]):  # 上位5件のみログ出力
+            logger.debug(
+                f"  {i+1}. {alt['word']} (スコア: {alt['score']:.3f}, 読み: {alt['reading']})"
+            )
 
     return filtered_alts
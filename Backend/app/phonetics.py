@@ -0,0 +1,166 @@
+"""
+読み（仮名）をモーラ単位で扱うためのユーティリティ
+"""
+
+import threading
+from collections import OrderedDict
+
+# 直前の仮名と合わせて1モーラになる小書き文字
+SMALL_KANA = frozenset("ァィゥェォャュョヮぁぃぅぇぉゃゅょゎ")
+
+
+def split_morae(reading):
+    """
+    読み（仮名）をモーラ単位に分割する
+    拗音（シャ等）は1モーラ、促音（ッ）・長音（ー）はそれぞれ1モーラとして扱う
+    """
+    morae = []
+    for char in reading:
+        if char in SMALL_KANA and morae:
+            morae[-1] += char
+        else:
+            morae.append(char)
+    return morae
+
+
+def first_mora(reading):
+    """読みの先頭のモーラを返す（読みが空の場合は空文字列）"""
+    if not reading:
+        return ""
+    if len(reading) > 1 and reading[1] in SMALL_KANA:
+        return reading[:2]
+    return reading[0]
+
+
+# 長音として扱う母音の組み合わせ（直前のモーラの母音, 続く母音）
+# 発音形の読み（キョー、センセー）と仮名表記の音（きょう、せんせい）を同じモーラ列にする
+_LONG_VOWEL_PAIRS = frozenset(
+    [("ア", "ア"), ("イ", "イ"), ("ウ", "ウ"), ("エ", "エ"), ("オ", "オ"),
+     ("エ", "イ"), ("オ", "ウ")]
+)
+
+# 各仮名の母音（長音の判定に使う）
+_VOWEL_ROWS = {
+    "ア": "アカサタナハマヤラワガザダバパァャヮ",
+    "イ": "イキシチニヒミリギジヂビピィ",
+    "ウ": "ウクスツヌフムユルグズヅブプゥュヴ",
+    "エ": "エケセテネヘメレゲゼデベペェ",
+    "オ": "オコソトノホモヨロヲゴゾドボポォョ",
+}
+_VOWEL_OF = {kana: vowel for vowel, row in _VOWEL_ROWS.items() for kana in row}
+
+# 苦手な音と先頭モーラで一致したときの難易度
+SOUND_MATCH_DIFFICULTY = 0.9
+
+# 1つの照合器が読みごとの結果を保持する最大件数
+_MATCH_MEMO_SIZE = 65536
+
+
+def _to_katakana(text):
+    """ひらがなをカタカナに変換する"""
+    return "".join(
+        chr(ord(char) + 0x60) if "ぁ" <= char <= "ゖ" else char for char in text
+    )
+
+
+def normalize_morae(reading):
+    """
+    読みをカタカナのモーラ列にし、母音の引き延ばしを長音（ー）にそろえる
+    例: 「きょう」「キョウ」「キョー」→ ["キョ", "ー"]
+    """
+    morae = split_morae(_to_katakana(reading))
+    for i in range(1, len(morae)):
+        previous_vowel = _VOWEL_OF.get(morae[i - 1][-1])
+        if previous_vowel and (previous_vowel, morae[i]) in _LONG_VOWEL_PAIRS:
+            morae[i] = "ー"
+    return morae
+
+
+class SoundMatcher:
+    """
+    苦手な音のリストをモーラ単位のトライ木にまとめた照合器
+    拗音（シャ）と直音（シ）は別のモーラとして区別し、長音・促音もそれぞれ1モーラとして照合する
+    position_weights: 読みの何モーラ目から始まる一致まで数えるかと、その重み
+                      （デフォルトは先頭モーラのみ (1.0,)）
+    """
+
+    def __init__(self, difficult_sounds, position_weights=(1.0,)):
+        self.position_weights = tuple(position_weights) or (1.0,)
+        self._trie = {}
+        for sound in difficult_sounds:
+            morae = normalize_morae(sound)
+            if not morae:
+                continue
+            node = self._trie
+            for mora in morae:
+                node = node.setdefault(mora, {})
+            node[None] = True  # 終端
+        self._memo = {}
+
+    def __bool__(self):
+        return bool(self._trie)
+
+    def _matches_at(self, morae, start):
+        node = self._trie
+        for mora in morae[start:]:
+            node = node.get(mora)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def score(self, reading):
+        """
+        読みが苦手な音を含む場合は、一致した位置の重みを掛けた難易度を返す（含まない場合は0.0）
+        同じ読みの結果は記憶しておき、2回目以降は辞書の参照だけで返す
+        """
+        cached = self._memo.get(reading)
+        if cached is not None:
+            return cached
+
+        result = 0.0
+        if reading:
+            morae = normalize_morae(reading)
+            for position, weight in enumerate(self.position_weights):
+                if position >= len(morae):
+                    break
+                if weight > result / SOUND_MATCH_DIFFICULTY and self._matches_at(
+                    morae, position
+                ):
+                    result = SOUND_MATCH_DIFFICULTY * weight
+
+        if len(self._memo) >= _MATCH_MEMO_SIZE:
+            self._memo.clear()
+        self._memo[reading] = result
+        return result
+
+    def scores(self, readings):
+        """読みの列をまとめて照合し、難易度のリストを返す"""
+        score = self.score
+        return [score(reading) for reading in readings]
+
+
+_matcher_cache = OrderedDict()
+_matcher_cache_lock = threading.Lock()
+_MATCHER_CACHE_SIZE = 256
+
+
+def compile_sound_matcher(difficult_sounds, position_weights=None):
+    """苦手な音のセットごとに照合器を作成し、キャッシュして返す"""
+    weights = tuple(position_weights) if position_weights else (1.0,)
+    key = (frozenset(difficult_sounds or ()), weights)
+
+    with _matcher_cache_lock:
+        matcher = _matcher_cache.get(key)
+        if matcher is not None:
+            _matcher_cache.move_to_end(key)
+            return matcher
+
+    matcher = SoundMatcher(sorted(key[0]), weights)
+
+    with _matcher_cache_lock:
+        _matcher_cache[key] = matcher
+        while len(_matcher_cache) > _MATCHER_CACHE_SIZE:
+            _matcher_cache.popitem(last=False)
+    return matcher
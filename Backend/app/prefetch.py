@@ -0,0 +1,171 @@
+"""
+難しい単語の代替案の先読み
+/analyze-realtime や編集セッションで新たに検出された単語の代替案を、推論の空き時間に
+バックグラウンドで計算して代替案キャッシュに入れておく
+ポップオーバーを開いたときの /smart-alternatives はキャッシュ（または計算中の結果）から応答できる
+
+先読みは常に1件ずつ、推論キューとバッチ待ちが空のときだけ実行するため、
+ユーザーの操作による推論を待たせるのは実行中の1件分までになる
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+import alternatives_cache
+import batching
+import inference
+
+logger = logging.getLogger(__name__)
+
+# 先読み待ちの最大件数（0の場合は先読みしない）。超えた場合は古いものから捨てる
+PREFETCH_QUEUE_SIZE = int(os.environ.get("PREFETCH_QUEUE_SIZE", "64"))
+
+# 1回の解析結果から先読みする単語の最大数
+PREFETCH_MAX_WORDS = int(os.environ.get("PREFETCH_MAX_WORDS", "20"))
+
+# 推論が混んでいるときに、空くまで待つ間隔（ミリ秒）
+PREFETCH_IDLE_WAIT_MS = float(os.environ.get("PREFETCH_IDLE_WAIT_MS", "50"))
+
+
+class PrefetchToken:
+    """
+    先読み1件のトークン
+    解析したテキストのバージョンが古くなると superseded になる
+    同じキーのポップオーバーのリクエストが相乗りすると、ポップオーバーの優先度に昇格する
+    """
+
+    __slots__ = ("parent", "priority")
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.priority = inference.PRIORITY_PREFETCH
+
+    @property
+    def key(self):
+        return self.parent.key if self.parent is not None else (None, "prefetch")
+
+    @property
+    def version(self):
+        return self.parent.version if self.parent is not None else None
+
+    @property
+    def promoted(self):
+        return self.priority < inference.PRIORITY_PREFETCH
+
+    @property
+    def superseded(self):
+        # 昇格した後は、ポップオーバーが結果を待っているためテキストが古くなっても打ち切らない
+        return not self.promoted and self.parent is not None and self.parent.superseded
+
+    def promote(self, priority=inference.PRIORITY_INTERACTIVE):
+        """待機中と以降の推論を priority で実行する（推論の待機キューの中の順番も上げる）"""
+        self.priority = min(self.priority, priority)
+        inference.model_executor.promote(self, self.priority)
+        batching.mlm_batcher.promote(self, self.priority)
+
+
+def _is_idle():
+    """ユーザーの操作による推論が実行中・待機中でないか"""
+    return inference.model_executor.pending == 0 and batching.mlm_batcher.pending == 0
+
+
+class AlternativesPrefetcher:
+    """
+    キャッシュキーと計算処理の組を優先度の低いキューに積み、推論の空き時間に1件ずつ計算する
+    新しく積まれたものから計算する（直前の編集で検出された単語ほどクリックされやすい）
+    """
+
+    def __init__(self, cache, max_queue_size, idle_wait_ms):
+        self.cache = cache
+        self.max_queue_size = max_queue_size
+        self.idle_wait = idle_wait_ms / 1000.0
+        # キャッシュキー -> (計算処理, トークン)（末尾が最新）
+        self._queue = OrderedDict()
+        self._wakeup = None
+        self._task = None
+        self.stats = {
+            "scheduled": 0,
+            "cached": 0,
+            "dropped": 0,
+            "superseded": 0,
+            "completed": 0,
+            "errors": 0,
+        }
+
+    @property
+    def pending(self):
+        """先読み待ちの件数"""
+        return len(self._queue)
+
+    def schedule(self, items, token=None):
+        """
+        (キャッシュキー, 計算処理) のリストを先読み待ちに積む（イベントループ上で呼び出す）
+        計算処理は PrefetchToken を受け取ってコルーチンを返す関数（推論にそのトークンを渡す）
+        キャッシュ済み・先読み待ちのキーは積み直さない
+        token（解析したテキストのバージョン）が古くなった場合、未計算のものは捨てる
+        """
+        if self.max_queue_size <= 0:
+            return
+
+        # 先頭の単語から計算されるよう、逆順に末尾へ積む
+        for key, compute in reversed(items):
+            if self.cache.contains(key):
+                self.stats["cached"] += 1
+                continue
+            if key in self._queue:
+                self._queue[key] = (compute, token)
+                self._queue.move_to_end(key)
+                continue
+            self._queue[key] = (compute, token)
+            self.stats["scheduled"] += 1
+            while len(self._queue) > self.max_queue_size:
+                self._queue.popitem(last=False)
+                self.stats["dropped"] += 1
+
+        if self._queue:
+            self._ensure_started()
+            self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # ユーザーの操作による推論を優先し、空くまで待つ
+            if not _is_idle():
+                await asyncio.sleep(self.idle_wait)
+                continue
+
+            key, (compute, token) = self._queue.popitem(last=True)
+            if token is not None and token.superseded:
+                self.stats["superseded"] += 1
+                continue
+            # 同じキーのポップオーバーのリクエストは先読みを昇格させて、その結果を待つ
+            item_token = PrefetchToken(token)
+            try:
+                await self.cache.get_or_compute(
+                    key, lambda: compute(item_token), promote=item_token.promote
+                )
+                self.stats["completed"] += 1
+            except (inference.QueueFullError, inference.SupersededError):
+                self.stats["dropped"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.debug(f"代替案の先読みに失敗しました: {e}")
+
+    def info(self):
+        return {**self.stats, "pending": self.pending, "max_size": self.max_queue_size}
+
+
+prefetcher = AlternativesPrefetcher(
+    alternatives_cache.alternatives_cache, PREFETCH_QUEUE_SIZE, PREFETCH_IDLE_WAIT_MS
+)
@@ -0,0 +1,156 @@
+"""
+サーバー側で保持する発音プロファイル
+苦手な音・発音しやすい音を一度登録すればIDで参照でき、
+苦手な音の照合器と語彙のマスクはプロファイルごとに作成済みの状態で保持する
+
+プロファイルIDは正規化した設定をエンコードしたもので、設定をIDから復元できる
+pre-fork型サーバーで登録したワーカーと別のワーカーにリクエストが届いても、
+そのワーカーでプロファイルを作り直して応答する
+"""
+
+import base64
+import binascii
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import nlp_utils
+import phonetics
+
+# 保持するプロファイルの最大数（超えた場合は最も長く使われていないものから削除する）
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "10000"))
+
+
+class ProfileNotFoundError(KeyError):
+    """指定されたIDのプロファイルが存在しない（削除された）ときに送出される例外"""
+
+
+class PronunciationProfile:
+    """1人のユーザーの発音の設定と、そこから作成した照合器"""
+
+    def __init__(self, profile_id, difficult_sounds, easy_pronunciations, position_weights):
+        self.id = profile_id
+        self.difficult_sounds = difficult_sounds
+        self.easy_pronunciations = easy_pronunciations
+        self.position_weights = position_weights
+        self.matcher = phonetics.SoundMatcher(difficult_sounds, position_weights or (1.0,))
+        # MLMで使う語彙の除外マスク（プロファイルが削除されるとメモリから解放される）
+        self.blocked_mask = None
+
+    def warm(self):
+        """MLMで使う語彙のマスクを作成しておく（モデルのロード前は何もしない）"""
+        index = nlp_utils.get_vocab_index()
+        if index is not None and self.blocked_mask is None:
+            self.blocked_mask = index.pin_blocked_mask(self.difficult_sounds)
+
+    def to_dict(self):
+        return {
+            "profile_id": self.id,
+            "difficult_sounds": self.difficult_sounds,
+            "easy_pronunciations": self.easy_pronunciations,
+            "position_weights": self.position_weights,
+        }
+
+
+def normalize_settings(difficult_sounds=None, easy_pronunciations=None, position_weights=None):
+    """プロファイルの設定を正規化する（同じ設定なら同じ値になる）"""
+    return (
+        sorted(set(difficult_sounds or [])),
+        sorted(set(easy_pronunciations or [])),
+        [float(weight) for weight in position_weights] if position_weights else None,
+    )
+
+
+def profile_id_for(difficult_sounds, easy_pronunciations, position_weights):
+    """正規化した設定をエンコードしたプロファイルID（同じ設定なら同じIDになる）"""
+    payload = json.dumps(
+        [difficult_sounds, easy_pronunciations, position_weights],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def settings_from_id(profile_id):
+    """プロファイルIDから正規化済みの設定を復元する（IDが不正な場合は ProfileNotFoundError）"""
+    try:
+        payload = base64.urlsafe_b64decode(profile_id + "=" * (-len(profile_id) % 4))
+        difficult_sounds, easy_pronunciations, position_weights = json.loads(payload)
+        settings = normalize_settings(difficult_sounds, easy_pronunciations, position_weights)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ProfileNotFoundError(profile_id)
+    if not all(isinstance(sound, str) for sound in settings[0] + settings[1]):
+        raise ProfileNotFoundError(profile_id)
+    # 正規化した結果が同じIDになるものだけを受け付ける
+    if profile_id_for(*settings) != profile_id:
+        raise ProfileNotFoundError(profile_id)
+    return settings
+
+
+class ProfileStore:
+    """プロファイルをIDで保持するLRU"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, difficult_sounds=None, easy_pronunciations=None, position_weights=None):
+        """プロファイルを登録してIDを返す（同じ設定のプロファイルがあればそれを返す）"""
+        difficult_sounds, easy_pronunciations, position_weights = normalize_settings(
+            difficult_sounds, easy_pronunciations, position_weights
+        )
+        profile_id = profile_id_for(difficult_sounds, easy_pronunciations, position_weights)
+
+        with self._lock:
+            profile = self._profiles.get(profile_id)
+            if profile is not None:
+                self._profiles.move_to_end(profile_id)
+                return profile
+
+        profile = PronunciationProfile(
+            profile_id, difficult_sounds, easy_pronunciations, position_weights
+        )
+        profile.warm()
+
+        with self._lock:
+            self._profiles[profile_id] = profile
+            self._profiles.move_to_end(profile_id)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def get(self, profile_id):
+        """IDでプロファイルを取得する（このプロセスに保持していない場合は ProfileNotFoundError）"""
+        with self._lock:
+            profile = self._profiles.get(profile_id)
+            if profile is None:
+                raise ProfileNotFoundError(profile_id)
+            self._profiles.move_to_end(profile_id)
+            return profile
+
+    def get_or_restore(self, profile_id):
+        """
+        IDでプロファイルを取得する
+        このプロセスに保持していない場合（別のワーカーで登録された・削除された）はIDから作り直す
+        """
+        try:
+            return self.get(profile_id)
+        except ProfileNotFoundError:
+            return self.create(*settings_from_id(profile_id))
+
+    def delete(self, profile_id):
+        """
+        このプロセスに保持しているプロファイルを削除する
+        IDは設定から決まるため、削除した後も同じIDで参照すれば作り直される
+        """
+        settings_from_id(profile_id)
+        with self._lock:
+            self._profiles.pop(profile_id, None)
+
+    def __len__(self):
+        return len(self._profiles)
+
+
+profile_store = ProfileStore(PROFILE_CACHE_SIZE)
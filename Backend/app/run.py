@@ -11,6 +11,13 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
     env = os.getenv("API_ENV", "development")
 
+    # 本番環境ではpre-fork型サーバーで複数のワーカーを起動する（モデルの重みを共有）
+    if env == "production":
+        import serve
+
+        serve.main()
+        raise SystemExit(0)
+
     # uvicornの設定
     uvicorn.run(
         "main:app",
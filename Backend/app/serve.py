@@ -0,0 +1,175 @@
+"""
+本番用のpre-fork型サーバー
+マスタープロセスでBERTモデルを一度だけロードしてから複数のワーカーをforkし、
+重みのメモリページをコピーオンライトで共有する（ワーカー数に比例してメモリが増えない）
+
+環境変数:
+- WEB_CONCURRENCY: ワーカープロセス数（デフォルト: CPUコア数）
+- TORCH_NUM_THREADS: ワーカーごとのPyTorchのintra-opスレッド数
+  （デフォルト: CPUコア数 / ワーカー数。コアの過剰な取り合いを防ぐ）
+- WORKER_RESTART_BACKOFF / WORKER_RESTART_BACKOFF_MAX: 異常終了したワーカーを起動し直すまでの
+  待ち時間の初期値と上限（秒。同じワーカーが続けて異常終了するたびに倍にする）
+- WORKER_CRASH_LIMIT: 同じワーカーが続けて異常終了できる回数。超えた場合は全てのワーカーを止めて
+  マスタープロセスも異常終了する（起動直後に落ち続ける場合にforkを繰り返さない）
+- WORKER_STABLE_SECONDS: この秒数以上動いてから終了したワーカーは、続けての異常終了として数えない
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import uvicorn
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+WORKER_RESTART_BACKOFF = float(os.getenv("WORKER_RESTART_BACKOFF", "0.5"))
+WORKER_RESTART_BACKOFF_MAX = float(os.getenv("WORKER_RESTART_BACKOFF_MAX", "30"))
+WORKER_CRASH_LIMIT = int(os.getenv("WORKER_CRASH_LIMIT", "5"))
+WORKER_STABLE_SECONDS = float(os.getenv("WORKER_STABLE_SECONDS", "60"))
+
+
+def restart_delay(crashes):
+    """続けて crashes 回異常終了したワーカーを起動し直すまでの秒数"""
+    return min(WORKER_RESTART_BACKOFF * 2 ** (crashes - 1), WORKER_RESTART_BACKOFF_MAX)
+
+
+def _bind_socket(host, port):
+    """全ワーカーで共有する待ち受けソケットを作成する"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock):
+    """forkされたワーカープロセスでuvicornを起動する"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    config = uvicorn.Config("main:app", log_level=os.getenv("LOG_LEVEL", "info"))
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main():
+    load_dotenv()
+
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    cpu_count = os.cpu_count() or 1
+    workers = int(os.getenv("WEB_CONCURRENCY", str(cpu_count)))
+
+    # ワーカーごとのスレッド数（fork後にワーカー側で適用される）
+    os.environ.setdefault("TORCH_NUM_THREADS", str(max(1, cpu_count // workers)))
+    os.environ.setdefault("TORCH_INTEROP_THREADS", "1")
+    os.environ.setdefault("MECAB_POOL_SIZE", str(max(1, cpu_count // workers)))
+
+    # メトリクスを全ワーカーで集計するためのディレクトリ（prometheus_clientの読み込み前に設定する）
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="fluent_assist_metrics_")
+
+    import nlp_utils
+
+    if not nlp_utils.preload_model():
+        logger.warning("モデルを事前ロードできなかったため、各ワーカーで個別にロードします")
+
+    # 以降に作られるオブジェクトだけをGCの対象にし、共有ページへの書き込みを減らす
+    gc.collect()
+    gc.freeze()
+
+    sock = _bind_socket(host, port)
+    logger.info(
+        f"{workers}個のワーカーを起動します（http://{host}:{port}、"
+        f"ワーカーごとのスレッド数: {os.environ['TORCH_NUM_THREADS']}）"
+    )
+
+    # pid -> (ワーカーの番号, 起動した時刻)
+    children = {}
+    # ワーカーの番号ごとの、続けて異常終了した回数
+    crashes = [0] * workers
+    # 起動し直すのを待っているワーカーの番号 -> 起動する時刻
+    restarts = {}
+    stopping = False
+    crash_looping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(sock)
+            finally:
+                os._exit(0)
+        children[pid] = (slot, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        restarts.clear()
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        spawn(slot)
+
+    # 異常終了したワーカーは、続けて落ちるほど間隔を空けて起動し直す
+    while children or restarts:
+        now = time.monotonic()
+        for slot, due in list(restarts.items()):
+            if due <= now:
+                del restarts[slot]
+                spawn(slot)
+
+        try:
+            if restarts:
+                # 起動し直す時刻まで、終了したワーカーを確認しながら待つ
+                pid, status = os.waitpid(-1, os.WNOHANG) if children else (0, 0)
+                if pid == 0:
+                    time.sleep(min(0.1, max(0.0, min(restarts.values()) - now)))
+                    continue
+            else:
+                pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+
+        slot, started = children.pop(pid)
+        if stopping:
+            continue
+        if time.monotonic() - started >= WORKER_STABLE_SECONDS:
+            crashes[slot] = 0
+        crashes[slot] += 1
+        if crashes[slot] > WORKER_CRASH_LIMIT:
+            logger.error(
+                f"ワーカー {slot} が続けて{crashes[slot]}回異常終了したため、サーバーを停止します"
+            )
+            crash_looping = True
+            stop(None, None)
+            continue
+        delay = restart_delay(crashes[slot])
+        logger.warning(
+            f"ワーカー {pid} が終了しました（status={status}）。{delay:.1f}秒後に再起動します"
+        )
+        restarts[slot] = time.monotonic() + delay
+
+    sock.close()
+    if crash_looping:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+同義語辞書のインデックス
+手元の類義語辞書から、見出し語 -> 同義語（読み付き）のインデックスを作成して1つのファイルに保存する
+サーバーはファイルをメモリマップで開くため、読み込みは一瞬で、ページはワーカー間で共有される
+見出し語の検索はハッシュ表による O(1)
+
+使い方:
+    python synonym_index.py thesaurus.txt -o synonyms.idx                  # 1行に1グループ（タブまたはカンマ区切り）
+    python synonym_index.py synonyms.txt -o synonyms.idx --format sudachi  # Sudachiの同義語辞書
+
+ファイルの形式:
+    先頭8バイトのマジック、4バイトのヘッダー長、JSONのヘッダー（配列の型・位置・要素数）、
+    8バイト境界に揃えた配列の本体
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b"FASYNIDX"
+
+# インデックスのファイル形式のバージョン（形式を変えたら上げる）
+INDEX_VERSION = 1
+
+THESAURUS_FORMATS = ("groups", "sudachi")
+
+# Sudachiの同義語辞書で見出しが入っている列
+_SUDACHI_HEADWORD_COLUMN = 8
+
+
+def _hash(word):
+    return int.from_bytes(
+        hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def read_thesaurus(path, fmt="groups"):
+    """
+    類義語辞書を読み込み、同義語のグループ（単語のリスト）を順に返す
+    groups: 1行に1グループ。単語はタブまたはカンマで区切る（# で始まる行は無視する）
+    sudachi: Sudachiの同義語辞書（CSV。1列目のグループ番号が同じ行の見出しを1グループにする）
+    """
+    with open(path, encoding="utf-8") as f:
+        if fmt == "groups":
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                words = [word.strip() for word in line.replace("\t", ",").split(",")]
+                group = [word for word in dict.fromkeys(words) if word]
+                if len(group) > 1:
+                    yield group
+            return
+
+        group_id, group = None, []
+        for line in f:
+            columns = line.rstrip("\n").split(",")
+            if len(columns) <= _SUDACHI_HEADWORD_COLUMN:
+                continue
+            if columns[0] != group_id:
+                if len(group) > 1:
+                    yield group
+                group_id, group = columns[0], []
+            word = columns[_SUDACHI_HEADWORD_COLUMN].strip()
+            if word and word not in group:
+                group.append(word)
+        if len(group) > 1:
+            yield group
+
+
+def _strings_to_arrays(strings):
+    """文字列のリストを、UTF-8を連結したバイト列と開始位置の配列に変換する"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def build_synonym_index(groups, analyze_words):
+    """
+    同義語のグループからインデックスの配列を作成する
+    各単語の同義語は、その単語を含むグループの他の単語（辞書に現れた順、重複なし）
+    analyze_words: 単語のリストから (読み, 品詞名) のリストを返す関数
+    """
+    synonyms = {}
+    for group in groups:
+        for word in group:
+            entry = synonyms.setdefault(word, {})
+            for other in group:
+                if other != word:
+                    entry[other] = None
+
+    words = sorted(synonyms)
+    ids = {word: i for i, word in enumerate(words)}
+    readings = [reading for reading, _ in analyze_words(words)]
+
+    synonym_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    synonym_offsets[1:] = np.cumsum([len(synonyms[word]) for word in words])
+    synonym_ids = np.array(
+        [ids[other] for word in words for other in synonyms[word]], dtype=np.int32
+    )
+
+    # 開番地法のハッシュ表（要素数の2倍以上の2のべき乗の大きさ）
+    hashes = np.array([_hash(word) for word in words], dtype=np.uint64)
+    table_size = 1
+    while table_size < 2 * len(words):
+        table_size *= 2
+    slots = np.full(table_size, -1, dtype=np.int32)
+    mask = table_size - 1
+    for i, h in enumerate(hashes.tolist()):
+        slot = h & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+
+    word_bytes, word_offsets = _strings_to_arrays(words)
+    reading_bytes, reading_offsets = _strings_to_arrays(readings)
+    return {
+        "hashes": hashes,
+        "slots": slots,
+        "word_bytes": word_bytes,
+        "word_offsets": word_offsets,
+        "reading_bytes": reading_bytes,
+        "reading_offsets": reading_offsets,
+        "synonym_offsets": synonym_offsets,
+        "synonym_ids": synonym_ids,
+    }
+
+
+def write_synonym_index(path, arrays):
+    """インデックスの配列を1つのファイルに書き出す（書き込み途中のファイルは読まれない）"""
+    digest = hashlib.blake2b(digest_size=8)
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = [array.dtype.str, offset, int(array.size)]
+        offset += -(-array.nbytes // 8) * 8
+        digest.update(array.tobytes())
+
+    header = json.dumps(
+        {"version": INDEX_VERSION, "fingerprint": digest.hexdigest(), "arrays": layout}
+    ).encode("utf-8")
+    # 配列の本体が8バイト境界から始まるようにヘッダーを埋める
+    header += b" " * (-(len(INDEX_MAGIC) + 4 + len(header)) % 8)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data)
+            f.write(b"\0" * (-len(data) % 8))
+    os.replace(tmp_path, path)
+
+
+class SynonymIndex:
+    """メモリマップしたインデックスファイルから同義語を引く"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"同義語インデックスのファイルではありません: {path}")
+        (header_size,) = struct.unpack_from("<I", self._mmap, len(INDEX_MAGIC))
+        data_start = len(INDEX_MAGIC) + 4 + header_size
+        header = json.loads(self._mmap[len(INDEX_MAGIC) + 4 : data_start])
+        if header["version"] != INDEX_VERSION:
+            raise ValueError(f"同義語インデックスの形式が異なります: {header['version']}")
+        self.fingerprint = header["fingerprint"]
+
+        arrays = {
+            name: np.frombuffer(self._mmap, dtype=dtype, count=count, offset=data_start + offset)
+            for name, (dtype, offset, count) in header["arrays"].items()
+        }
+        self._hashes = arrays["hashes"]
+        self._slots = arrays["slots"]
+        self._mask = len(self._slots) - 1
+        self._word_bytes = arrays["word_bytes"]
+        self._word_offsets = arrays["word_offsets"]
+        self._reading_bytes = arrays["reading_bytes"]
+        self._reading_offsets = arrays["reading_offsets"]
+        self._synonym_offsets = arrays["synonym_offsets"]
+        self._synonym_ids = arrays["synonym_ids"]
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _string(self, data, offsets, i):
+        return data[offsets[i] : offsets[i + 1]].tobytes().decode("utf-8")
+
+    def word(self, i):
+        return self._string(self._word_bytes, self._word_offsets, i)
+
+    def reading(self, i):
+        return self._string(self._reading_bytes, self._reading_offsets, i)
+
+    def find(self, word):
+        """見出し語の番号を返す（ない場合は -1）"""
+        h = _hash(word)
+        slot = h & self._mask
+        while True:
+            i = int(self._slots[slot])
+            if i < 0:
+                return -1
+            if int(self._hashes[i]) == h and self.word(i) == word:
+                return i
+            slot = (slot + 1) & self._mask
+
+    def synonyms(self, word):
+        """同義語の (単語, 読み) のリストを辞書に現れた順に返す（見出し語にない場合は空）"""
+        i = self.find(word)
+        if i < 0:
+            return []
+        ids = self._synonym_ids[self._synonym_offsets[i] : self._synonym_offsets[i + 1]]
+        return [(self.word(j), self.reading(j)) for j in ids.tolist()]
+
+
+def load_synonym_index(path):
+    """インデックスファイルを開く（ファイルがない・開けない場合はNone）"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        index = SynonymIndex(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"同義語インデックスを開けませんでした: {e}")
+        return None
+    logger.info(f"同義語インデックスを読み込みました: {path}（{len(index)}語）")
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("thesaurus", help="類義語辞書のファイル")
+    parser.add_argument("-o", "--output", required=True, help="出力するインデックスファイル")
+    parser.add_argument(
+        "--format", choices=THESAURUS_FORMATS, default="groups", help="類義語辞書の形式"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    # 読みの取得にはMeCabだけを使う（BERTモデルはロードしない）
+    import nlp_utils
+
+    groups = list(read_thesaurus(args.thesaurus, args.format))
+    arrays = build_synonym_index(groups, nlp_utils.analyze_words)
+    write_synonym_index(args.output, arrays)
+    logger.info(
+        f"{len(groups)}グループ・{len(arrays['hashes'])}語の同義語インデックスを作成しました: "
+        f"{args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import alternatives_cache  # noqa: E402
+
+
+def test_make_key_normalizes_context_and_preferences():
+    """空白・全角半角の揺れや設定の順序が違っても同じキーになるかのテスト"""
+    key = alternatives_cache.make_key(
+        "今日は 学校に行きます", "学校", difficult_sounds=["き", "し"]
+    )
+    assert key == alternatives_cache.make_key(
+        "今日は　学校に行きます", "学校", difficult_sounds=["し", "き"]
+    )
+    assert key != alternatives_cache.make_key(
+        "今日は 学校に行きます", "学校", difficult_sounds=["き"]
+    )
+
+
+def test_concurrent_misses_are_coalesced(tmp_path):
+    """同じキーの同時のミスが一度の計算にまとめられ、SQLiteから復元できるかのテスト"""
+    db_path = str(tmp_path / "cache.db")
+    cache = alternatives_cache.AlternativesCache(db_path=db_path)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"word": "学校", "alternatives": []}
+
+    async def run():
+        return await asyncio.gather(
+            *[cache.get_or_compute("key", compute) for _ in range(5)]
+        )
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result == results[0] for result in results)
+    assert cache.stats["misses"] == 1
+    assert cache.stats["coalesced"] == 4
+
+    # 再起動後もSQLiteから取得できること
+    restarted = alternatives_cache.AlternativesCache(db_path=db_path)
+    assert asyncio.run(restarted.get_or_compute("key", compute)) == results[0]
+    assert len(calls) == 1
+    assert restarted.stats["db_hits"] == 1
+
+
+def test_key_follows_model_context_window():
+    """キーがBERTに入力する文脈の範囲で決まり、範囲外の違いは無視されるかのテスト"""
+    import nlp_utils
+
+    def key(text):
+        start, window = nlp_utils.find_context_window(text, "学校")
+        return alternatives_cache.make_key(text, "学校", start=start, window=window)
+
+    # 対象の文の中で、対象単語から64文字より前の違いはキーに反映される
+    long_sentence = "あ" * 100 + "ので学校に行きます。"
+    assert key(long_sentence) != key("い" + long_sentence[1:])
+
+    # 前後 MLM_CONTEXT_SENTENCES 文より外の違いは反映されない
+    before = "昨日は雨でした。" * (nlp_utils.MLM_CONTEXT_SENTENCES + 1)
+    text = before + "今日は学校に行きます。"
+    assert key(text) == key("一昨日" + text)
+
+
+def test_cancelled_caller_does_not_cancel_coalesced_callers():
+    """最初の呼び出し元がキャンセルされても、相乗りした呼び出しが結果を受け取れるかのテスト"""
+    cache = alternatives_cache.AlternativesCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"word": "学校", "alternatives": []}
+
+    async def run():
+        leader = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower, leader.cancelled()
+
+    result, leader_cancelled = asyncio.run(run())
+    assert leader_cancelled
+    assert result == {"word": "学校", "alternatives": []}
+    assert len(calls) == 1
+    assert cache.contains("key")
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulk_analyze  # noqa: E402
+
+
+def test_split_paragraphs():
+    """空行で段落が区切られるかのテスト"""
+    text = "一行目です。\n二行目です。\n\n\n次の段落です。\n"
+    assert bulk_analyze.split_paragraphs(text) == [
+        (0, "一行目です。\n二行目です。"),
+        (1, "次の段落です。"),
+    ]
+
+
+def test_load_completed_truncates_partial_line(tmp_path):
+    """中断で途中まで書かれた行を切り詰め、出力済みの段落だけを返すかのテスト"""
+    key = bulk_analyze.paragraph_key("a.txt", 0, "吃音症は言語障害の一種です。")
+    record = {"path": key[0], "paragraph": key[1], "sha1": key[2], "words": []}
+    output = tmp_path / "out.jsonl"
+    output.write_text(json.dumps(record) + "\n" + '{"path": "a.txt", "para', encoding="utf-8")
+
+    assert bulk_analyze.load_completed(str(output)) == {key}
+    assert output.read_text(encoding="utf-8") == json.dumps(record) + "\n"
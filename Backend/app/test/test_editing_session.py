@@ -0,0 +1,101 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import editing_session  # noqa: E402
+import nlp_utils  # noqa: E402
+
+
+TEST_TEXT = "今日は学校に行きます。吃音症は言語障害の一種です。"
+
+
+def _apply_delta(highlights, delta):
+    """クライアントと同じ手順で差分を適用する"""
+    highlights = {h["id"]: dict(h) for h in highlights}
+    for shift in delta["shifts"]:
+        for highlight in highlights.values():
+            if highlight["start"] >= shift["at"]:
+                highlight["start"] += shift["delta"]
+                highlight["end"] += shift["delta"]
+    for highlight_id in delta["removed"]:
+        del highlights[highlight_id]
+    for highlight in delta["added"]:
+        highlights[highlight["id"]] = dict(highlight)
+    return list(highlights.values())
+
+
+def test_deltas_match_full_analysis():
+    """差分を適用したハイライトが、編集後の文書の全体解析と一致するかのテスト"""
+    session = editing_session.EditingSession()
+    highlights = session.reset(TEST_TEXT, ["き", "が"])
+
+    edits = [
+        [{"start": 0, "end": 2, "text": "明日"}],
+        [{"start": 11, "end": 11, "text": "きっと"}],
+        [{"start": 3, "end": 5, "text": "会社"}, {"start": 0, "end": 0, "text": "北の"}],
+    ]
+    for edit in edits:
+        session.apply_edits(edit)
+        highlights = _apply_delta(highlights, session.refresh())
+
+        expected = nlp_utils.get_difficult_words(session.text, 0.5, ["き", "が"])
+        assert sorted((h["start"], h["end"], h["word"]) for h in highlights) == sorted(
+            (w["start"], w["end"], w["word"]) for w in expected
+        )
+        for highlight in highlights:
+            assert session.text[highlight["start"] : highlight["end"]] == highlight["word"]
+
+
+def test_invalid_edit_is_rejected():
+    """文書の範囲外の編集操作が拒否されるかのテスト"""
+    session = editing_session.EditingSession()
+    session.reset(TEST_TEXT)
+    with pytest.raises(editing_session.EditError):
+        session.apply_edits([{"start": 0, "end": len(TEST_TEXT) + 1, "text": ""}])
+
+
+def test_fields_with_wrong_types_are_rejected():
+    """型の異なるフィールドが EditError として拒否され、文書が変わらないかのテスト"""
+    session = editing_session.EditingSession()
+    session.reset(TEST_TEXT)
+    invalid_calls = [
+        lambda: session.apply_edits(5),
+        lambda: session.apply_edits([{"start": "0", "end": 1, "text": ""}]),
+        lambda: session.apply_edits([{"start": 0, "end": 1, "text": None}]),
+        lambda: session.apply_edits(["edit"]),
+        lambda: session.reset(123),
+        lambda: session.reset("き", difficulty_threshold="x"),
+        lambda: session.set_options(difficult_sounds="き"),
+        lambda: session.set_options(easy_pronunciations=[1]),
+        lambda: editing_session.check_message({"version": "1"}),
+        lambda: editing_session.check_message({"profile_id": 1}),
+    ]
+    for call in invalid_calls:
+        with pytest.raises(editing_session.EditError):
+            call()
+    assert session.text == TEST_TEXT
+
+
+def test_websocket_replies_error_for_wrong_types():
+    """型の異なるメッセージにエラーを返し、接続を保ったまま次のメッセージを処理するかのテスト"""
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app).websocket_connect("/ws/edit-session") as websocket:
+        for message in [
+            {"type": "edit", "edits": 5, "version": 1},
+            {"type": "init", "text": 123, "version": 2},
+            {"type": "init", "text": "き", "difficulty_threshold": "x", "version": 3},
+            {"type": "init", "text": "き", "version": "4"},
+        ]:
+            websocket.send_json(message)
+            reply = websocket.receive_json()
+            assert reply["type"] == "error"
+            assert reply["version"] == (None if message["version"] == "4" else message["version"])
+
+        websocket.send_json({"type": "init", "text": TEST_TEXT, "version": 5})
+        assert websocket.receive_json()["type"] == "snapshot"
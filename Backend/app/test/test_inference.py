@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import inference  # noqa: E402
+
+
+def test_executor_runs_higher_priority_first():
+    executor = inference.InferenceExecutor("test", 1, 8)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def block():
+        started.set()
+        release.wait()
+
+    # 1件目の実行中に積んだ処理は、優先度の順に実行される
+    executor.submit(block)
+    started.wait()
+    futures = [
+        executor.submit(order.append, "prefetch", priority=inference.PRIORITY_PREFETCH),
+        executor.submit(order.append, "bulk", priority=inference.PRIORITY_BULK),
+        executor.submit(order.append, "interactive", priority=inference.PRIORITY_INTERACTIVE),
+    ]
+    release.set()
+    for future in futures:
+        future.result(timeout=1)
+    executor.shutdown()
+
+    assert order == ["interactive", "bulk", "prefetch"]
+    assert executor.pending == 0
+
+
+def test_superseded_requests_are_not_run():
+    registry = inference.VersionRegistry(max_clients=8)
+    executor = inference.InferenceExecutor("test", 1, 8)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def block():
+        started.set()
+        release.wait()
+
+    old = registry.issue("client", "analyze", 1)
+    executor.submit(block)
+    started.wait()
+    stale = executor.submit(calls.append, 1, token=old)
+
+    # 新しいバージョンが届くと、待機中の古いバージョンの処理は実行されない
+    new = registry.issue("client", "analyze", 2)
+    current = executor.submit(calls.append, 2, token=new)
+    release.set()
+
+    with pytest.raises(inference.SupersededError):
+        stale.result(timeout=1)
+    current.result(timeout=1)
+    executor.shutdown()
+    assert calls == [2]
+
+    # 遅れて届いた古いバージョンのリクエストは受け付けない
+    with pytest.raises(inference.SupersededError):
+        registry.issue("client", "analyze", 1)
+    # 別のクライアント・別の種類のリクエストには影響しない
+    assert not registry.issue("other", "analyze", 1).superseded
+    assert not registry.issue("client", "alternatives", 1).superseded
+    assert registry.issue(None, "analyze", 3) is None
+
+
+def test_mlm_batches_run_on_model_executor(monkeypatch):
+    import batching
+    import nlp_utils
+
+    executor = inference.InferenceExecutor("test", 1, 8)
+    monkeypatch.setattr(inference, "model_executor", executor)
+    submitted = []
+    submit = executor.submit
+
+    def record_submit(fn, *args, priority=inference.PRIORITY_INTERACTIVE, **kwargs):
+        submitted.append((threading.current_thread().name, priority))
+        return submit(fn, *args, priority=priority, **kwargs)
+
+    monkeypatch.setattr(executor, "submit", record_submit)
+    monkeypatch.setattr(
+        nlp_utils,
+        "generate_alternatives_with_mlm_batch",
+        lambda items: [[{"word": item[1]}] for item in items],
+    )
+
+    # バッチはエグゼキュータ上で、バッチ内で最も高い優先度で実行される
+    batcher = batching.MLMBatcher(max_batch_size=4, max_wait_ms=50, max_queue_size=8)
+    prefetch = batcher.submit("文", "先読み", priority=inference.PRIORITY_PREFETCH)
+    popover = batcher.submit("文", "単語", priority=inference.PRIORITY_INTERACTIVE)
+    assert popover.result(timeout=1) == [{"word": "単語"}]
+    assert prefetch.result(timeout=1) == [{"word": "先読み"}]
+    executor.shutdown()
+
+    assert submitted == [("mlm-batcher", inference.PRIORITY_INTERACTIVE)]
+
+
+def test_interactive_request_runs_between_bulk_chunks(monkeypatch):
+    import asyncio
+    import time
+
+    import main
+    import nlp_utils
+
+    executor = inference.InferenceExecutor("test", 1, 8)
+    monkeypatch.setattr(inference, "model_executor", executor)
+    monkeypatch.setattr(main, "BULK_ALTERNATIVES_CHUNK_SPANS", 2)
+    chunks = []
+
+    def slow_mlm_spans(items):
+        chunks.append(len(items))
+        time.sleep(0.05)
+        return [[] for _ in items]
+
+    monkeypatch.setattr(nlp_utils, "generate_alternatives_with_mlm_spans", slow_mlm_spans)
+    request = main.BulkAlternativesRequest(
+        text="あいうえおかきくけこ", spans=[{"start": i, "end": i + 1} for i in range(8)]
+    )
+    finished = []
+
+    async def bulk():
+        await main._generate_bulk_alternatives(request)
+        finished.append("bulk")
+
+    async def interactive():
+        # 最初のチャンクの実行中に届いたポップオーバーの処理は、残りのチャンクより先に実行される
+        await asyncio.sleep(0.02)
+        await executor.run(lambda: None)
+        finished.append("interactive")
+
+    async def scenario():
+        await asyncio.gather(bulk(), interactive())
+
+    asyncio.run(scenario())
+    executor.shutdown()
+
+    assert chunks == [2, 2, 2, 2]
+    assert finished == ["interactive", "bulk"]
@@ -0,0 +1,132 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nlp_utils  # noqa: E402
+
+
+TEST_TEXT = "吃音症は言語障害の一種です。人前で話すのは緊張します。\n発表の練習をしました。"
+
+
+def test_split_segments():
+    """文分割のテスト"""
+    segments = nlp_utils.split_segments(TEST_TEXT)
+    assert "".join(segment for _, segment in segments) == TEST_TEXT
+    for start, segment in segments:
+        assert TEST_TEXT[start : start + len(segment)] == segment
+
+
+def test_incremental_analysis_matches_full_analysis():
+    """文単位キャッシュを使った解析結果のオフセットが元のテキストと一致するかのテスト"""
+    words = nlp_utils.analyze_morphology_incremental(TEST_TEXT)
+    assert words
+    for index, word_info in enumerate(words):
+        assert word_info["position"] == index
+        assert TEST_TEXT[word_info["start"] : word_info["end"]] == word_info["surface"]
+
+    # 一文だけ変更しても、結果が全体解析と一致すること
+    edited = TEST_TEXT.replace("緊張", "不安に")
+    incremental = nlp_utils.analyze_morphology_incremental(edited)
+    full = nlp_utils.analyze_morphology(edited)
+    assert [(w["surface"], w["start"], w["end"]) for w in incremental] == [
+        (w["surface"], w["start"], w["end"]) for w in full
+    ]
+
+
+def test_token_table_shared_by_consumers():
+    """トークン表を難しい単語の検出と読みの取得で共有できるかのテスト"""
+    table = nlp_utils.analyze_text(TEST_TEXT)
+    assert len(table) == len(nlp_utils.analyze_morphology_incremental(TEST_TEXT))
+
+    difficult_words = nlp_utils.get_difficult_words(
+        TEST_TEXT, 0.5, ["き"], table=table
+    )
+    for word_info in difficult_words:
+        assert word_info["reading"].startswith("キ")
+
+    pronunciation = nlp_utils.get_pronunciation(TEST_TEXT, table=table)
+    assert pronunciation
+    assert "。" not in pronunciation
+
+
+def test_context_window_is_centered_on_target():
+    """文脈の範囲が対象の文と前後の文に限られ、長い文書でも一定の長さになるかのテスト"""
+    long_text = TEST_TEXT * 200
+    start = long_text.index("人前", len(TEST_TEXT) * 100)
+    end = start + len("人前")
+
+    window_start, window_end = nlp_utils._context_window(long_text, start, end, sentences=1)
+    assert window_start <= start and end <= window_end
+    assert long_text[window_start:window_end] == "吃音症は言語障害の一種です。人前で話すのは緊張します。\n発表の練習をしました。"
+
+
+def test_parallel_analysis_matches_sequential_analysis(monkeypatch):
+    """文を分けて複数のスレッドで解析した結果が、順に解析した結果と一致するかのテスト"""
+    text = "".join(f"{i}番目の文を解析します。" for i in range(40)) + TEST_TEXT
+    sequential = nlp_utils.analyze_morphology(text)
+
+    nlp_utils._segment_cache.clear()
+    monkeypatch.setattr(nlp_utils, "MECAB_PARALLEL_SEGMENTS", 4)
+    monkeypatch.setattr(nlp_utils.mecab_pool, "size", 4)
+    parallel = nlp_utils.analyze_morphology_incremental(text)
+
+    assert [(w["surface"], w["start"], w["end"], w["reading"]) for w in parallel] == [
+        (w["surface"], w["start"], w["end"], w["reading"]) for w in sequential
+    ]
+    assert nlp_utils.mecab_pool.idle == nlp_utils.mecab_pool.created
+
+
+def test_topk_log_probs_matches_full_softmax():
+    """上位k件だけを正規化した結果が、語彙全体のsoftmaxを取った場合と一致するかのテスト"""
+    import torch
+
+    torch.manual_seed(0)
+    logits = torch.randn(3, 100)
+    blocked = torch.zeros(100, dtype=torch.bool)
+    blocked[torch.topk(logits[0], k=2).indices] = True
+
+    topk_log_probs, topk_indices = nlp_utils._topk_log_probs(logits, 5, blocked)
+
+    expected = torch.log_softmax(logits, dim=-1).masked_fill(blocked, -float("inf"))
+    expected_log_probs, expected_indices = torch.topk(expected, k=5, dim=-1)
+    assert torch.equal(topk_indices, expected_indices)
+    assert torch.allclose(topk_log_probs, expected_log_probs, atol=1e-6)
+
+
+def test_suffix_is_not_merged_across_word_boundaries():
+    """単語のリストの読み取得で、接尾辞が前の単語に結合されないかのテスト"""
+    assert nlp_utils.analyze_words(["学校", "さん"])[0][0] == "ガッコー"
+    readings = nlp_utils.get_readings(["先生", "さん"])
+    assert readings["先生"] == "センセー"
+    assert readings["さん"]
+
+    # 同じテキスト内で隣接する接尾辞は従来どおり結合する
+    assert [w["surface"] for w in nlp_utils.analyze_morphology("田中さん")] == ["田中さん"]
+
+
+def test_model_load_error_is_reported(monkeypatch):
+    """モデルのロード中の例外が記録され、/readyz が503とエラーの内容を返すかのテスト"""
+    import threading
+
+    from fastapi.testclient import TestClient
+
+    import main
+
+    def broken_load_model():
+        raise OSError("モデルが見つかりません")
+
+    monkeypatch.setattr(nlp_utils, "_preloaded", None)
+    monkeypatch.setattr(nlp_utils, "load_model", broken_load_model)
+    monkeypatch.setattr(nlp_utils, "model_state", nlp_utils.MODEL_LOADING)
+    monkeypatch.setattr(nlp_utils, "model_error", None)
+    monkeypatch.setattr(nlp_utils, "_model_ready", threading.Event())
+
+    nlp_utils._load_model_in_background()
+    assert nlp_utils._model_ready.is_set()
+    assert nlp_utils.model_state == nlp_utils.MODEL_FAILED
+
+    response = TestClient(main.app).get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["model"] == nlp_utils.MODEL_FAILED
+    assert "モデルが見つかりません" in response.json()["error"]
@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import phonetics  # noqa: E402
+
+
+def test_normalize_morae():
+    """拗音・促音・長音がモーラ単位にそろえられるかのテスト"""
+    assert phonetics.normalize_morae("きょう") == ["キョ", "ー"]
+    assert phonetics.normalize_morae("キョー") == ["キョ", "ー"]
+    assert phonetics.normalize_morae("センセイ") == ["セ", "ン", "セ", "ー"]
+    assert phonetics.normalize_morae("ガッコー") == ["ガ", "ッ", "コ", "ー"]
+
+
+def test_sound_matcher():
+    """拗音と直音を区別し、位置ごとの重みで照合できるかのテスト"""
+    matcher = phonetics.compile_sound_matcher(["し"])
+    assert matcher.score("シンブン") == phonetics.SOUND_MATCH_DIFFICULTY
+    assert matcher.score("シャシン") == 0.0
+    assert phonetics.compile_sound_matcher(["し"]) is matcher
+
+    matcher = phonetics.compile_sound_matcher(["しゃ", "きょう"], [1.0, 0.5])
+    assert matcher.score("シャシン") == phonetics.SOUND_MATCH_DIFFICULTY
+    assert matcher.score("キョー") == phonetics.SOUND_MATCH_DIFFICULTY
+    assert matcher.score("カイシャ") == 0.0
+    assert matcher.score("アシャ") == phonetics.SOUND_MATCH_DIFFICULTY * 0.5
+    assert matcher.score("キョ") == 0.0
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import alternatives_cache  # noqa: E402
+import inference  # noqa: E402
+import prefetch  # noqa: E402
+
+
+def _compute(calls, key):
+    async def compute(token):
+        calls.append(key)
+        return {"word": key, "alternatives": []}
+
+    return compute
+
+
+def test_prefetch_waits_for_idle_and_skips_cached_keys(monkeypatch):
+    async def scenario():
+        cache = alternatives_cache.AlternativesCache()
+        prefetcher = prefetch.AlternativesPrefetcher(cache, max_queue_size=8, idle_wait_ms=1)
+        calls = []
+        busy = [True]
+        monkeypatch.setattr(prefetch, "_is_idle", lambda: not busy[0])
+
+        prefetcher.schedule([(key, _compute(calls, key)) for key in ["a", "b", "a"]])
+        assert prefetcher.pending == 2
+
+        # 推論が混んでいる間は先読みしない
+        await asyncio.sleep(0.02)
+        assert calls == []
+
+        busy[0] = False
+        await asyncio.sleep(0.02)
+        assert calls == ["a", "b"]
+        assert cache.contains("a") and cache.contains("b")
+
+        # キャッシュ済みのキーは積まない
+        prefetcher.schedule([("a", _compute(calls, "a"))])
+        assert prefetcher.pending == 0
+        assert prefetcher.info()["cached"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_prefetch_queue_drops_oldest_and_runs_newest_first(monkeypatch):
+    async def scenario():
+        cache = alternatives_cache.AlternativesCache()
+        prefetcher = prefetch.AlternativesPrefetcher(cache, max_queue_size=2, idle_wait_ms=1)
+        calls = []
+        busy = [True]
+        monkeypatch.setattr(prefetch, "_is_idle", lambda: not busy[0])
+
+        prefetcher.schedule([("old", _compute(calls, "old"))])
+        prefetcher.schedule([(key, _compute(calls, key)) for key in ["new1", "new2"]])
+        assert prefetcher.info()["dropped"] == 1
+
+        busy[0] = False
+        await asyncio.sleep(0.02)
+        assert calls == ["new1", "new2"]
+
+    asyncio.run(scenario())
+
+
+def test_interactive_request_promotes_in_flight_prefetch(monkeypatch):
+    executor = inference.InferenceExecutor("test", 1, 8)
+    monkeypatch.setattr(inference, "model_executor", executor)
+    monkeypatch.setattr(prefetch, "_is_idle", lambda: True)
+    order = []
+
+    async def scenario():
+        cache = alternatives_cache.AlternativesCache()
+        prefetcher = prefetch.AlternativesPrefetcher(cache, max_queue_size=8, idle_wait_ms=1)
+        started = threading.Event()
+        release = threading.Event()
+        tokens = []
+
+        def block():
+            started.set()
+            release.wait()
+
+        async def slow_prefetch(token):
+            tokens.append(token)
+            return await executor.run(
+                order.append, "prefetch", priority=inference.PRIORITY_PREFETCH, token=token
+            )
+
+        async def interactive():
+            order.append("recomputed")
+
+        # 先読みの推論が待機中の間に、別のポップオーバーの推論が積まれている
+        executor.submit(block)
+        started.wait()
+        prefetcher.schedule([("a", slow_prefetch)])
+        while not tokens:
+            await asyncio.sleep(0.01)
+        other = executor.submit(order.append, "other", priority=inference.PRIORITY_INTERACTIVE)
+
+        # ポップオーバーのリクエストは先読みを昇格させ、計算し直さずにその結果を待つ
+        waiting = asyncio.ensure_future(cache.get_or_compute("a", interactive))
+        await asyncio.sleep(0.01)
+        assert tokens[0].promoted
+        release.set()
+        await waiting
+        other.result(timeout=1)
+        assert cache.info()["promoted"] == 1
+        assert cache.info()["coalesced"] == 1
+
+    asyncio.run(scenario())
+    executor.shutdown()
+
+    # 昇格した先読みは、先に積まれていた同じ優先度の処理の順番で実行される
+    assert order == ["prefetch", "other"]
+
+
+def test_prefetch_keys_match_popover_requests(monkeypatch):
+    import main
+    import nlp_utils
+
+    monkeypatch.setattr(nlp_utils, "is_model_ready", lambda: True)
+    scheduled = []
+    monkeypatch.setattr(
+        prefetch.prefetcher, "schedule", lambda items, token=None: scheduled.extend(items)
+    )
+
+    # 同じ単語でも、離れた位置の出現は別々の文脈で先読みする
+    text = "学校に行きます。" + "今日は晴れです。" * 40 + "学校で勉強します。"
+    second = text.rindex("学校")
+    words = [
+        {"word": "学校", "start": 0, "end": 2},
+        {"word": "学校", "start": second, "end": second + 2},
+    ]
+    main._prefetch_alternatives(text, words, "mlm")
+    assert len(scheduled) == 2
+
+    # WordPopover の getContextWindow と同じテキストを送るポップオーバーのリクエストと同じキーになる
+    before = text[second - 250 : second].strip()
+    after = text[second + 2 : second + 250].strip()
+    popover = main.AlternativesRequest(
+        text=before + "学校" + after, target_word="学校", method="mlm"
+    )
+    assert scheduled[1][0] == main._alternatives_cache_key(popover)
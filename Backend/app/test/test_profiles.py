@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import profiles  # noqa: E402
+
+
+def test_create_is_idempotent_and_compiles_matcher():
+    store = profiles.ProfileStore(max_size=4)
+    profile = store.create(["し", "き"], ["あ"])
+
+    # 音の順序が違っても同じ設定なら同じプロファイルになる
+    assert store.create(["き", "し", "き"], ["あ"]) is profile
+    assert store.get(profile.id) is profile
+    assert len(store) == 1
+
+    assert profile.matcher.score("キモチ") > 0
+    assert profile.matcher.score("シャシン") == 0
+    assert profile.to_dict()["difficult_sounds"] == ["き", "し"]
+
+
+def test_lru_eviction_and_delete():
+    store = profiles.ProfileStore(max_size=2)
+    first = store.create(["し"])
+    second = store.create(["き"])
+
+    # first を参照してから追加すると、最も長く使われていない second が削除される
+    store.get(first.id)
+    third = store.create(["か"])
+    assert len(store) == 2
+    with pytest.raises(profiles.ProfileNotFoundError):
+        store.get(second.id)
+
+    store.delete(third.id)
+    with pytest.raises(profiles.ProfileNotFoundError):
+        store.get(third.id)
+    assert store.get(first.id) is first
+
+
+def test_profile_is_restored_from_id_in_another_process():
+    profile = profiles.ProfileStore(max_size=4).create(["し", "き"], ["あ"], [1.0, 0.5])
+
+    # 別のワーカーのストアでも、IDから同じ設定のプロファイルを作り直せる
+    other = profiles.ProfileStore(max_size=4)
+    restored = other.get_or_restore(profile.id)
+    assert restored.to_dict() == profile.to_dict()
+    assert other.get(profile.id) is restored
+
+    with pytest.raises(profiles.ProfileNotFoundError):
+        other.get_or_restore("not-a-profile")
+    with pytest.raises(profiles.ProfileNotFoundError):
+        other.delete("not-a-profile")
+
+
+def test_delete_endpoint_only_evicts_from_cache():
+    """DELETEがキャッシュからの削除だけを行い、同じIDで引き続き参照できるかのテスト"""
+    from fastapi.testclient import TestClient
+
+    import main
+
+    client = TestClient(main.app)
+    profile_id = client.post("/profiles", json={"difficult_sounds": ["き"]}).json()["profile_id"]
+
+    response = client.delete(f"/profiles/{profile_id}")
+    assert response.status_code == 200
+    assert response.json() == {"status": "evicted"}
+    assert client.get(f"/profiles/{profile_id}").json()["difficult_sounds"] == ["き"]
+    assert client.delete("/profiles/not-a-profile").status_code == 404
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import serve  # noqa: E402
+
+# 起動直後に異常終了するワーカーでマスタープロセスを動かす
+CRASHING_SERVER = """
+import os
+import nlp_utils
+import serve
+
+nlp_utils.preload_model = lambda: False
+serve._run_worker = lambda sock: os._exit(3)
+serve.main()
+"""
+
+
+def test_restart_delay_backs_off_exponentially(monkeypatch):
+    """続けて異常終了するたびに待ち時間が倍になり、上限で止まるかのテスト"""
+    monkeypatch.setattr(serve, "WORKER_RESTART_BACKOFF", 0.5)
+    monkeypatch.setattr(serve, "WORKER_RESTART_BACKOFF_MAX", 3.0)
+    assert [serve.restart_delay(n) for n in range(1, 6)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+
+
+def test_master_exits_when_workers_crash_loop():
+    """ワーカーが落ち続ける場合、マスタープロセスが異常終了するかのテスト"""
+    env = {
+        **os.environ,
+        "HOST": "127.0.0.1",
+        "PORT": "0",
+        "WEB_CONCURRENCY": "2",
+        "WORKER_RESTART_BACKOFF": "0.01",
+        "WORKER_CRASH_LIMIT": "3",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", CRASHING_SERVER],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 1
+    assert "続けて4回異常終了した" in result.stderr
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synonym_index import (  # noqa: E402
+    SynonymIndex,
+    build_synonym_index,
+    read_thesaurus,
+    write_synonym_index,
+)
+
+READINGS = {"始める": "ハジメル", "開始": "カイシ", "スタート": "スタート", "着手": "チャクシュ"}
+
+
+def _analyze_words(words):
+    return [(READINGS.get(word, word), "名詞") for word in words]
+
+
+def test_index_returns_synonyms_with_readings(tmp_path):
+    groups = [["始める", "開始", "スタート"], ["開始", "着手"]]
+    path = str(tmp_path / "synonyms.idx")
+    write_synonym_index(path, build_synonym_index(groups, _analyze_words))
+
+    index = SynonymIndex(path)
+    assert len(index) == 4
+    assert index.synonyms("開始") == [
+        ("始める", "ハジメル"),
+        ("スタート", "スタート"),
+        ("着手", "チャクシュ"),
+    ]
+    assert index.synonyms("着手") == [("開始", "カイシ")]
+    assert index.synonyms("終了") == []
+    assert index.find("終了") == -1
+
+    # 内容が同じなら指紋も同じ（代替案キャッシュのキーに使う）
+    other_path = str(tmp_path / "other.idx")
+    write_synonym_index(other_path, build_synonym_index(groups, _analyze_words))
+    assert SynonymIndex(other_path).fingerprint == index.fingerprint
+
+
+def test_read_thesaurus_formats(tmp_path):
+    groups_path = tmp_path / "groups.txt"
+    groups_path.write_text("# コメント\n始める\t開始,スタート\n\n単独\n", encoding="utf-8")
+    assert list(read_thesaurus(str(groups_path))) == [["始める", "開始", "スタート"]]
+
+    sudachi_path = tmp_path / "synonyms.txt"
+    sudachi_path.write_text(
+        "000001,1,0,1,0,0,0,(),開始,,\n"
+        "000001,1,0,1,0,0,2,(),スタート,,\n"
+        "\n"
+        "000002,1,0,1,0,0,0,(),終了,,\n",
+        encoding="utf-8",
+    )
+    assert list(read_thesaurus(str(sudachi_path), "sudachi")) == [["開始", "スタート"]]
@@ -0,0 +1,52 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tagger_pool import TaggerPool  # noqa: E402
+
+
+def test_checkout_creates_taggers_lazily_up_to_size():
+    pool = TaggerPool(object, size=2)
+    assert pool.created == 0
+
+    with pool.checkout() as first:
+        with pool.checkout() as second:
+            assert first is not second
+            assert pool.created == 2
+
+            # 全て貸し出し中の場合は返却されるまで待つ
+            acquired = []
+            waiter = threading.Thread(
+                target=lambda: acquired.append(pool.checkout().__enter__())
+            )
+            waiter.start()
+            waiter.join(timeout=0.1)
+            assert waiter.is_alive()
+        waiter.join(timeout=1)
+        assert acquired == [second]
+
+    assert pool.created == 2
+
+
+def test_factory_error_does_not_consume_capacity():
+    calls = []
+
+    def factory():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("初期化に失敗")
+        return object()
+
+    pool = TaggerPool(factory, size=1)
+    try:
+        with pool.checkout():
+            pass
+    except RuntimeError:
+        pass
+    assert pool.created == 0
+
+    with pool.checkout() as tagger:
+        assert tagger is not None
+    assert pool.created == 1
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vocab_index  # noqa: E402
+from vocab_index import POS_CLASS_CONTENT, VocabIndex  # noqa: E402
+
+
+def _index():
+    readings = np.array(["シアイ", "キモチ", "ハナシ"])
+    return VocabIndex(
+        readings,
+        np.array(["シ", "キ", "ハ"]),
+        np.full(3, POS_CLASS_CONTENT, dtype=np.int8),
+        np.zeros(3, dtype=bool),
+        np.zeros(3, dtype=bool),
+    )
+
+
+def test_blocked_mask_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(vocab_index, "BLOCKED_MASK_CACHE_SIZE", 2)
+    index = _index()
+
+    assert index.blocked_mask(["し"]).tolist() == [True, False, False]
+    index.blocked_mask(["き"])
+    index.blocked_mask(["し"])
+    index.blocked_mask(["は"])
+
+    # 最も長く使われていない「き」のマスクから削除される
+    assert set(index._blocked_cache) == {frozenset(["し"]), frozenset(["は"])}
@@ -0,0 +1,228 @@
+"""
+BERTの語彙に対する読み・先頭モーラ・品詞クラス・サブワードフラグのインデックス
+MLMのロジットからTop-kを取る前に、苦手な音で始まる候補や単語として不適切な候補を除外するために使う
+"""
+
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from phonetics import compile_sound_matcher, first_mora
+
+logger = logging.getLogger(__name__)
+
+# インデックスのファイル形式のバージョン（形式や読みの取得方法を変えたら上げる）
+INDEX_VERSION = 2
+
+# 苦手な音のセットごとの除外マスクを保持する最大数（超えた場合は最も長く使われていないものから削除する）
+BLOCKED_MASK_CACHE_SIZE = int(os.environ.get("BLOCKED_MASK_CACHE_SIZE", "256"))
+
+# 品詞クラス
+POS_CLASS_OTHER = 0
+POS_CLASS_CONTENT = 1  # 内容語（代替案の候補になる）
+POS_CLASS_FUNCTION = 2  # 機能語
+POS_CLASS_SYMBOL = 3  # 記号・空白
+
+CONTENT_POS = (
+    "名詞",
+    "代名詞",
+    "動詞",
+    "形容詞",
+    "形状詞",
+    "副詞",
+    "連体詞",
+    "接続詞",
+    "感動詞",
+)
+FUNCTION_POS = ("助詞", "助動詞", "接頭辞", "接尾辞")
+SYMBOL_POS = ("補助記号", "記号", "空白")
+
+
+def classify_pos(pos):
+    """品詞名を品詞クラスに分類する"""
+    if pos in CONTENT_POS:
+        return POS_CLASS_CONTENT
+    if pos in FUNCTION_POS:
+        return POS_CLASS_FUNCTION
+    if pos in SYMBOL_POS:
+        return POS_CLASS_SYMBOL
+    return POS_CLASS_OTHER
+
+
+class VocabIndex:
+    """
+    語彙ID順に並んだ配列で各トークンの情報を保持する
+    - readings: 読み（カタカナ）
+    - first_morae: 読みの先頭モーラ
+    - pos_classes: 品詞クラス
+    - is_subword: サブワード（##で始まる）かどうか
+    - is_special: 特殊トークンかどうか
+    """
+
+    def __init__(self, readings, first_morae, pos_classes, is_subword, is_special):
+        self.readings = readings
+        self.first_morae = first_morae
+        self.pos_classes = pos_classes
+        self.is_subword = is_subword
+        self.is_special = is_special
+
+        # 単語として代替案になりうるトークン
+        self.word_mask = (
+            ~is_subword & ~is_special & (pos_classes == POS_CLASS_CONTENT)
+        )
+
+        # 複数トークンからなる単語の2番目以降に置けないトークン（特殊トークン・記号）
+        self.continuation_blocked = is_special | (pos_classes == POS_CLASS_SYMBOL)
+
+        self._blocked_cache = OrderedDict()
+        # 発音プロファイルが保持している除外マスク（プロファイルが削除されると消える）
+        self._pinned_masks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.readings)
+
+    def blocked_mask(self, difficult_sounds=None):
+        """
+        代替案から除外するトークンのブールマスクを返す（Trueが除外）
+        苦手な音のセットごとに、最大 BLOCKED_MASK_CACHE_SIZE 個までキャッシュする
+        """
+        key = frozenset(difficult_sounds or ())
+        with self._lock:
+            blocked = self._pinned_masks.get(key)
+            if blocked is not None:
+                return blocked
+            blocked = self._blocked_cache.get(key)
+            if blocked is not None:
+                self._blocked_cache.move_to_end(key)
+                return blocked
+
+        blocked = self.compute_blocked_mask(key)
+        with self._lock:
+            self._blocked_cache[key] = blocked
+            while len(self._blocked_cache) > BLOCKED_MASK_CACHE_SIZE:
+                self._blocked_cache.popitem(last=False)
+        return blocked
+
+    def pin_blocked_mask(self, difficult_sounds=None):
+        """
+        除外マスクを作成して返す（呼び出し側が参照を保持している間は blocked_mask が再利用する）
+        LRUのキャッシュには入れないため、参照がなくなればメモリから解放される
+        """
+        key = frozenset(difficult_sounds or ())
+        with self._lock:
+            blocked = self._pinned_masks.get(key)
+        if blocked is None:
+            blocked = self.compute_blocked_mask(key)
+            with self._lock:
+                blocked = self._pinned_masks.setdefault(key, blocked)
+        return blocked
+
+    def compute_blocked_mask(self, difficult_sounds=None):
+        """除外マスクをキャッシュを使わずに作成する"""
+        key = frozenset(difficult_sounds or ())
+
+        allowed = self.word_mask.copy()
+        matcher = compile_sound_matcher(key)
+        if matcher:
+            # 候補になりうるトークンの読みだけを、重複を除いてモーラ単位で照合する
+            # （シ と シャ を区別し、キョウ と キョー を同じ音として扱う）
+            candidates = np.flatnonzero(allowed)
+            unique_readings, inverse = np.unique(
+                self.readings[candidates], return_inverse=True
+            )
+            starts_with_sound = np.array(
+                [score > 0.0 for score in matcher.scores(unique_readings.tolist())],
+                dtype=bool,
+            )
+            allowed[candidates[starts_with_sound[inverse]]] = False
+
+        return ~allowed
+
+    def save(self, path, model_name):
+        """インデックスをファイルに保存する"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            readings=self.readings,
+            first_morae=self.first_morae,
+            pos_classes=self.pos_classes,
+            is_subword=self.is_subword,
+            is_special=self.is_special,
+            meta=np.array([model_name, str(len(self)), str(INDEX_VERSION)]),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, model_name, vocab_size):
+        """保存済みのインデックスを読み込む（モデルや形式が一致しない場合はNone）"""
+        with np.load(path, allow_pickle=False) as data:
+            meta = data["meta"].tolist()
+            if meta != [model_name, str(vocab_size), str(INDEX_VERSION)]:
+                return None
+            return cls(
+                data["readings"],
+                data["first_morae"],
+                data["pos_classes"],
+                data["is_subword"],
+                data["is_special"],
+            )
+
+
+def build_vocab_index(tokenizer, analyze_words):
+    """
+    トークナイザの語彙全体を形態素解析してインデックスを作成する
+    analyze_words: 単語のリストから (読み, 品詞名) のリストを返す関数
+    """
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    special_ids = set(tokenizer.all_special_ids)
+
+    is_subword = np.array([token.startswith("##") for token in tokens], dtype=bool)
+    is_special = np.array([i in special_ids for i in range(len(tokens))], dtype=bool)
+
+    surfaces = []
+    for token, subword in zip(tokens, is_subword):
+        surface = token[2:] if subword else token
+        # 空白を含むトークンは単語の区切りを壊すため解析しない
+        if not surface or any(char.isspace() for char in surface):
+            surface = ""
+        surfaces.append(surface)
+
+    analyzed = analyze_words(surfaces)
+
+    readings = np.array([reading for reading, _ in analyzed], dtype=str)
+    first_morae = np.array([first_mora(reading) for reading, _ in analyzed], dtype=str)
+    pos_classes = np.array([classify_pos(pos) for _, pos in analyzed], dtype=np.int8)
+
+    return VocabIndex(readings, first_morae, pos_classes, is_subword, is_special)
+
+
+def load_or_build_vocab_index(tokenizer, model_name, path, analyze_words):
+    """キャッシュファイルがあれば読み込み、なければ作成して保存する"""
+    vocab_size = len(tokenizer)
+
+    if path and os.path.exists(path):
+        try:
+            index = VocabIndex.load(path, model_name, vocab_size)
+            if index is not None:
+                logger.info(f"語彙インデックスを読み込みました: {path}")
+                return index
+        except Exception as e:
+            logger.warning(f"語彙インデックスの読み込みに失敗しました: {e}")
+
+    logger.info("語彙インデックスを作成中...")
+    index = build_vocab_index(tokenizer, analyze_words)
+    logger.info(f"語彙インデックスを作成しました（{len(index)}語）")
+
+    if path:
+        try:
+            index.save(path, model_name)
+        except OSError as e:
+            logger.warning(f"語彙インデックスを保存できませんでした: {e}")
+
+    return index
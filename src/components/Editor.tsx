@@ -2,7 +2,7 @@ import React, { useState, useRef, useEffect, useCallback } from 'react';
 import { Editor as DraftEditor, EditorState, ContentState, CompositeDecorator, Modifier, SelectionState, ContentBlock } from 'draft-js';
 import 'draft-js/dist/Draft.css';
 import WordPopover from './WordPopover';
-import { analyzeRealtime } from '../services/apiService';
+import { analyzeRealtime, EditingSession, SessionHighlight } from '../services/apiService';
 import debounce from 'lodash/debounce';
 
 interface DifficultWordSpanProps {
@@ -15,6 +15,7 @@ interface DifficultWordSpanProps {
   onSelectAlternative: (alternative: string) => void;
   contentState: ContentState;
   easyPronunciations?: string[]; // ユーザーが発音しやすい音のリスト
+  difficultPronunciations?: string[]; // ユーザーが苦手な音のリスト
 }
 
 interface EditorProps {
@@ -127,6 +128,7 @@ const DifficultWordSpan: React.FC<DifficultWordSpanProps> = (props) => {
           onSelect={handleSelectAlternative}
           onIgnore={() => setShowPopover(false)}
           easyPronunciations={props.easyPronunciations}
+          difficultPronunciations={props.difficultPronunciations}
         />
       )}
     </span>
@@ -227,6 +229,8 @@ const Editor: React.FC<EditorProps> = ({
   // 代替案選択で除外された位置のリスト（永続的除外）
   const [excludedPositions, setExcludedPositions] = useState<Set<string>>(new Set());
   const editorRef = useRef<DraftEditor>(null);
+  // 編集セッション（接続できない場合はHTTPのリアルタイム分析を使う）
+  const sessionRef = useRef<EditingSession | null>(null);
 
   // 位置ベースで除外する関数（代替案選択後の永続的除外）
   const addExcludedPosition = useCallback((start: number, end: number): void => {
@@ -290,6 +294,7 @@ const Editor: React.FC<EditorProps> = ({
             {...props}
             currentText={currentText}
             easyPronunciations={easyPronunciations}
+            difficultPronunciations={difficultPronunciations}
             onSelectAlternative={(alternative: string) => {
               if (alternative === 'ignore') {
                 onAddEasyWord(props.decoratedText);
@@ -305,7 +310,7 @@ const Editor: React.FC<EditorProps> = ({
       },
     ]);
   // eslint-disable-next-line react-hooks/exhaustive-deps
-  }, [hardWords, ignoredWords, excludedPositions, easyPronunciations]);
+  }, [hardWords, ignoredWords, excludedPositions, easyPronunciations, difficultPronunciations]);
 
   const [editorState, setEditorState] = useState<EditorState>(() => {
     // 初期状態
@@ -319,7 +324,14 @@ const Editor: React.FC<EditorProps> = ({
 
   // リアルタイム分析のための関数
   const analyzeText = useCallback(async (text: string) => {
-    if (!text || text.trim() === '' || isAnalyzing) return;
+    // 編集セッションが使える場合は変更部分だけを送り、ハイライトの差分を受け取る
+    if (sessionRef.current && sessionRef.current.isOpen()) {
+      sessionRef.current.syncText(text, difficultPronunciations, easyPronunciations);
+      return;
+    }
+
+    // 分析中でも最新のテキストを送る（古いバージョンの分析はサーバーが打ち切り、結果は null になる）
+    if (!text || text.trim() === '') return;
 
     try {
       setIsAnalyzing(true);
@@ -426,11 +438,29 @@ const Editor: React.FC<EditorProps> = ({
   }, [handleCompositionStart, handleCompositionEnd]);
 
 
-  // 初期テキストの分析を実行
+  // 初期テキストの分析を実行（編集セッションに接続できた場合は文書全体を送る）
   useEffect(() => {
-    if (currentText) {
-      analyzeText(currentText);
-    }
+    const session = new EditingSession((words: SessionHighlight[]) => {
+      setHardWords(words.map(({ word, start, end, reason, reading }) => ({
+        word, start, end, reason, reading
+      })));
+    });
+
+    session.open(currentText, difficultPronunciations, easyPronunciations)
+      .then(() => {
+        sessionRef.current = session;
+      })
+      .catch(() => {
+        console.warn('編集セッションに接続できないため、HTTPで分析します');
+        if (currentText) {
+          analyzeText(currentText);
+        }
+      });
+
+    return () => {
+      session.close();
+      sessionRef.current = null;
+    };
   // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []); // 初回のみ実行
 
@@ -17,10 +17,11 @@ interface WordPopoverProps {
   onMouseEnter?: (e: MouseEvent<HTMLDivElement>) => void;
   onMouseLeave?: (e: MouseEvent<HTMLDivElement>) => void;
   easyPronunciations?: string[];  // ユーザーが発音しやすい音のリスト
+  difficultPronunciations?: string[];  // ユーザーが苦手な音のリスト
 }
 
 const WordPopover = forwardRef((
-  { word, position, currentText, textPosition, onSelect, onIgnore, onMouseEnter, onMouseLeave, easyPronunciations }: WordPopoverProps,
+  { word, position, currentText, textPosition, onSelect, onIgnore, onMouseEnter, onMouseLeave, easyPronunciations, difficultPronunciations }: WordPopoverProps,
   ref: Ref<HTMLDivElement>
 ) => {
   const [alternatives, setAlternatives] = useState<{word: string, reading?: string}[]>([]);
@@ -73,11 +74,11 @@ const WordPopover = forwardRef((
           currentText,
           textPosition.start,
           textPosition.end,
-          250
+          250 // サーバーの先読み（POPOVER_CONTEXT_CHARS）と揃える
         );
         const contextText = beforeContext + word + afterContext;
         console.log('contextText', beforeContext, word, afterContext);
-        const result = await getSmartAlternatives(contextText, word, easyPronunciations);
+        const result = await getSmartAlternatives(contextText, word, easyPronunciations, difficultPronunciations);
         console.log('API result:', result);
         
         if (result && result.alternatives && Array.isArray(result.alternatives)) {
@@ -106,7 +107,7 @@ const WordPopover = forwardRef((
     };
 
     fetchAlternatives();
-  }, [word, currentText, textPosition, easyPronunciations]);
+  }, [word, currentText, textPosition, easyPronunciations, difficultPronunciations]);
 
   const handleSelect = (alternative: string, e: React.MouseEvent): void => {
     e.stopPropagation();
@@ -11,33 +11,275 @@ const apiClient = axios.create({
   },
 });
 
+// このページのクライアントID（同じクライアントの古いバージョンのリクエストはサーバーが打ち切る）
+const CLIENT_ID = crypto.randomUUID();
+
+// リクエストの種類ごとの最新のバージョン
+const latestVersions: Record<string, number> = {};
+
+const nextVersion = (channel: string) => {
+  latestVersions[channel] = (latestVersions[channel] ?? 0) + 1;
+  return latestVersions[channel];
+};
+
+// 新しいリクエストに置き換えられたため、サーバーが処理を打ち切った（409）かどうか
+const isSuperseded = (error: unknown) =>
+  axios.isAxiosError(error) && error.response?.status === 409;
+
+// 発音の設定ごとのプロファイルID（サーバーに一度だけ登録し、以降はIDで参照する）
+const profileIds = new Map<string, Promise<string>>();
+
+const getProfileId = (easyPronunciations: string[], difficultPronunciations: string[]) => {
+  const key = JSON.stringify([[...easyPronunciations].sort(), [...difficultPronunciations].sort()]);
+  let profileId = profileIds.get(key);
+  if (!profileId) {
+    profileId = apiClient
+      .post('/profiles', {
+        easy_pronunciations: easyPronunciations,
+        difficult_sounds: difficultPronunciations,
+      })
+      .then((response) => response.data.profile_id as string);
+    // 登録に失敗した場合は次回に登録し直す
+    profileId.catch(() => profileIds.delete(key));
+    profileIds.set(key, profileId);
+  }
+  return { key, profileId };
+};
+
+// プロファイルIDを付けてPOSTする
+// サーバーの再起動などでプロファイルが消えていた場合（404）は登録し直して再送する
+const postWithProfile = async (
+  url: string,
+  body: Record<string, unknown>,
+  easyPronunciations: string[],
+  difficultPronunciations: string[]
+) => {
+  const { key, profileId } = getProfileId(easyPronunciations, difficultPronunciations);
+  try {
+    return await apiClient.post(url, { ...body, profile_id: await profileId });
+  } catch (error) {
+    if (!axios.isAxiosError(error) || error.response?.status !== 404) throw error;
+    profileIds.delete(key);
+    const retry = getProfileId(easyPronunciations, difficultPronunciations);
+    return apiClient.post(url, { ...body, profile_id: await retry.profileId });
+  }
+};
 
 // リアルタイム分析API（難しい単語と代替案を一度に取得）
+// 新しいバージョンの分析を送った後に届いた古い結果は null を返す（画面に反映しない）
 export const analyzeRealtime = async (text: string, easyPronunciations: string[] = [], difficultPronunciations: string[] = []) => {
+  const version = nextVersion('analyze');
   try {
-    const response = await apiClient.post('/analyze-realtime', {
-      text,
-      easy_sounds: easyPronunciations,
-      difficult_sounds: difficultPronunciations
-    });
+    // 検出された単語の代替案はサーバーが空き時間に先読みし、クリック時はキャッシュから返される
+    const response = await postWithProfile(
+      '/analyze-realtime',
+      { text, prefetch_alternatives: 'mlm', client_id: CLIENT_ID, version },
+      easyPronunciations,
+      difficultPronunciations
+    );
+    if (version !== latestVersions.analyze) return null;
     console.log('リアルタイム分析結果:', response.data); // デバッグ用ログ
     return response.data;
   } catch (error) {
+    if (isSuperseded(error) || version !== latestVersions.analyze) return null;
     console.error('リアルタイム分析に失敗しました', error);
     throw error;
   }
 };
 
 
-// BERTを使用してマスクされた単語の代替案を取得するAPI
-export const getSmartAlternatives = async (text: string, targetWord: string, easyPronunciations: string[] = []) => {
-  try {
-    const response = await apiClient.post('/smart-alternatives', {
+// 編集セッションのハイライト（サーバーが割り当てたIDで差分を管理する）
+export interface SessionHighlight {
+  id: number;
+  word: string;
+  start: number;
+  end: number;
+  reason: string;
+  reading: string;
+}
+
+// 文書に対する編集操作（start〜endをtextで置き換える）
+export interface TextEdit {
+  start: number;
+  end: number;
+  text: string;
+}
+
+// 編集前後のテキストの共通の先頭・末尾を除いた差分を1つの編集操作として求める
+export const diffText = (oldText: string, newText: string): TextEdit | null => {
+  if (oldText === newText) return null;
+
+  let prefix = 0;
+  const maxPrefix = Math.min(oldText.length, newText.length);
+  while (prefix < maxPrefix && oldText[prefix] === newText[prefix]) prefix++;
+
+  let suffix = 0;
+  const maxSuffix = maxPrefix - prefix;
+  while (
+    suffix < maxSuffix &&
+    oldText[oldText.length - 1 - suffix] === newText[newText.length - 1 - suffix]
+  ) suffix++;
+
+  return {
+    start: prefix,
+    end: oldText.length - suffix,
+    text: newText.slice(prefix, newText.length - suffix),
+  };
+};
+
+// WebSocketの編集セッション
+// 文書全体は接続時に一度だけ送り、以降は編集操作を送ってハイライトの差分を受け取る
+export class EditingSession {
+  private socket: WebSocket | null = null;
+  private highlights = new Map<number, SessionHighlight>();
+  private text = '';
+  private difficultSounds: string[] = [];
+  private easyPronunciations: string[] = [];
+  private version = 0;
+  // 同期し直すまでの待ち（混雑・連続したエラーのときは間隔を空けて init を送り直す）
+  private resyncTimer: ReturnType<typeof setTimeout> | null = null;
+  private consecutiveErrors = 0;
+
+  constructor(private onChange: (words: SessionHighlight[]) => void) {}
+
+  // 接続を開いて文書全体を送る
+  open(text: string, difficultSounds: string[] = [], easyPronunciations: string[] = []): Promise<void> {
+    return new Promise((resolve, reject) => {
+      const socket = new WebSocket(`${API_BASE_URL.replace(/^http/, 'ws')}/ws/edit-session`);
+      socket.onopen = () => {
+        this.socket = socket;
+        this.sendInit(text, difficultSounds, easyPronunciations);
+        resolve();
+      };
+      socket.onerror = (event) => reject(event);
+      socket.onclose = () => {
+        this.socket = null;
+      };
+      socket.onmessage = (event) => this.handleMessage(JSON.parse(event.data));
+    });
+  }
+
+  isOpen(): boolean {
+    return this.socket !== null && this.socket.readyState === WebSocket.OPEN;
+  }
+
+  // 現在のテキストと設定をサーバーに同期する（変更部分だけを送る）
+  syncText(text: string, difficultSounds: string[] = [], easyPronunciations: string[] = []) {
+    if (this.resyncTimer !== null) {
+      // 送り直す init に最新の状態を含める
+      this.text = text;
+      this.difficultSounds = difficultSounds;
+      this.easyPronunciations = easyPronunciations;
+      return;
+    }
+
+    if (
+      difficultSounds.join(',') !== this.difficultSounds.join(',') ||
+      easyPronunciations.join(',') !== this.easyPronunciations.join(',')
+    ) {
+      this.difficultSounds = difficultSounds;
+      this.easyPronunciations = easyPronunciations;
+      this.send({
+        type: 'options',
+        difficult_sounds: difficultSounds,
+        easy_pronunciations: easyPronunciations,
+      });
+    }
+
+    const edit = diffText(this.text, text);
+    if (edit) {
+      this.text = text;
+      this.send({ type: 'edit', edits: [edit] });
+    }
+  }
+
+  close() {
+    this.cancelResync();
+    this.socket?.close();
+    this.socket = null;
+  }
+
+  private scheduleResync(delayMs: number) {
+    this.cancelResync();
+    this.resyncTimer = setTimeout(() => {
+      this.resyncTimer = null;
+      this.sendInit(this.text, this.difficultSounds, this.easyPronunciations);
+    }, delayMs);
+  }
+
+  private cancelResync() {
+    if (this.resyncTimer !== null) {
+      clearTimeout(this.resyncTimer);
+      this.resyncTimer = null;
+    }
+  }
+
+  private sendInit(text: string, difficultSounds: string[], easyPronunciations: string[]) {
+    this.text = text;
+    this.difficultSounds = difficultSounds;
+    this.easyPronunciations = easyPronunciations;
+    this.send({
+      type: 'init',
       text,
-      target_word: targetWord,
-      method: 'mlm',
-      easy_pronunciations: easyPronunciations
+      difficult_sounds: difficultSounds,
+      // 先読みのキーを getSmartAlternatives と同じ設定で作る
+      easy_pronunciations: easyPronunciations,
+      prefetch_alternatives: 'mlm', // getSmartAlternatives と同じ方法で先読みする
     });
+  }
+
+  private send(message: Record<string, unknown>) {
+    this.version += 1;
+    this.socket?.send(JSON.stringify({ ...message, version: this.version }));
+  }
+
+  private handleMessage(message: any) {
+    if (message.type === 'snapshot') {
+      this.consecutiveErrors = 0;
+      this.highlights = new Map(message.words.map((word: SessionHighlight) => [word.id, word]));
+    } else if (message.type === 'delta') {
+      // 位置のずれ → 削除 → 追加の順に適用する
+      for (const shift of message.shifts) {
+        this.highlights.forEach((highlight) => {
+          if (highlight.start >= shift.at) {
+            highlight.start += shift.delta;
+            highlight.end += shift.delta;
+          }
+        });
+      }
+      message.removed.forEach((id: number) => this.highlights.delete(id));
+      message.added.forEach((word: SessionHighlight) => this.highlights.set(word.id, word));
+    } else if (message.type === 'busy') {
+      // サーバーが混雑している場合は、指定された秒数だけ待ってから送り直す
+      this.scheduleResync((message.retry_after ?? 1) * 1000);
+      return;
+    } else if (message.type === 'error') {
+      // サーバーと状態がずれた場合は文書全体を送り直す（続けて失敗する場合は間隔を空ける）
+      console.error('編集セッションエラー:', message.detail);
+      const delayMs = this.consecutiveErrors === 0 ? 0 : Math.min(250 * 2 ** this.consecutiveErrors, 10000);
+      this.consecutiveErrors += 1;
+      this.scheduleResync(delayMs);
+      return;
+    }
+
+    this.onChange(
+      Array.from(this.highlights.values()).sort((a, b) => a.start - b.start)
+    );
+  }
+}
+
+// BERTを使用してマスクされた単語の代替案を取得するAPI
+export const getSmartAlternatives = async (text: string, targetWord: string, easyPronunciations: string[] = [], difficultPronunciations: string[] = []) => {
+  // 別の単語のポップオーバーを開いた場合、前の単語の推論はサーバーが打ち切る
+  const version = nextVersion('alternatives');
+  try {
+    // 苦手な音で始まる候補はサーバー側でプロファイルの設定をもとに除外する
+    const response = await postWithProfile(
+      '/smart-alternatives',
+      { text, target_word: targetWord, method: 'mlm', client_id: CLIENT_ID, version },
+      easyPronunciations,
+      difficultPronunciations
+    );
 
     // 応答形式の変更を処理
     if (response.data.alternatives) {
@@ -50,11 +292,33 @@ export const getSmartAlternatives = async (text: string, targetWord: string, eas
       return { alternatives: [] };
     }
   } catch (error) {
+    if (isSuperseded(error)) return { alternatives: [] };
     console.error(`単語「${targetWord}」の高度な代替案取得に失敗しました`, error);
     return { alternatives: [] }; // エラー時は空の配列を返す
   }
 };
 
+// 文書内の複数の単語（start / end の範囲）の代替案を一度に取得するAPI
+export const getBulkAlternatives = async (
+  text: string,
+  spans: { start: number; end: number }[],
+  easyPronunciations: string[] = [],
+  difficultPronunciations: string[] = []
+) => {
+  try {
+    const response = await postWithProfile(
+      '/bulk-alternatives',
+      { text, spans, method: 'mlm' },
+      easyPronunciations,
+      difficultPronunciations
+    );
+    return response.data.results;
+  } catch (error) {
+    console.error('代替案の一括取得に失敗しました', error);
+    return [];
+  }
+};
+
 // APIのバージョンやステータスを確認するAPI
 export const checkApiStatus = async () => {
   try {
@@ -69,5 +333,6 @@ export const checkApiStatus = async () => {
 export default {
   analyzeRealtime,
   getSmartAlternatives,
+  getBulkAlternatives,
   checkApiStatus,
 }; 
\ No newline at end of file